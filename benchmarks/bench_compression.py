@@ -0,0 +1,96 @@
+#benchmark: TNFS compression, space vs read latency
+#created by SKATT
+import argparse
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+INIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(INIT_DIR)
+
+from src.libs.logging import Logger
+from src.libs.CrashHandler import CrashHandler
+from src.core.users import UserManager
+from src.TNFS.TNFS import TNFS
+from src.TNFS.compress import COMPRESSION_MODES
+from src.security.SELinux import SELinux
+
+def parse_args():
+    """Разбирает аргументы командной строки."""
+    parser = argparse.ArgumentParser(description="TNFS compression: space vs read latency")
+    parser.add_argument("--files", type=int, default=100, help="Число файлов каждого вида")
+    parser.add_argument("--size", type=int, default=256 * 1024, help="Размер файла в байтах")
+    parser.add_argument("--reads", type=int, default=500, help="Число чтений на замер")
+    parser.add_argument("--modes", default=",".join(COMPRESSION_MODES), help="Режимы сжатия через запятую")
+    return parser.parse_args()
+
+def make_log(size: int, rng: random.Random) -> str:
+    """Текст, похожий на журнал сервиса: повторяющиеся шаблоны строк с меняющимися числами."""
+    levels = ("INFO", "INFO", "INFO", "WARNING", "ERROR")
+    lines, total = [], 0
+    while total < size:
+        line = (f"2025-06-27 23:{rng.randrange(60):02d}:{rng.randrange(60):02d} {rng.choice(levels)} "
+                f"worker-{rng.randrange(16)}: request {rng.randrange(10 ** 6)} served in {rng.random() * 100:.2f} ms\n")
+        lines.append(line)
+        total += len(line)
+    return "".join(lines)[:size]
+
+def make_config(size: int, rng: random.Random) -> str:
+    """Конфигурация: ключи с хэшами и токенами - сжимается хуже журнала."""
+    lines, total = [], 0
+    while total < size:
+        line = f"key_{rng.randrange(10 ** 4)} = {rng.getrandbits(128):032x}\n"
+        lines.append(line)
+        total += len(line)
+    return "".join(lines)[:size]
+
+def build(db_path: Path, mode: str, args) -> (TNFS, float):
+    """Создает образ с журналами и конфигурациями; кэш содержимого отключен, чтобы мерить чтение из SQLite."""
+    logger = Logger("bench")
+    crash_handler = CrashHandler(logger)
+    user_manager = UserManager(logger, crash_handler)
+    tnfs = TNFS(logger, crash_handler, user_manager, None, db_path=db_path, cache_bytes=0, compression=mode, read_journal="off")
+    tnfs.current_user = tnfs.current_role = "root"
+    tnfs.selinux = SELinux(logger, crash_handler, tnfs)
+    tnfs.selinux.set_mode("permissive")
+    rng = random.Random(1)
+    contents = [(f"/var/log_{i}.log", make_log(args.size, rng)) for i in range(args.files)]
+    contents += [(f"/etc/conf_{i}.conf", make_config(args.size, rng)) for i in range(args.files)]
+    start = time.perf_counter()
+    with tnfs.transaction():
+        for path, content in contents:
+            tnfs.create_file(path, content, owner="root", perms=0o644)
+    return tnfs, time.perf_counter() - start
+
+def measure(tnfs: TNFS, prefix: str, args) -> float:
+    """Среднее время чтения файла в миллисекундах."""
+    paths = [f"{prefix}_{i % args.files}" for i in range(args.reads)]
+    start = time.perf_counter()
+    for path in paths:
+        tnfs.read_file(path + (".log" if prefix.startswith("/var") else ".conf"))
+    return (time.perf_counter() - start) / args.reads * 1000
+
+def main():
+    args = parse_args()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        for mode in args.modes.split(","):
+            with contextlib.redirect_stdout(devnull):
+                tnfs, write_time = build(Path(tmp) / f"bench_{mode}.db", mode, args)
+                stats = tnfs.storage_stats()
+                log_ms = measure(tnfs, "/var/log", args)
+                conf_ms = measure(tnfs, "/etc/conf", args)
+            results.append((mode, stats, write_time, log_ms, conf_ms))
+            tnfs.db.close()
+    print(f"{'mode':>6} {'stored MB':>10} {'ratio':>6} {'write s':>8} {'log read ms':>12} {'conf read ms':>13}  codecs")
+    for mode, stats, write_time, log_ms, conf_ms in results:
+        codecs = ", ".join(f"{codec}={count}" for codec, count in sorted(stats["codecs"].items()))
+        print(f"{mode:>6} {stats['stored'] / 2 ** 20:>10.1f} {stats['stored'] / stats['bytes']:>6.2f} {write_time:>8.2f} "
+              f"{log_ms:>12.2f} {conf_ms:>13.2f}  {codecs}")
+
+if __name__ == "__main__":
+    main()
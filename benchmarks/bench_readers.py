@@ -0,0 +1,87 @@
+#benchmark: TNFS read throughput vs reader threads
+#created by SKATT
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+INIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(INIT_DIR)
+
+from src.libs.logging import Logger
+from src.libs.CrashHandler import CrashHandler
+from src.core.users import UserManager
+from src.TNFS.TNFS import TNFS
+from src.security.SELinux import SELinux
+
+def parse_args():
+    """Разбирает аргументы командной строки."""
+    parser = argparse.ArgumentParser(description="TNFS read throughput vs reader threads")
+    parser.add_argument("--files", type=int, default=200, help="Число файлов")
+    parser.add_argument("--size", type=int, default=256 * 1024, help="Размер файла в байтах")
+    parser.add_argument("--reads", type=int, default=2000, help="Число чтений на замер")
+    parser.add_argument("--threads", default="1,2,4,8", help="Список числа потоков через запятую")
+    parser.add_argument("--busy-timeout", type=float, default=10.0, help="busy-timeout SQLite в секундах")
+    parser.add_argument("--with-writer", action="store_true", help="Параллельно держать поток-писатель")
+    return parser.parse_args()
+
+def build(db_path: Path, args) -> TNFS:
+    """Создает образ TNFS с тестовыми файлами; кэш содержимого отключен, чтобы мерить чтение из SQLite."""
+    logger = Logger("bench")
+    crash_handler = CrashHandler(logger)
+    user_manager = UserManager(logger, crash_handler)
+    pool_size = max(int(n) for n in args.threads.split(","))
+    tnfs = TNFS(logger, crash_handler, user_manager, None, db_path=db_path, cache_bytes=0,
+                reader_pool_size=pool_size, busy_timeout=args.busy_timeout)
+    tnfs.current_user = tnfs.current_role = "root"
+    tnfs.selinux = SELinux(logger, crash_handler, tnfs)
+    tnfs.selinux.set_mode("permissive")
+    with tnfs.transaction():
+        for i in range(args.files):
+            tnfs.create_file(f"/tmp/bench_{i}.bin", chr(97 + i % 26) * args.size, owner="root", perms=0o644)
+    return tnfs
+
+def measure(tnfs: TNFS, threads: int, args) -> float:
+    """Возвращает число чтений в секунду при заданном числе потоков."""
+    paths = [f"/tmp/bench_{i % args.files}.bin" for i in range(args.reads)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for _ in pool.map(tnfs.read_file, paths):
+            pass
+    return args.reads / (time.perf_counter() - start)
+
+def writer(tnfs: TNFS, stop: threading.Event):
+    i = 0
+    while not stop.is_set():
+        tnfs.write_file("/tmp/bench_0.bin", str(i))
+        i += 1
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            tnfs = build(Path(tmp) / "bench.db", args)
+        results = []
+        for threads in [int(n) for n in args.threads.split(",")]:
+            stop = threading.Event()
+            background = threading.Thread(target=writer, args=(tnfs, stop)) if args.with_writer else None
+            with contextlib.redirect_stdout(devnull):
+                if background:
+                    background.start()
+                rate = measure(tnfs, threads, args)
+                stop.set()
+                if background:
+                    background.join()
+            results.append((threads, rate))
+        base = results[0][1]
+        print(f"{'threads':>8} {'reads/s':>10} {'speedup':>8}")
+        for threads, rate in results:
+            print(f"{threads:>8} {rate:>10.0f} {rate / base:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
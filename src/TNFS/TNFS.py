@@ -1,280 +1,1292 @@
 #TuNderFileSystem
 #created by SKATT
 import sqlite3
+import json
+import re
+import fnmatch
+import tarfile
+import shutil
 import time
 from pathlib import Path
-from typing import List, Optional, Dict
+from typing import Callable, Iterable, List, Optional, Dict, Tuple
 import os
 import sys
+import threading
+from contextlib import contextmanager
+try:
+    import pwd
+except ImportError:  # Windows: владельцы хоста не переносятся
+    pwd = None
 INIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(INIT_DIR)
 from libs.logging import Logger
 from libs.CrashHandler import CrashHandler, TunderCrash
+from TNFS.cache import ContentCache, DentryCache, Stat, DEFAULT_CACHE_BYTES
+from TNFS.handle import TNFSFile
+from TNFS.pool import ReaderPool, WriterLock, READER_POOL_SIZE, BUSY_TIMEOUT
+from TNFS.snapshot import SnapshotJob, SNAPSHOT_STEP_PAGES, SNAPSHOT_SUFFIX
+from TNFS.compress import encode, COMPRESSION_MODES, COMPRESS_MIN_BYTES
+from TNFS.backend import (StorageBackend, SQLiteBackend, MemoryBackend, BACKENDS, SCHEMA_VERSION, ROOT_PARENT, CHUNK_SIZE,
+                          blob_hash, components, split_path, parent_of)
+from TNFS.logstore import LogBackend
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
-     
+TNFS_DB = BASE_DIR / "data" / "tnfs.db"
+GROUP_COMMIT_SIZE = 256  # максимум операций в одной групповой фиксации
+GROUP_COMMIT_LATENCY = 0.05  # максимум секунд, которые операция ждет групповой фиксации
+COPY_BATCH_SIZE = 1000  # записей в одном пакете массового копирования
+WALK_BATCH_SIZE = 1000  # сколько записей директории walk читает за один запрос
+IMPORT_BATCH_SIZE = 5000  # записей в одной транзакции импорта
+IMPORT_BUFFER_BYTES = 16 * 1024 * 1024  # сколько содержимого импорт держит в памяти до записи пакета
+COMPRESS_BATCH_SIZE = 256  # blobs в одной транзакции compress
+READ_JOURNAL_MODES = ("full", "sampled", "aggregated", "off")  # политики журнала для чтений; изменения пишутся всегда
+READ_OPERATIONS = ("read", "list", "grep", "find")  # операции, которые учитываются по политике read_journal
+READ_SAMPLE_EVERY = 100  # в режиме sampled в журнал попадает каждое N-е чтение
+ACCESS_FLUSH_INTERVAL = 30.0  # секунд между записями счетчиков обращений в access_stats
+ACCESS_FLUSH_PATHS = 10000  # столько разных путей в памяти вызывает запись счетчиков раньше срока
+SNAPSHOT_NAME = re.compile(r"[A-Za-z0-9_][A-Za-z0-9_.-]*")  # имя снимка - имя файла в snapshot_dir
+
+class OperationCancelled(Exception):
+    """Операция прервана через токен отмены; её изменения откатываются."""
+
 class TNFS:
-    def __init__(self, logger: Logger, crash_handler: CrashHandler, user_manager: 'UserManager', selinux: Optional['SELinux'] = None):
+    def __init__(self, logger: Logger, crash_handler: CrashHandler, user_manager: 'UserManager', selinux: Optional['SELinux'] = None, db_path: Optional[Path] = None, cache_bytes: int = DEFAULT_CACHE_BYTES,
+                 journal_mode: str = "sync", group_commit_size: int = GROUP_COMMIT_SIZE, group_commit_latency: float = GROUP_COMMIT_LATENCY,
+                 reader_pool_size: int = READER_POOL_SIZE, busy_timeout: float = BUSY_TIMEOUT,
+                 read_journal: str = "aggregated", read_sample_every: int = READ_SAMPLE_EVERY, access_flush_interval: float = ACCESS_FLUSH_INTERVAL,
+                 compression: str = "auto", backend="sqlite"):
         from core.users import UserManager
         from security.SELinux import SELinux
         self.logger = logger
         self.crash_handler = crash_handler
         self.user_manager = user_manager
         self.selinux = selinux
-        self.cache = {}
-        self.db = sqlite3.connect(BASE_DIR / "data" / "tnfs.db", timeout=10)
-        self.db.execute("CREATE TABLE IF NOT EXISTS inodes (inode INTEGER PRIMARY KEY AUTOINCREMENT, ref_count INTEGER DEFAULT 1)")
-        self.db.execute("""
-            CREATE TABLE IF NOT EXISTS files (
-                path TEXT PRIMARY KEY,
-                inode INTEGER,
-                content TEXT,
-                owner TEXT,
-                perms INTEGER,
-                type TEXT CHECK(type IN ('file', 'directory')),
-                size INTEGER,
-                ctime REAL,
-                mtime REAL,
-                FOREIGN KEY(inode) REFERENCES inodes(inode)
-            )
-        """)
-        self.db.execute("""
-            CREATE TABLE IF NOT EXISTS journal (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                operation TEXT,
-                path TEXT,
-                timestamp REAL,
-                details TEXT,
-                user TEXT
-            )
-        """)
-        try:
-            self.db.execute("ALTER TABLE journal ADD COLUMN user TEXT")
-            self.logger.info("Added 'user' column to journal table")
-        except sqlite3.OperationalError:
-            pass
+        self.cache = ContentCache(cache_bytes)
+        self.dentries = DentryCache()
+        self.db_path = Path(db_path) if db_path else TNFS_DB
+        if compression not in COMPRESSION_MODES:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid compression mode: {compression}")
+        # хранилище образа (TNFS/backend.py): по умолчанию SQLite с единственным писателем и пулом читателей снимков WAL
+        if isinstance(backend, StorageBackend):
+            self.store = backend
+        elif backend == "sqlite":
+            self.store = SQLiteBackend(self.db_path, compression, reader_pool_size, busy_timeout)
+        elif backend == "memory":
+            self.store = MemoryBackend()
+        elif backend == "log":
+            self.store = LogBackend(self.db_path.with_suffix(".segments"))
+        else:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid storage backend: {backend} (expected one of {', '.join(BACKENDS)})")
+        self.compression = compression
+        self.snapshot_dir = self.db_path.parent / "snapshots"
+        self._snapshots: Dict[str, SnapshotJob] = {}
+        self._snapshot_lock = threading.Lock()
+        self._write_lock = WriterLock()
+        self._writer_owner = None
+        self._group_timer = None  # threading.Timer, фиксирующий отложенную группу через group_commit_latency
+        self._flushing_for = None  # поток, чью отложенную группу сейчас фиксирует таймер
+        self._commit_seq = 0
+        self._local = threading.local()
+        if journal_mode not in ("sync", "group"):
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid journal mode: {journal_mode}")
+        self.journal_mode = journal_mode
+        self.group_commit_size = group_commit_size
+        self.group_commit_latency = group_commit_latency
+        self._journal_buffer = []
+        self._deferred_journal = []
+        self._journal_lock = threading.Lock()
+        if read_journal not in READ_JOURNAL_MODES:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid read journal mode: {read_journal}")
+        self.read_journal = read_journal
+        self.read_sample_every = max(1, read_sample_every)
+        self.access_flush_interval = access_flush_interval
+        self._reads = 0
+        self._access: Dict[Tuple[str, str], List] = {}  # (путь, операция) -> [число обращений, последнее обращение, пользователь]
+        self._access_flushed = time.monotonic()
+        self._op_depth = 0
+        self.transaction_active = False
+        self._pending_ops = 0
+        self._first_pending = 0.0
+        self._mutations = 0
+        self._recovery = None
+        self._quotas = False  # есть ли заданные квоты: без них операции не проверяют превышение
         self.current_user = "user"
         self.current_role = "user"
         self.init_default_structure()
         self.logger.info("Tunder File System initialized")
 
+    @property
+    def db(self) -> sqlite3.Connection:
+        """Соединение писателя образа SQLite (для диагностики, TunRecovery и тестов)."""
+        return self.store.db
+
+    @db.setter
+    def db(self, conn: sqlite3.Connection):
+        self.store.db = conn
+
+    @property
+    def readers(self) -> ReaderPool:
+        return self.store.readers
+
+    @readers.setter
+    def readers(self, pool: ReaderPool):
+        self.store.readers = pool
+
+    @property
+    def compression(self) -> str:
+        """Политика сжатия новых блоков (TNFS/compress.py); её применяет хранилище."""
+        return self.store.compression
+
+    @compression.setter
+    def compression(self, mode: str):
+        self.store.compression = mode
+
+    @property
+    def recovery(self):
+        """TunRecovery: создает контрольные точки после фиксаций; пока он подключен, blobs без ссылок хранятся до контрольной точки."""
+        return self._recovery
+
+    @recovery.setter
+    def recovery(self, recovery):
+        self._recovery = recovery
+        self.store.retain_blobs = recovery is not None
+
+    def _require_feature(self, feature: str, operation: str):
+        if feature not in self.store.FEATURES:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"The {self.store.name} storage backend does not support {operation}")
+
     def init_default_structure(self):
         """Создает начальную структуру файловой системы."""
+        self._init_schema()
         defaults = [
-            ("/", "", "root", 0o755, "directory", 0),
-            ("/home", "", "root", 0o755, "directory", 0),
-            ("/etc", "", "root", 0o755, "directory", 0),
-            ("/bin", "", "root", 0o755, "directory", 0),
-            ("/var", "", "root", 0o755, "directory", 0),
-            ("/tmp", "", "root", 0o777, "directory", 0)
+            ("/", "root", 0o755, "directory", 0),
+            ("/home", "root", 0o755, "directory", 0),
+            ("/etc", "root", 0o755, "directory", 0),
+            ("/bin", "root", 0o755, "directory", 0),
+            ("/var", "root", 0o755, "directory", 0),
+            ("/tmp", "root", 0o777, "directory", 0)
         ]
-        for path, content, owner, perms, type_, size in defaults:
-            if not self.db.execute("SELECT path FROM files WHERE path = ?", (path,)).fetchone():
-                inode = self._create_inode()
-                ctime = mtime = time.time()
-                self.db.execute(
-                    "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (path, inode, content, owner, perms, type_, size, ctime, mtime)
-                )
-                self._log_journal("create", path, f"Created {type_}: {path}")
-        self.db.commit()
+        with self._op():
+            for path, owner, perms, type_, size in defaults:
+                if self._resolve(path) is None:
+                    inode = self._create_inode()
+                    ctime = mtime = time.time()
+                    self._insert_entry(path, inode, owner, perms, type_, size, ctime, mtime)
+                    self._log_journal("create", path, f"Created {type_}: {path}",
+                                      {"create": [[path, type_, owner, perms, size, ctime, mtime]]} if path != "/" else None)
+        self.flush()
         self.logger.info("Default TNFS structure committed to database")
-        cursor = self.db.execute("SELECT path, perms FROM files WHERE path = '/'")
-        result = cursor.fetchone()
+        result = self._entry("/")
         if result:
-            self.logger.info(f"Confirmed / exists in database with perms={oct(result[1])}")
+            self.logger.info(f"Confirmed / exists in database with perms={oct(result[2])}")
         else:
             self.logger.error("Failed to confirm / in database")
         self.logger.info("Default TNFS structure initialized")
 
+    def _init_schema(self):
+        """Создает структуры хранилища и мигрирует старые образы."""
+        self.cache.clear()
+        self.dentries.clear()
+        self.store.init_schema(self.logger)
+        self._quotas = self.store.has_quotas()
+
+    def purge_blobs(self, hashes: List[str]) -> int:
+        """Удаляет из hashes blobs, на которые по-прежнему нет ссылок. Возвращает число удаленных."""
+        with self._op():
+            return self.store.purge_blobs(hashes)
+
+    def _load_content(self, inode: int) -> bytes:
+        """Собирает содержимое файла из блоков."""
+        with self.reader() as view:
+            return view.chunks(inode)
+
+    def _index_content(self, inode: int, text: Optional[str] = None):
+        """Связывает файл с записью полнотекстового индекса; без text содержимое собирается из блоков, если записи еще нет."""
+        self.store.index(inode, text)
+
+    def _refresh_index(self):
+        """Переиндексирует файлы из очереди content_stale и убирает накопившиеся мертвые записи индекса."""
+        with self.reader() as view:
+            if not view.has_stale() and not view.index_garbage():
+                return
+        with self._op():
+            stale = self.store.stale()
+            for inode in stale:
+                self._index_content(inode)
+            self.store.clear_stale()
+            pruned = self.store.prune_index() if self.store.index_garbage() else 0
+        if stale:
+            self.logger.info(f"Reindexed {len(stale)} files")
+        if pruned:
+            self.logger.info(f"Pruned {pruned} dead content index entries")
+
+    def _read_range(self, inode: int, offset: int, length: int, size: int) -> bytes:
+        """Читает диапазон байтов файла, загружая только нужные блоки."""
+        end = size if length < 0 else min(offset + length, size)
+        if offset >= end:
+            return b""
+        first, last = offset // CHUNK_SIZE, (end - 1) // CHUNK_SIZE
+        with self.reader() as view:
+            data = view.chunks(inode, first, last)
+        base = first * CHUNK_SIZE
+        return data[offset - base:end - base]
+
+    _parent_of = staticmethod(parent_of)
+    _components = staticmethod(components)
+    _split = staticmethod(split_path)
+
+    def _resolve(self, path: str, view: Optional[StorageBackend] = None) -> Optional[int]:
+        """Находит инод пути, проходя dentries от корня; разрешенные префиксы берутся из кэша dentries."""
+        view = view or self.store
+        parts = self._components(path)
+        # пока другой поток держит транзакцию записи, кэш может содержать её незафиксированные переименования
+        cacheable = self._write_lock.acquire(blocking=False)
+        try:
+            fill = cacheable and (view is self.store or getattr(self._local, "snapshot_seq", None) == self._commit_seq)
+            start, inode = 0, None
+            if cacheable:
+                for i in range(len(parts), -1, -1):
+                    inode = self.dentries.get("/" + "/".join(parts[:i]))
+                    if inode is not None:
+                        start = i
+                        break
+            if inode is None:
+                inode = view.root()
+                if inode is None:
+                    return None
+                if fill:
+                    self.dentries.put("/", inode)
+            for i in range(start, len(parts)):
+                inode = view.lookup(inode, parts[i])
+                if inode is None:
+                    return None
+                if fill:
+                    self.dentries.put("/" + "/".join(parts[:i + 1]), inode)
+            return inode
+        finally:
+            if cacheable:
+                self._write_lock.release()
+
+    def _entry(self, path: str, view: Optional[StorageBackend] = None) -> Optional[Stat]:
+        """Возвращает запись Stat пути или None. При попадании в кэш dentries запросов нет, иначе - один запрос на каждый неразрешенный компонент."""
+        view = view or self.store
+        key = "/" + "/".join(self._components(path))
+        cacheable = self._write_lock.acquire(blocking=False)
+        try:
+            fill = cacheable and (view is self.store or getattr(self._local, "snapshot_seq", None) == self._commit_seq)
+            inode = self.dentries.get(key) if cacheable else None
+            if inode is not None:
+                stat = self.dentries.get_stat(inode)
+                if stat is not None:
+                    return stat
+                stat = view.get_stat(inode)
+            else:
+                parent_path, name = self._split(path)
+                if parent_path is None:
+                    parent = ROOT_PARENT
+                else:
+                    # предки разрешаются так же, поэтому их записи Stat тоже попадают в кэш
+                    parent_entry = self._entry(parent_path, view)
+                    if parent_entry is None:
+                        return None
+                    parent = parent_entry.inode
+                stat = view.lookup_stat(parent, name)
+            if stat is None:
+                return None
+            if fill:
+                self.dentries.put(key, stat.inode)
+                self.dentries.put_stat(stat)
+            return stat
+        finally:
+            if cacheable:
+                self._write_lock.release()
+
+    def _parent_entry(self, path: str) -> Stat:
+        """Возвращает Stat родительской директории пути или завершает операцию ошибкой, если её нет."""
+        parent_dir = os.path.dirname(path) or "/"
+        parent = self._entry(parent_dir)
+        if parent is None or parent.type != "directory":
+            self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Parent directory not found: {parent_dir}")
+        return parent
+
+    def stat(self, path: str) -> Optional[Stat]:
+        """Возвращает неизменяемую запись Stat (inode, owner, perms, type, size, ctime, mtime) или None, если пути нет."""
+        with self.reader() as view:
+            return self._entry(path, view)
+
+    def path_type(self, path: str) -> Optional[str]:
+        """Возвращает тип записи ('file' или 'directory') или None, если пути нет."""
+        entry = self.stat(path)
+        return entry.type if entry else None
+
+    def _account(self, parent_path: Optional[str], files: int = 0, directories: int = 0, size: int = 0, owners: Iterable[str] = ()):
+        """Добавляет изменение к счетчикам директории parent_path и всех её предков: иноды предков берутся из кэша dentries,
+        обновление - O(глубины) строк dir_usage по первичному ключу. Если использование растет, проверяет квоты этих директорий
+        и владельцев owners."""
+        if parent_path is None:
+            return
+        parts = self._components(parent_path)
+        ancestors = [self._resolve("/" + "/".join(parts[:i])) for i in range(len(parts) + 1)]
+        if files or directories or size:
+            self.store.account(ancestors, files, directories, size)
+        if self._quotas and (files > 0 or directories > 0 or size > 0):
+            self._check_quota(ancestors, owners)
+
+    def _check_quota(self, ancestors: List[int], owners: Iterable[str]):
+        """Прерывает операцию, если директории ancestors или владельцы owners превысили квоту."""
+        row = self.store.over_quota(ancestors)
+        if row is not None:
+            self.crash_handler.raise_crash("FS", "0xQEX0ERR", f"Quota exceeded for {self._path_of(row[0], self.store, {})}: {self._quota_text(*row[1:])}")
+        for owner in set(owners):
+            row = self.store.owner_over_quota(owner)
+            if row is not None:
+                self.crash_handler.raise_crash("FS", "0xQEX0ERR", f"Quota exceeded for user {owner}: {self._quota_text(*row)}")
+
+    @staticmethod
+    def _quota_text(size: int, entries: int, max_bytes: Optional[int], max_entries: Optional[int]) -> str:
+        limits = [f"{limit} {unit}" for limit, unit in ((max_bytes, "bytes"), (max_entries, "entries")) if limit is not None]
+        return f"{size} bytes, {entries} entries (limit {', '.join(limits)})"
+
+    def _usage_of(self, entry: Stat) -> Tuple[int, int, int]:
+        """Вклад записи в счетчики предков: (файлы, директории, байты), у директории вместе с ней самой и поддеревом."""
+        if entry.type != "directory":
+            return 1, 0, entry.size or 0
+        files, directories, size = self.store.usage(entry.inode)
+        return files, directories + 1, size
+
+    def _insert_entry(self, path: str, inode: int, owner: str, perms: int, type_: str, size: int, ctime: float, mtime: float):
+        """Добавляет запись о файле или директории."""
+        parent_path, name = self._split(path)
+        parent = ROOT_PARENT if parent_path is None else self._resolve(parent_path)
+        self.store.link(parent, name, inode, owner, perms, type_, size, ctime, mtime)
+        self._account(parent_path, type_ == "file", type_ == "directory", size or 0, (owner,))
+
+    def _unlink(self, path: str):
+        """Удаляет запись пути из родительской директории."""
+        parent_path, name = self._split(path)
+        self.store.unlink(self._resolve(parent_path), name)
+        self.dentries.invalidate_tree(path)
+
+    def _move_entry(self, old_path: str, new_path: str):
+        """Переносит одну запись dentries: потомки директории идут за ней без изменений."""
+        old_parent, old_name = self._split(old_path)
+        new_parent, new_name = self._split(new_path)
+        old_inode, new_inode = self._resolve(old_parent), self._resolve(new_parent)
+        if old_inode != new_inode:
+            files, directories, size = self._usage_of(self._entry(old_path))
+            self._account(old_parent, -files, -directories, -size)
+            self._account(new_parent, files, directories, size)
+        self.store.move(old_inode, old_name, new_inode, new_name)
+        self.dentries.invalidate_tree(old_path)
+
+    def _has_children(self, path: str) -> bool:
+        """Проверяет, есть ли в директории записи (по первичному ключу dentries)."""
+        return self.store.has_children(self._resolve(path))
+
+    def count_children(self, path: str) -> int:
+        """Возвращает число непосредственных потомков директории."""
+        with self.reader() as view:
+            return view.count_children(self._resolve(path, view))
+
+    def _walk(self, inode: int, path: str, view: StorageBackend, order: str = "pre", batch_size: int = WALK_BATCH_SIZE):
+        """Обходит потомков директории inode в глубину и отдает (путь, Stat).
+
+        Записи директории читаются страницами по первичному ключу dentries (name > последнего прочитанного),
+        поэтому в памяти держится не больше batch_size записей на уровень вложенности.
+        order="pre" отдает директорию раньше её содержимого, order="post" - после.
+        """
+        if order not in ("pre", "post"):
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid walk order: {order}")
+        # кадр: [инод директории, префикс путей, текущая страница, позиция в странице, сама директория для post]
+        frames = [[inode, path.rstrip("/") + "/", [], 0, None]]
+        while frames:
+            frame = frames[-1]
+            if frame[3] == len(frame[2]):
+                page = view.children(frame[0], frame[2][-1][0] if frame[2] else "", batch_size)
+                if not page:
+                    frames.pop()
+                    if frame[4] is not None:
+                        yield frame[4]
+                    continue
+                frame[2], frame[3] = page, 0
+            name, stat = frame[2][frame[3]]
+            frame[3] += 1
+            entry = (frame[1] + name, stat)
+            if entry[1].type == "directory":
+                if order == "pre":
+                    yield entry
+                frames.append([entry[1].inode, entry[0] + "/", [], 0, entry if order == "post" else None])
+            else:
+                yield entry
+
+    def walk(self, path: str = "/", order: str = "pre", batch_size: int = WALK_BATCH_SIZE):
+        """Генератор (путь, Stat) по всем потомкам директории path (без неё самой) в одном снимке читателя."""
+        with self.reader() as view:
+            root = self._entry(path, view)
+            self._selinux_check(path, "read", root)
+            if root.type != "directory":
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a directory: {path}")
+            if not self._check_permissions(path, self.current_user, "read", root):
+                self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No read permission: {path}")
+            yield from self._walk(root.inode, path, view, order, batch_size)
+
+    def du(self, path: str, stored: bool = False) -> Dict:
+        """Записи и логический размер (bytes) поддерева директории из счетчиков dir_usage за O(1).
+        stored=True дополнительно считает занятое на диске после сжатия (stored) обходом walk."""
+        with self.reader() as view:
+            entry = self._entry(path, view)
+            self._selinux_check(path, "read", entry)
+            if entry is None:
+                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Directory not found: {path}")
+            if entry.type != "directory":
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a directory: {path}")
+            if not self._check_permissions(path, self.current_user, "read", entry):
+                self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No read permission: {path}")
+            files, directories, size = view.usage(entry.inode)
+        usage = {"entries": files + directories, "files": files, "directories": directories, "bytes": size}
+        if not stored:
+            return usage
+        usage["stored"] = 0
+        inodes = []
+
+        def count_stored():
+            with self.reader() as view:
+                usage["stored"] += view.stored_bytes(inodes)
+            inodes.clear()
+
+        for _, child in self.walk(path):
+            if child.type == "file":
+                inodes.append(child.inode)
+                if len(inodes) >= WALK_BATCH_SIZE:
+                    count_stored()
+        if inodes:
+            count_stored()
+        return usage
+
+    def df(self) -> Dict:
+        """Занятое место образа из счетчиков: итог по корню, размер файла образа и свободные в нем страницы, разбивка по владельцам."""
+        with self.reader() as view:
+            root = self._entry("/", view)
+            files, directories, size = view.usage(root.inode)
+            image, free = view.image_size()
+            owners = {
+                owner: {"files": files_, "directories": directories_, "bytes": size_, "max_bytes": max_bytes, "max_entries": max_entries}
+                for owner, files_, directories_, size_, max_bytes, max_entries in sorted(view.owner_usage(), key=lambda row: -row[3])
+                if files_ + directories_ > 0 or max_bytes is not None or max_entries is not None
+            }
+        return {"entries": files + directories + 1, "files": files, "directories": directories + 1, "bytes": size,
+                "image": image, "free": free, "owners": owners}
+
+    def set_quota(self, target: str, max_bytes: Optional[int] = None, max_entries: Optional[int] = None):
+        """Задает квоту (только root) пользователю или, если target - путь, поддереву директории; None снимает ограничение.
+        Квота не пускает операции, которые увеличивают использование сверх нее; уже занятое место не отбирается."""
+        self._require_root("set quotas")
+        for limit in (max_bytes, max_entries):
+            if limit is not None and limit < 0:
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid quota limit: {limit}")
+        with self._op():
+            self._apply_quota(target, max_bytes, max_entries)
+            self._log_journal("quota", target, f"Set quota for {target}: {max_bytes} bytes, {max_entries} entries",
+                              {"quota": [[target, max_bytes, max_entries]]})
+        self.logger.info(f"Quota set for {target}: {max_bytes} bytes, {max_entries} entries")
+
+    def _apply_quota(self, target: str, max_bytes: Optional[int], max_entries: Optional[int]):
+        """Записывает лимиты квоты пользователя или директории target (путь начинается с /)."""
+        if target.startswith("/"):
+            entry = self._entry(target)
+            if entry is None:
+                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Directory not found: {target}")
+            if entry.type != "directory":
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a directory: {target}")
+            self.store.set_dir_quota(entry.inode, max_bytes, max_entries)
+        else:
+            self.store.set_owner_quota(target, max_bytes, max_entries)
+        self._quotas = self._quotas or max_bytes is not None or max_entries is not None
+
+    def quotas(self) -> List[Dict]:
+        """Заданные квоты пользователей и директорий с текущим использованием."""
+        result = []
+        with self.reader() as view:
+            for owner, files, directories, size, max_bytes, max_entries in sorted(view.owner_usage()):
+                if max_bytes is None and max_entries is None:
+                    continue
+                result.append({"target": owner, "entries": files + directories, "bytes": size, "max_bytes": max_bytes, "max_entries": max_entries})
+            known = {}
+            for inode, files, directories, size, max_bytes, max_entries in view.dir_quotas():
+                result.append({"target": self._path_of(inode, view, known), "entries": files + directories, "bytes": size,
+                               "max_bytes": max_bytes, "max_entries": max_entries})
+        return result
+
+    def storage_stats(self) -> Dict:
+        """Хранилище blobs целиком: число blobs, исходный (bytes) и хранимый (stored) объем, число blobs по кодекам."""
+        with self.reader() as view:
+            return view.storage_stats()
+
+    def compress(self, progress: Optional[Callable[[int, int], None]] = None, cancel: Optional[threading.Event] = None) -> Dict:
+        """Сжимает blobs, сохраненные как есть, по текущей политике compression (только root). Сжатие идет вне блокировки
+        писателя по снимку читателя, результат пишется пакетами по COMPRESS_BATCH_SIZE. Возвращает отчет."""
+        self._require_root("compress the image")
+        self._require_feature("compress", "compression")
+        report = {"blobs": 0, "compressed": 0, "before": 0, "after": 0}
+        if self.compression == "off":
+            return report
+        with self.reader() as view:
+            total = view.count_raw_blobs(COMPRESS_MIN_BYTES)
+        last = ""
+        while cancel is None or not cancel.is_set():
+            with self.reader() as view:
+                rows = view.raw_blobs(last, COMPRESS_MIN_BYTES, COMPRESS_BATCH_SIZE)
+            if not rows:
+                break
+            last = rows[-1][0]
+            updates = []
+            for blob, content in rows:
+                codec, stored = encode(content, self.compression)
+                report["blobs"] += 1
+                report["before"] += len(content)
+                report["after"] += len(stored)
+                if codec is not None:
+                    updates.append((codec, stored, blob))
+            if updates:
+                # содержимое blob по хэшу неизменно: пакет только меняет его представление и не конфликтует с операциями
+                with self._op():
+                    self.store.set_codecs(updates)
+                report["compressed"] += len(updates)
+            if progress is not None:
+                progress(report["blobs"], total)
+        with self._op():
+            self._log_journal("compress", "/", f"Compressed {report['compressed']} of {report['blobs']} blobs: "
+                                               f"{report['before']} -> {report['after']} bytes")
+        self.logger.info(f"Compressed {report['compressed']} of {report['blobs']} blobs ({report['before']} -> {report['after']} bytes)")
+        return report
+
+    def fsck(self, path: str = "/") -> List[str]:
+        """Проверяет целостность поддерева и возвращает список найденных проблем; образ не изменяет."""
+        self.logger.info(f"Checking TNFS consistency: {path}")
+        problems = []
+        with self.reader() as view:
+            for entry_path, entry in self.walk(path):
+                if entry.type not in ("file", "directory"):
+                    problems.append(f"{entry_path}: invalid type {entry.type!r}")
+                elif entry.type == "file":
+                    problems.extend(self._check_file(entry_path, entry, view))
+            if path.rstrip("/") == "":
+                # проверки по всему образу: записи без инодов, недостижимые иноды, счетчики ссылок блоков
+                problems.extend(view.check_image())
+        for problem in problems:
+            self.logger.warning(f"fsck: {problem}")
+        self._log_journal("fsck", path, f"Checked {path}: {len(problems)} problems")
+        return problems
+
+    @staticmethod
+    def _check_file(path: str, entry: Stat, view: StorageBackend) -> List[str]:
+        """Проверяет блоки одного файла: все blobs на месте, номера блоков подряд, размер совпадает с содержимым."""
+        problems = []
+        count, last, size, missing = view.check_file(entry.inode)
+        if missing:
+            problems.append(f"{path}: {missing} extents reference missing blobs")
+        if count and last != count - 1:
+            problems.append(f"{path}: extents are not contiguous")
+        if not missing and size != entry.size:
+            problems.append(f"{path}: size {entry.size} does not match stored content ({size} bytes)")
+        return problems
+
     def _create_inode(self) -> int:
         """Создает новый инод."""
-        with self.db:
-            cursor = self.db.execute("INSERT INTO inodes (ref_count) VALUES (1)")
-            inode = cursor.lastrowid
-            self.logger.info(f"Created inode: {inode}")
-            return inode
+        inode = self.store.create_inode()
+        self.logger.info(f"Created inode: {inode}")
+        return inode
 
-    def _check_permissions(self, path: str, user: str, operation: str) -> bool:
-        """Проверяет разрешения на основе chmod."""
-        with self.db:
-            cursor = self.db.execute("SELECT owner, perms FROM files WHERE path = ?", (path,))
-            result = cursor.fetchone()
-            if not result:
+    def _check_permissions(self, path: str, user: str, operation: str, entry: Optional[Stat] = None) -> bool:
+        """Проверяет разрешения на основе chmod; entry - уже найденная запись пути, чтобы не искать её повторно."""
+        if entry is None:
+            entry = self.stat(path)
+        if not entry:
+            self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Path not found: {path}")
+        return self._perm_allows(path, entry.owner, entry.perms, user, operation)
+
+    def _selinux_check(self, path: str, operation: str, entry: Optional[Stat]):
+        """Проверяет политику SELinux по уже найденной записи пути, без повторного запроса к TNFS."""
+        if entry is None and operation != "write":
+            self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Path not found: {path}")
+        if not self.selinux.check_access(path, operation, self.current_user, self.current_role, self.user_manager.current_session_id, stat=entry):
+            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied {operation} on {path} for {self.current_user} ({self.current_role})")
+
+    def _perm_allows(self, path: str, owner: str, perms: int, user: str, operation: str) -> bool:
+        """Проверяет биты прав по уже известным owner и perms. Вызывается на каждом чтении, поэтому в лог не пишет:
+        отказ попадает туда через crash_handler."""
+        # Права в восьмеричной системе: owner (u), group (g), others (o)
+        owner_perms = (perms >> 6) & 0o7  # Права владельца
+        other_perms = perms & 0o7  # Права для остальных
+        operation_bits = {"read": 0o4, "write": 0o2, "execute": 0o1}
+        required_bit = operation_bits.get(operation)
+        if not required_bit:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid operation: {operation}")
+        if user == owner or user == "root":
+            return (owner_perms & required_bit) == required_bit
+        return operation in ["read", "execute"] and (other_perms & required_bit) == required_bit
+
+    def _log_journal(self, operation: str, path: str, details: str, payload: Optional[Dict] = None):
+        """Добавляет запись в буфер журнала; она пишется в той же транзакции, что и операция.
+        payload - описание изменения для повтора при восстановлении (см. _redo); у чтений его нет."""
+        record = (operation, path, time.time(), details, self.current_user,
+                  None if payload is None else json.dumps(payload, separators=(",", ":")))
+        if self._writer_owner == threading.get_ident():
+            self._journal_buffer.append(record)
+        else:
+            # чтения идут без транзакции писателя: их записи уходят со следующей фиксацией
+            with self._journal_lock:
+                self._deferred_journal.append(record)
+
+    def _require_root(self, operation: str):
+        if self.current_user != "root":
+            self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"Only root can {operation}")
+
+    def set_read_journal(self, mode: str):
+        """Задает политику журнала для чтений: full - запись на каждое чтение, sampled - каждое read_sample_every-е,
+        aggregated - счетчики обращений в access_stats, off - чтения не учитываются. Изменения журналируются всегда."""
+        self._require_root("change the read journal mode")
+        if mode not in READ_JOURNAL_MODES:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid read journal mode: {mode}")
+        previous, self.read_journal = self.read_journal, mode
+        if previous == "aggregated" and mode != "aggregated":
+            self.flush_access_stats()
+        self.logger.info(f"Read journal mode: {mode}")
+
+    def _log_read(self, operation: str, path: str, details: str):
+        """Учитывает чтение по политике read_journal."""
+        mode = self.read_journal
+        if mode == "off":
+            return
+        if mode == "full":
+            self._log_journal(operation, path, details)
+            return
+        with self._journal_lock:
+            if mode == "sampled":
+                self._reads += 1
+                sampled = self._reads % self.read_sample_every == 0
+            else:
+                counter = self._access.get((path, operation))
+                if counter is None:
+                    self._access[(path, operation)] = [1, time.time(), self.current_user]
+                else:
+                    counter[0] += 1
+                    counter[1] = time.time()
+                    counter[2] = self.current_user
+                due = self._access_due()
+        if mode == "sampled":
+            if sampled:
+                self._log_journal(operation, path, f"{details} (sampled 1/{self.read_sample_every})")
+        elif due and self._write_lock.acquire(blocking=False):
+            # чтение не ждет чужую транзакцию: счетчики запишет следующая фиксация
+            try:
+                self.flush()
+            finally:
+                self._write_lock.release()
+
+    def _access_due(self) -> bool:
+        """Пора ли записать счетчики обращений: прошел access_flush_interval или накопилось ACCESS_FLUSH_PATHS путей."""
+        return bool(self._access) and (len(self._access) >= ACCESS_FLUSH_PATHS
+                                       or time.monotonic() - self._access_flushed >= self.access_flush_interval)
+
+    def _write_access(self) -> int:
+        """Переносит счетчики обращений в access_stats одной пакетной записью в текущей транзакции."""
+        with self._journal_lock:
+            if not self._access:
+                return 0
+            access, self._access = self._access, {}
+            self._access_flushed = time.monotonic()
+        self.store.write_access([(path, operation, count, last_access, user) for (path, operation), (count, last_access, user) in access.items()])
+        return len(access)
+
+    def flush_access_stats(self) -> int:
+        """Сразу записывает счетчики обращений из памяти. Возвращает число записанных путей."""
+        with self._write_lock:
+            if self._op_depth:
+                return 0
+            if not self.store.in_transaction:
+                self._begin_write()
+            written = self._write_access()
+        self.flush()
+        return written
+
+    def hot_files(self, limit: int = 10, operation: str = "read") -> List[Tuple[str, int, float]]:
+        """Самые частые обращения операции operation по access_stats: (путь, число обращений, последнее обращение).
+        Удаленные пути и пути без права чтения пропускаются."""
+        if operation not in READ_OPERATIONS:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid operation: {operation}")
+        self.flush_access_stats()
+        hot = []
+        with self.reader() as view:
+            for path, count, last_access in view.access(operation):
+                entry = self._entry(path, view)
+                if entry is None or not self._perm_allows(path, entry.owner, entry.perms, self.current_user, "read"):
+                    continue
+                hot.append((path, count, last_access))
+                if len(hot) >= limit:
+                    break
+        return hot
+
+    def _write_journal(self):
+        """Переносит буфер журнала в текущую транзакцию одной пакетной записью."""
+        with self._journal_lock:
+            deferred, self._deferred_journal = self._deferred_journal, []
+        records, self._journal_buffer = deferred + self._journal_buffer, []
+        if not records:
+            return
+        self.store.append_journal(records)
+        self._mutations += sum(1 for record in records if record[5] is not None)
+
+    def _redo(self, payload: Dict, fetch_blob: Callable[[str], Optional[bytes]]):
+        """Повторяет изменение по payload записи журнала, без проверок SELinux. Части применяются в порядке
+        delete, rename, copy, create, extents, set, quota; повтор уже примененной записи ничего не меняет."""
+        for path in payload.get("delete", []):
+            entry = self._entry(path)
+            if entry is not None:
+                self._drop(path, entry)
+        for old_path, new_path in payload.get("rename", []):
+            if self._entry(old_path) is not None and self._entry(new_path) is None:
+                self._parent_entry(new_path)
+                self._move_entry(old_path, new_path)
+                self.cache.invalidate_tree(old_path)
+        for src_path, dst_path, ctime in payload.get("copy", []):
+            source = self._entry(src_path)
+            if source is None:
+                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Path not found: {src_path}")
+            if self._entry(dst_path) is None:
+                self._copy_entry(source, dst_path, ctime)
+        touched = set()
+        for path, type_, owner, perms, size, ctime, mtime in payload.get("create", []):
+            entry = self._entry(path)
+            if entry is None:
+                self._parent_entry(path)
+                self._insert_entry(path, self._create_inode(), owner, perms, type_, size, ctime, mtime)
+            elif entry.type != type_:
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path already exists: {path}")
+            else:
+                self.store.set_stat(entry.inode, owner=owner, perms=perms, size=size, ctime=ctime, mtime=mtime)
+                self._account(self._split(path)[0], size=(size or 0) - (entry.size or 0), owners=(owner,))
+                self.dentries.invalidate_inode(entry.inode)
+        for path, idx, blob in payload.get("extents", []):
+            entry = self._entry(path)
+            if entry is None:
+                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"File not found: {path}")
+            old = self.store.extents(entry.inode, idx, idx)
+            if not old or old[0][1] != blob:
+                if not self.store.blob_ref(blob):
+                    data = fetch_blob(blob)
+                    if data is None or blob_hash(data) != blob:
+                        self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Blob {blob[:12]} of {path} is not available")
+                    self.store.blob_put(data)
+                self.store.put_extent(entry.inode, idx, blob)
+                self.store.blob_release(old[0][1] if old else None)
+            touched.add((path, entry.inode))
+        for path, fields in payload.get("set", []):
+            entry = self._entry(path)
+            if entry is None:
                 self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Path not found: {path}")
-            owner, perms = result
-            self.logger.info(f"Checking permissions: path={path}, user={user}, operation={operation}, owner={owner}, perms={oct(perms)}")
-            # Права в восьмеричной системе: owner (u), group (g), others (o)
-            owner_perms = (perms >> 6) & 0o7  # Права владельца
-            other_perms = perms & 0o7  # Права для остальных
-            operation_bits = {"read": 0o4, "write": 0o2, "execute": 0o1}
-            required_bit = operation_bits.get(operation)
-            if not required_bit:
-                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid operation: {operation}")
-            if user == owner or user == "root":
-                self.logger.info(f"User is owner or root, checking owner perms: {oct(owner_perms)} & {oct(required_bit)}")
-                return (owner_perms & required_bit) == required_bit
-            self.logger.info(f"User is not owner, checking other perms: {oct(other_perms)} & {oct(required_bit)}")
-            return operation in ["read", "execute"] and (other_perms & required_bit) == required_bit
-
-    def _log_journal(self, operation: str, path: str, details: str):
-        """Логирует операцию в журнал."""
-        with self.db:
-            self.db.execute(
-                "INSERT INTO journal (operation, path, timestamp, details, user) VALUES (?, ?, ?, ?, ?)",
-                (operation, path, time.time(), details, self.current_user)
-            )
+            self.store.set_stat(entry.inode, **{column: fields[column] for column in ("size", "mtime", "perms") if column in fields})
+            if "size" in fields and entry.type == "file":
+                self._account(self._split(path)[0], size=fields["size"] - (entry.size or 0), owners=(entry.owner,))
+                self.store.truncate_extents(entry.inode, (fields["size"] + CHUNK_SIZE - 1) // CHUNK_SIZE)
+                touched.add((path, entry.inode))
+            self.dentries.invalidate_inode(entry.inode)
+        for target, max_bytes, max_entries in payload.get("quota", []):
+            self._apply_quota(target, max_bytes, max_entries)
+        for path, inode in touched:
+            self.store.mark_stale([inode])
+            self.dentries.invalidate_inode(inode)
+            self.cache.invalidate(path)
+
+    def replay(self, records, fetch_blob: Callable[[str], Optional[bytes]]) -> int:
+        """Повторяет записи журнала (id, operation, path, timestamp, details, user, payload) одной транзакцией и переносит их
+        в журнал образа без изменений. Останавливается на первой записи, которую нельзя повторить. Возвращает число повторенных записей."""
+        replayed = 0
+        user = self.current_user
+        self.begin()
+        try:
+            for record in records:
+                try:
+                    with self._op():
+                        if record[6] is not None:
+                            self.current_user = record[5] or "root"
+                            self._redo(json.loads(record[6]), fetch_blob)
+                        self.store.insert_journal(record)
+                except Exception as e:
+                    self.logger.error(f"Replay stopped at journal entry {record[0]} ({record[1]} {record[2]}): {e}")
+                    break
+                replayed += 1
+        finally:
+            self.current_user = user
+            self.commit()
+        self.dentries.clear()
+        self.cache.clear()
+        return replayed
+
+    def _begin_write(self):
+        """Открывает транзакцию писателя; блокировка удерживается до фиксации или отката."""
+        self._write_lock.acquire()
+        self._writer_owner = threading.get_ident()
+        self.store.begin()
+
+    def _end_write(self):
+        if self._writer_owner is None:
+            return
+        self._writer_owner = None
+        self._commit_seq += 1
+        self._write_lock.release()
+
+    @contextmanager
+    def reader(self):
+        """Представление хранилища для чтения: поток с открытой транзакцией читает через писателя, остальные - через reader() хранилища."""
+        if self._writer_owner == threading.get_ident():
+            yield self.store
+            return
+        if self._flushing_for == threading.get_ident():
+            with self._write_lock:  # таймер фиксирует записи этого потока: читаем после фиксации, чтобы их увидеть
+                pass
+        outer = getattr(self._local, "snapshot_seq", None) is not None
+        if not outer:
+            self._local.snapshot_seq = self._commit_seq
+        try:
+            with self.store.reader() as view:
+                yield view
+        finally:
+            if not outer:
+                self._local.snapshot_seq = None
+
+    def _cache_lookup(self, path: str):
+        """Ищет файл в кэше; пока другой поток держит транзакцию, кэш может содержать незафиксированные данные и пропускается."""
+        if not self._write_lock.acquire(blocking=False):
+            return None
+        try:
+            return self.cache.get(path)
+        finally:
+            self._write_lock.release()
+
+    def _cache_fill(self, seq: int, path: str, content: str, owner: str, perms: int, type_: str, size: int):
+        """Кладет прочитанный файл в кэш, если с начала чтения никто не фиксировал изменения."""
+        if not self._write_lock.acquire(blocking=False):
+            return
+        try:
+            if seq == self._commit_seq:
+                self.cache.put(path, content, owner, perms, type_, size)
+        finally:
+            self._write_lock.release()
+
+    @contextmanager
+    def _op(self):
+        """Выполняет операцию TNFS как одну транзакцию (SAVEPOINT) вместе с её записями журнала."""
+        with self._write_lock:
+            if self._op_depth == 0 and not self.store.in_transaction:
+                self._begin_write()
+            savepoint = f"tnfs_op_{self._op_depth}"
+            self.store.savepoint(savepoint)
+            journal_mark = len(self._journal_buffer)
+            self._op_depth += 1
+            try:
+                yield
+            except BaseException:
+                self._op_depth -= 1
+                self.store.rollback_to(savepoint)
+                del self._journal_buffer[journal_mark:]
+                self.dentries.clear()
+                if self._op_depth == 0 and not self._pending_ops:
+                    self.store.rollback()
+                    self._end_write()
+                raise
+            self._op_depth -= 1
+            self.store.release(savepoint)
+            if self._op_depth == 0:
+                self._write_journal()
+                if not self._pending_ops:
+                    self._first_pending = time.monotonic()
+                self._pending_ops += 1
+                if (self.journal_mode == "sync" or self._pending_ops >= self.group_commit_size
+                        or time.monotonic() - self._first_pending >= self.group_commit_latency):
+                    self.flush()
+                else:
+                    if self._pending_ops == 1:
+                        self._arm_group_timer(self.group_commit_latency)
+                    self._write_lock.park()
+
+    def _arm_group_timer(self, delay: float):
+        self._group_timer = threading.Timer(delay, self._flush_idle)
+        self._group_timer.daemon = True
+        self._group_timer.start()
+
+    def _flush_idle(self):
+        """Таймер group_commit_latency: фиксирует отложенную группу, если писатель простаивает между операциями.
+        Занятый писатель обычно фиксирует ее сам в конце операции, а если операция упала, таймер проверит снова."""
+        owner = self._write_lock.take_idle()
+        if owner is None:
+            if self._pending_ops:
+                self._arm_group_timer(self.group_commit_latency / 4)
+            return
+        self._writer_owner = threading.get_ident()
+        self._flushing_for = owner
+        try:
+            self.flush()
+        except Exception as exc:
+            self.logger.error(f"Group commit timer failed: {exc}")
+        finally:
+            self._flushing_for = None
+
+    def begin(self):
+        """Начинает явную транзакцию: все следующие операции до commit/rollback фиксируются вместе."""
+        if self.transaction_active:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", "Transaction already active")
+        with self._write_lock:
+            # отложенные операции группового режима фиксируются отдельно: откат транзакции не затронет завершенные команды
+            self.flush()
+            self._begin_write()
+        self.cache.begin()
+        # операции внутри транзакции идут точками сохранения tnfs_op_<глубина> и не фиксируются по отдельности
+        self._op_depth += 1
+        self.transaction_active = True
+        self.logger.info("TNFS transaction started")
+
+    def commit(self):
+        """Фиксирует явную транзакцию одной записью журнала и одним commit."""
+        if not self.transaction_active:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", "No active transaction")
+        self._op_depth -= 1
+        self.transaction_active = False
+        self.cache.commit()
+        self.flush()
+        self.logger.info("TNFS transaction committed")
+
+    def rollback(self):
+        """Откатывает явную транзакцию вместе с журналом и кэшем."""
+        if not self.transaction_active:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", "No active transaction")
+        self._op_depth -= 1
+        self.transaction_active = False
+        self.store.rollback()
+        self._end_write()
+        self._journal_buffer.clear()
+        self._pending_ops = 0
+        self.cache.rollback()
+        self.dentries.clear()
+        self.logger.info("TNFS transaction rolled back")
+
+    @contextmanager
+    def transaction(self):
+        """with tnfs.transaction(): несколько операций в одной транзакции; при исключении все откатывается."""
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def flush(self):
+        """Фиксирует накопленные операции и журнал на диске (точка долговечности)."""
+        with self._write_lock:
+            if self._op_depth:
+                return
+            access_due = self._access_due()
+            if (self._deferred_journal or access_due) and not self.store.in_transaction:
+                self._begin_write()
+            self._write_journal()
+            if access_due:
+                self._write_access()
+            if self.store.in_transaction:
+                self.store.commit()
+                self._end_write()
+            if self._pending_ops > 1:
+                self.logger.info(f"Group commit: {self._pending_ops} operations")
+            self._pending_ops = 0
+            if self._group_timer is not None:
+                self._group_timer.cancel()
+                self._group_timer = None
+            if self.recovery is not None and self._mutations:
+                mutations, self._mutations = self._mutations, 0
+                self.recovery.on_commit(self, mutations)
+
+    def close(self):
+        """Фиксирует накопленные операции и закрывает хранилище (при остановке ядра)."""
+        self.flush()
+        self.store.close()
 
     def create_directory(self, path: str, owner: str = "root", perms: int = 0o755) -> bool:
         """Создает директорию."""
         self.logger.info(f"Creating directory: {path}")
-        if not self.selinux.check_access(path, "write", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied write on {path} for {self.current_user} ({self.current_role})")
         parent_dir = os.path.dirname(path) or "/"
-        with self.db:
-            cursor = self.db.execute("SELECT path FROM files WHERE path = ? AND type = 'directory'", (parent_dir,))
-            if not cursor.fetchone():
-                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Parent directory not found: {parent_dir}")
-            if not self._check_permissions(parent_dir, self.current_user, "write"):
+        with self._op():
+            entry = self._entry(path)
+            self._selinux_check(path, "write", entry)
+            parent = self._parent_entry(path)
+            if not self._check_permissions(parent_dir, self.current_user, "write", parent):
                 self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No write permission for {parent_dir}")
-            if self.db.execute("SELECT path FROM files WHERE path = ?", (path,)).fetchone():
+            if entry is not None:
                 self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path already exists: {path}")
             inode = self._create_inode()
             ctime = mtime = time.time()
-            self.db.execute(
-                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (path, inode, "", owner, perms, "directory", 0, ctime, mtime)
-            )
-            self._log_journal("create", path, f"Created directory: {path}")
+            self._insert_entry(path, inode, owner, perms, "directory", 0, ctime, mtime)
+            self._log_journal("create", path, f"Created directory: {path}", {"create": [[path, "directory", owner, perms, 0, ctime, mtime]]})
             self.logger.info(f"Directory created: {path}")
         return True
 
-    def remove(self, path: str) -> bool:
-        """Удаляет файл или директорию."""
+    def remove(self, path: str, recursive: bool = False) -> bool:
+        """Удаляет файл или директорию; recursive=True удаляет директорию вместе с содержимым."""
         self.logger.info(f"Removing path: {path}")
-        if not self.selinux.check_access(path, "delete", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied delete on {path} for {self.current_user} ({self.current_role})")
-        with self.db:
-            cursor = self.db.execute("SELECT type, inode, perms, owner FROM files WHERE path = ?", (path,))
-            result = cursor.fetchone()
-            if not result:
-                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Path not found: {path}")
-            type_, inode, perms, owner = result
-            if not self._check_permissions(path, self.current_user, "write"):
+        with self._op():
+            result = self._entry(path)
+            self._selinux_check(path, "delete", result)
+            inode, owner, perms, type_ = result[:4]
+            if not self._check_permissions(path, self.current_user, "write", result):
                 self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No write permission: {path}")
-            if type_ == "directory":
-                if self.db.execute("SELECT path FROM files WHERE path LIKE ? AND path != ?", (f"{path}/%", path)).fetchone():
-                    self.crash_handler.raise_crash("FS", "0xDNE0ERR", f"Directory not empty: {path}")
-            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
-            self.db.execute("UPDATE inodes SET ref_count = ref_count - 1 WHERE inode = ?", (inode,))
-            if path in self.cache:
-                del self.cache[path]
-            self._log_journal("delete", path, f"Deleted {type_}: {path}")
+            if type_ == "directory" and self._split(path)[0] is None:
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", "Cannot remove root directory")
+            if type_ == "directory" and not recursive and self._has_children(path):
+                self.crash_handler.raise_crash("FS", "0xDNE0ERR", f"Directory not empty: {path}")
+            removed = self._drop(path, result)
+            if removed:
+                self._log_journal("delete", path, f"Deleted {removed} entries under {path}")
+            self._log_journal("delete", path, f"Deleted {type_}: {path}", {"delete": [path]})
             self.logger.info(f"{type_.capitalize()} deleted: {path}")
         return True
 
+    def _drop(self, path: str, entry: Stat) -> int:
+        """Удаляет запись вместе с поддеревом директории. Возвращает число удаленных потомков."""
+        files, directories, size = self._usage_of(entry)
+        self._account(self._split(path)[0], -files, -directories, -size)
+        removed = self._remove_tree(entry.inode, path) if entry.type == "directory" and self._has_children(path) else 0
+        self._unlink(path)
+        self.store.drop_inode(entry.inode)
+        self.dentries.invalidate_inode(entry.inode)
+        self.cache.invalidate(path)
+        return removed
+
+    def _remove_tree(self, inode: int, path: str) -> int:
+        """Удаляет потомков директории пакетами по COPY_BATCH_SIZE в текущей транзакции. Возвращает число записей."""
+        removed = 0
+        batch = []
+        walker = self._walk(inode, path, self.store, "post", COPY_BATCH_SIZE)
+        while True:
+            item = next(walker, None)
+            if item is not None:
+                entry_path, entry = item
+                if not self._perm_allows(entry_path, entry.owner, entry.perms, self.current_user, "write"):
+                    self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No write permission: {entry_path}")
+                batch.append(entry.inode)
+                if len(batch) < COPY_BATCH_SIZE:
+                    continue
+            # walk в обратном порядке отдает директорию после содержимого, записи до курсора удалять безопасно
+            self.store.drop_inodes(batch)
+            for dropped in batch:
+                self.dentries.invalidate_inode(dropped)
+            removed += len(batch)
+            batch = []
+            if item is None:
+                break
+        self.dentries.invalidate_tree(path)
+        self.cache.invalidate_tree(path)
+        return removed
+
     def rename_directory(self, old_path: str, new_path: str) -> bool:
         """Переименовывает директорию."""
         self.logger.info(f"Renaming directory: {old_path} to {new_path}")
-        if not self.selinux.check_access(old_path, "write", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied write on {old_path} for {self.current_user} ({self.current_role})")
-        if not self.selinux.check_access(new_path, "write", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied write on {new_path} for {self.current_user} ({self.current_role})")
-        with self.db:
-            cursor = self.db.execute("SELECT type, perms, owner FROM files WHERE path = ?", (old_path,))
-            result = cursor.fetchone()
+        with self._op():
+            result = self._entry(old_path)
+            target = self._entry(new_path)
+            self._selinux_check(old_path, "write", result)
+            self._selinux_check(new_path, "write", target)
             if not result:
                 self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Directory not found: {old_path}")
-            type_, perms, owner = result
+            owner, perms, type_ = result[1:4]
             if type_ != "directory":
                 self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a directory: {old_path}")
-            if not self._check_permissions(old_path, self.current_user, "write"):
+            if self._split(old_path)[0] is None or (new_path.rstrip("/") + "/").startswith(old_path.rstrip("/") + "/"):
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Cannot move directory into itself: {old_path} to {new_path}")
+            if not self._check_permissions(old_path, self.current_user, "write", result):
                 self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No write permission: {old_path}")
-            parent_dir = os.path.dirname(new_path) or "/"
-            if not self.db.execute("SELECT path FROM files WHERE path = ? AND type = 'directory'", (parent_dir,)).fetchone():
-                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Parent directory not found: {parent_dir}")
-            if self.db.execute("SELECT path FROM files WHERE path = ?", (new_path,)).fetchone():
+            self._parent_entry(new_path)
+            if target is not None:
                 self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path already exists: {new_path}")
-            self.db.execute("UPDATE files SET path = ? WHERE path = ?", (new_path, old_path))
-            if old_path in self.cache:
-                self.cache[new_path] = self.cache.pop(old_path)
-            self._log_journal("rename", old_path, f"Renamed directory {old_path} to {new_path}")
+            self._move_entry(old_path, new_path)
+            self.cache.invalidate_tree(old_path)
+            self.cache.invalidate_tree(new_path)
+            self._log_journal("rename", old_path, f"Renamed directory {old_path} to {new_path}", {"rename": [[old_path, new_path]]})
             self.logger.info(f"Directory renamed: {old_path} to {new_path}")
         return True
 
-    def copy_directory(self, src_path: str, dst_path: str) -> bool:
-        """Копирует директорию и ее содержимое."""
+    def copy_directory(self, src_path: str, dst_path: str, progress: Optional[Callable[[int, int], None]] = None,
+                       cancel: Optional[threading.Event] = None) -> bool:
+        """Копирует директорию и ее содержимое одной транзакцией; при отмене через cancel изменения откатываются и возвращается False."""
         self.logger.info(f"Copying directory: {src_path} to {dst_path}")
-        if not self.selinux.check_access(src_path, "read", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied read on {src_path} for {self.current_user} ({self.current_role})")
-        if not self.selinux.check_access(dst_path, "write", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied write on {dst_path} for {self.current_user} ({self.current_role})")
-        with self.db:
-            cursor = self.db.execute("SELECT type, perms, owner FROM files WHERE path = ?", (src_path,))
-            result = cursor.fetchone()
-            if not result:
-                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Directory not found: {src_path}")
-            type_, perms, owner = result
-            if type_ != "directory":
-                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a directory: {src_path}")
-            if not self._check_permissions(src_path, self.current_user, "read"):
-                self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No read permission: {src_path}")
-            parent_dir = os.path.dirname(dst_path) or "/"
-            if not self.db.execute("SELECT path FROM files WHERE path = ? AND type = 'directory'", (parent_dir,)).fetchone():
-                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Parent directory not found: {parent_dir}")
-            if self.db.execute("SELECT path FROM files WHERE path = ?", (dst_path,)).fetchone():
-                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path already exists: {dst_path}")
-            inode = self._create_inode()
-            ctime = mtime = time.time()
-            self.db.execute(
-                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (dst_path, inode, "", owner, perms, "directory", 0, ctime, mtime)
-            )
-            cursor = self.db.execute("SELECT path, inode, content, owner, perms, type, size, ctime, mtime FROM files WHERE path LIKE ? AND path != ?", (f"{src_path}/%", src_path))
-            for row in cursor.fetchall():
-                old_subpath = row[0]
-                new_subpath = dst_path + old_subpath[len(src_path):]
-                new_inode = self._create_inode()
-                self.db.execute(
-                    "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (new_subpath, new_inode, row[2], row[3], row[4], row[5], row[6], row[7], row[8])
-                )
-            self._log_journal("copy", src_path, f"Copied directory {src_path} to {dst_path}")
-            self.logger.info(f"Directory copied: {src_path} to {dst_path}")
+        try:
+            with self._op():
+                result = self._entry(src_path)
+                target = self._entry(dst_path)
+                self._selinux_check(src_path, "read", result)
+                self._selinux_check(dst_path, "write", target)
+                if not result:
+                    self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Directory not found: {src_path}")
+                src_inode, owner, perms, type_ = result[:4]
+                if type_ != "directory":
+                    self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a directory: {src_path}")
+                if not self._check_permissions(src_path, self.current_user, "read", result):
+                    self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No read permission: {src_path}")
+                if (dst_path.rstrip("/") + "/").startswith(src_path.rstrip("/") + "/"):
+                    self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Cannot copy directory into itself: {src_path} to {dst_path}")
+                self._parent_entry(dst_path)
+                if target is not None:
+                    self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path already exists: {dst_path}")
+                ctime = time.time()
+                copied = self._copy_entry(result, dst_path, ctime, progress, cancel)
+                self._log_journal("copy", src_path, f"Copied directory {src_path} to {dst_path} ({copied} entries)",
+                                  {"copy": [[src_path, dst_path, ctime]]})
+        except OperationCancelled:
+            self.logger.warning(f"Directory copy cancelled: {src_path} to {dst_path}")
+            return False
+        self.logger.info(f"Directory copied: {src_path} to {dst_path} ({copied} entries)")
         return True
 
+    def _copy_entry(self, source: Stat, dst_path: str, ctime: float, progress: Optional[Callable[[int, int], None]] = None,
+                    cancel: Optional[threading.Event] = None) -> int:
+        """Копирует файл или директорию с поддеревом в dst_path; копия получает время ctime. Возвращает число скопированных потомков."""
+        self._parent_entry(dst_path)
+        inode = self._create_inode()
+        if source.type == "directory":
+            self._insert_entry(dst_path, inode, source.owner, source.perms, "directory", 0, ctime, ctime)
+            owners = set()
+            copied = self._bulk_copy(source.inode, inode, progress, cancel, owners)
+            # счетчики копии совпадают со счетчиками источника; квоты источника не копируются
+            self.store.copy_usage([(inode, source.inode)])
+            files, directories, size = self.store.usage(inode)
+            self._account(self._split(dst_path)[0], files, directories, size, owners)
+            self.cache.invalidate_tree(dst_path)
+            return copied
+        # копия ссылается на те же blobs и наследует запись индекса источника и его место в очереди переиндексации
+        self.store.copy_files([(source.inode, inode)])
+        self._insert_entry(dst_path, inode, source.owner, source.perms, "file", source.size, ctime, ctime)
+        self.cache.invalidate(dst_path)
+        return 0
+
+    def _bulk_copy(self, src_inode: int, dst_inode: int, progress: Optional[Callable[[int, int], None]] = None,
+                   cancel: Optional[threading.Event] = None, owners: Optional[set] = None) -> int:
+        """Копирует потомков src_inode под dst_inode пакетами в текущей транзакции; в owners собираются
+        владельцы скопированных записей. Возвращает число записей."""
+        total = self.store.subtree_size(src_inode)
+        # новые иноды запоминаются только для директорий: они нужны как родители следующих записей
+        copies = {"": dst_inode}
+        next_inode = self.store.allocate_inodes()
+        done = 0
+        inodes, entries, files, dirs = [], [], [], []
+        walker = self._walk(src_inode, "", self.store, "pre", COPY_BATCH_SIZE)
+        while True:
+            item = next(walker, None)
+            if item is not None:
+                rel, entry = item
+                parent_rel, name = rel.rsplit("/", 1)
+                inodes.append((next_inode, entry.owner, entry.perms, entry.type, entry.size, entry.ctime, entry.mtime))
+                entries.append((copies[parent_rel], name, next_inode))
+                if entry.type == "directory":
+                    copies[rel] = next_inode
+                    dirs.append((next_inode, entry.inode))
+                else:
+                    files.append((entry.inode, next_inode))
+                if owners is not None:
+                    owners.add(entry.owner)
+                next_inode += 1
+            if len(inodes) < COPY_BATCH_SIZE and item is not None:
+                continue
+            if cancel is not None and cancel.is_set():
+                raise OperationCancelled(f"Copy cancelled after {done} of {total} entries")
+            # walk идет в глубину, поэтому родитель каждой записи пакета уже записан
+            self.store.insert_entries(inodes, entries)
+            self.store.copy_usage(dirs)
+            if files:
+                self.store.copy_files(files)
+            done += len(inodes)
+            if progress is not None and inodes:
+                progress(done, total)
+            inodes, entries, files, dirs = [], [], [], []
+            if item is None:
+                break
+        return done
+
     def move_directory(self, src_path: str, dst_path: str) -> bool:
         """Перемещает директорию."""
-        if self.rename_directory(src_path, dst_path):
+        with self._op():
+            if not self.rename_directory(src_path, dst_path):
+                return False
             self._log_journal("move", src_path, f"Moved directory {src_path} to {dst_path}")
-            self.logger.info(f"Directory moved: {src_path} to {dst_path}")
-            return True
-        return False
+        self.logger.info(f"Directory moved: {src_path} to {dst_path}")
+        return True
 
     def list_directory(self, path: str) -> List[str]:
         """Возвращает список содержимого директории."""
         self.logger.info(f"Listing directory: {path}")
-        if not self.selinux.check_access(path, "read", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied read on {path} for {self.current_user} ({self.current_role})")
-        with self.db:
-            cursor = self.db.execute("SELECT type FROM files WHERE path = ?", (path,))
-            result = cursor.fetchone()
-            if not result:
-                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Directory not found: {path}")
-            if result[0] != "directory":
+        with self.reader() as view:
+            result = self._entry(path, view)
+            self._selinux_check(path, "read", result)
+            if result.type != "directory":
                 self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a directory: {path}")
-            if not self._check_permissions(path, self.current_user, "read"):
+            if not self._check_permissions(path, self.current_user, "read", result):
                 self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No read permission: {path}")
-            # Убедимся, что путь заканчивается на / для корректного LIKE
-            normalized_path = path.rstrip("/") + "/"
-            cursor = self.db.execute(
-                "SELECT path FROM files WHERE path LIKE ? AND path != ? AND path NOT LIKE ?",
-                (f"{normalized_path}%", path, f"{normalized_path}%/%")
-            )
-            files = [os.path.basename(row[0]) for row in cursor.fetchall()]
-            self._log_journal("list", path, f"Listed directory: {path}")
-            self.logger.info(f"Directory listed: {path}")
-            return files
+            files = view.names(result.inode)
+        self._log_read("list", path, f"Listed directory: {path}")
+        self.logger.info(f"Directory listed: {path}")
+        return files
+
+    def _path_of(self, inode: int, view: StorageBackend, known: Dict[int, str]) -> Optional[str]:
+        """Восстанавливает путь инода, поднимаясь по dentries к корню; known - уже найденные пути директорий."""
+        names = []
+        while inode not in known:
+            row = view.parent_of(inode)
+            if row is None:
+                return None
+            if row[0] == ROOT_PARENT:
+                known[inode] = "/"
+                break
+            names.append((inode, row[1]))
+            inode = row[0]
+        path = known[inode]
+        for child, name in reversed(names):
+            path = path.rstrip("/") + "/" + name
+            known[child] = path
+        return path
+
+    def grep(self, pattern: str, path: str = "/") -> List[Tuple[str, int, str]]:
+        """Ищет строку pattern в файлах поддерева path через полнотекстовый индекс. Возвращает (путь, номер строки, строка)."""
+        self.logger.info(f"Searching {path} for: {pattern}")
+        if not pattern:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", "Empty search pattern")
+        self._refresh_index()
+        prefix = path.rstrip("/") + "/"
+        matches = []
+        with self.reader() as view:
+            root = self._entry(path, view)
+            self._selinux_check(path, "read", root)
+            known = {}
+            for inode in view.search(pattern):
+                file_path = self._path_of(inode, view, known)
+                if file_path is None or not (file_path == path or file_path.startswith(prefix)):
+                    continue
+                entry = self._entry(file_path, view)
+                if entry is None or not self._perm_allows(file_path, entry.owner, entry.perms, self.current_user, "read"):
+                    continue
+                text = view.indexed_text(inode, pattern)
+                if text is None:
+                    continue
+                matches.extend((file_path, number, line) for number, line in enumerate(text.splitlines(), 1) if pattern in line)
+        matches.sort()
+        self._log_read("grep", path, f"Searched {path} for {pattern!r}: {len(matches)} matches")
+        return matches
+
+    def find(self, path: str, name: str = "*") -> List[str]:
+        """Возвращает пути поддерева path, имя которых подходит под шаблон name (* ? [..]); записи без права чтения пропускаются."""
+        self.logger.info(f"Finding in {path}: {name}")
+        found = sorted(
+            found_path for found_path, entry in self.walk(path)
+            if fnmatch.fnmatchcase(found_path.rsplit("/", 1)[1], name) and self._perm_allows(found_path, entry.owner, entry.perms, self.current_user, "read")
+        )
+        self._log_read("find", path, f"Found {len(found)} entries in {path} matching {name}")
+        return found
 
     def create_file(self, path: str, content: str, owner: str = "root", perms: int = 0o644) -> bool:
         """Создает файл."""
@@ -282,178 +1294,564 @@ class TNFS:
         self.logger.info(f"Current user: {self.current_user}, role: {self.current_role}, session_id: {self.user_manager.current_session_id}")
         if not path or not isinstance(path, str):
             self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid path: {path}")
-        try:
-            if not self.selinux.check_access(path, "write", self.current_user, self.current_role, self.user_manager.current_session_id):
-                self.logger.info(f"SELinux denied write access to {path}")
-                self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied write on {path} for {self.current_user} ({self.current_role})")
-        except TunderCrash as e:
-            self.logger.error(f"SELinux check failed: {str(e)}")
-            raise
         parent_dir = os.path.dirname(path) or "/"
-        self.logger.info(f"Checking parent directory: {parent_dir}")
-        with self.db:
-            cursor = self.db.execute("SELECT path FROM files WHERE path = ? AND type = 'directory'", (parent_dir,))
-            if not cursor.fetchone():
-                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Parent directory not found: {parent_dir}")
+        with self._op():
+            entry = self._entry(path)
+            try:
+                self._selinux_check(path, "write", entry)
+            except TunderCrash as e:
+                self.logger.error(f"SELinux check failed: {str(e)}")
+                raise
+            self.logger.info(f"Checking parent directory: {parent_dir}")
+            parent = self._parent_entry(path)
             self.logger.info(f"Parent directory {parent_dir} exists")
-            if not self._check_permissions(parent_dir, self.current_user, "write"):
+            if not self._check_permissions(parent_dir, self.current_user, "write", parent):
                 self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No write permission for {parent_dir}")
             self.logger.info(f"Write permission granted for {parent_dir}")
-            if self.db.execute("SELECT path FROM files WHERE path = ?", (path,)).fetchone():
+            if entry is not None:
                 self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path already exists: {path}")
             inode = self._create_inode()
             ctime = mtime = time.time()
-            size = len(content.encode())
-            self.db.execute(
-                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (path, inode, content, owner, perms, "file", size, ctime, mtime)
-            )
-            self.db.commit()
+            data = content.encode()
+            size = len(data)
+            blobs = self.store.store_content(inode, data)
+            self._insert_entry(path, inode, owner, perms, "file", size, ctime, mtime)
+            self._index_content(inode, content)
             self.logger.info(f"Inserted file into database: {path}, inode: {inode}, size: {size}")
-            cursor = self.db.execute("SELECT path FROM files WHERE path = ?", (path,))
-            if cursor.fetchone():
-                self.logger.info(f"Confirmed file exists in database: {path}")
-            else:
-                self.logger.error(f"Failed to confirm file creation: {path}")
-                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Failed to create file: {path}")
-            self._log_journal("create", path, f"Created file: {path}")
+            self._log_journal("create", path, f"Created file: {path}", {
+                "create": [[path, "file", owner, perms, size, ctime, mtime]],
+                "extents": [[path, idx, blob] for idx, blob in enumerate(blobs)],
+            })
             self.logger.info(f"File created: {path}")
         return True
 
     def read_file(self, path: str) -> Optional[str]:
-        """Читает содержимое файла."""
-        self.logger.info(f"Reading file: {path}")
-        if path in self.cache:
-            if not self._check_permissions(path, self.current_user, "read"):
+        """Читает содержимое файла. Чтение не пишет в лог: каждая строка лога - открытие файла под GIL, что сериализует
+        читателей; чтения учитывает журнал чтений (_log_read)."""
+        cached = self._cache_lookup(path)
+        if cached is not None:
+            if not self._perm_allows(path, cached.owner, cached.perms, self.current_user, "read"):
                 self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No read permission: {path}")
-            if not self.selinux.check_access(path, "read", self.current_user, self.current_role, self.user_manager.current_session_id):
+            if not self.selinux.check_access(path, "read", self.current_user, self.current_role, self.user_manager.current_session_id, stat=cached):
                 self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied read on {path} for {self.current_user} ({self.current_role})")
-            return self.cache[path]
-        with self.db:
-            cursor = self.db.execute("SELECT content, perms, owner, type FROM files WHERE path = ?", (path,))
-            result = cursor.fetchone()
+            self._log_read("read", path, f"Read file: {path}")
+            return cached.content
+        seq = self._commit_seq
+        with self.reader() as view:
+            result = self._entry(path, view)
             if not result:
                 self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"File not found: {path}")
-            content, perms, owner, type_ = result
+            inode, owner, perms, type_, size = result[:5]
             if type_ != "file":
                 self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a file: {path}")
-            if not self._check_permissions(path, self.current_user, "read"):
+            if not self._perm_allows(path, owner, perms, self.current_user, "read"):
                 self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No read permission: {path}")
-            if not self.selinux.check_access(path, "read", self.current_user, self.current_role, self.user_manager.current_session_id):
-                self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied read on {path} for {self.current_user} ({self.current_role})")
-            self.cache[path] = content
-            self._log_journal("read", path, f"Read file: {path}")
-            self.logger.info(f"File read: {path}")
-            return content
+            self._selinux_check(path, "read", result)
+            content = self._load_content(inode).decode(errors="replace")
+        self._cache_fill(seq, path, content, owner, perms, type_, size)
+        self._log_read("read", path, f"Read file: {path}")
+        return content
 
     def write_file(self, path: str, content: str) -> bool:
         """Пишет в файл."""
         self.logger.info(f"Writing to file: {path}")
-        if not self.selinux.check_access(path, "write", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied write on {path} for {self.current_user} ({self.current_role})")
-        with self.db:
-            cursor = self.db.execute("SELECT perms, owner, type FROM files WHERE path = ?", (path,))
-            result = cursor.fetchone()
+        with self._op():
+            result = self._entry(path)
+            self._selinux_check(path, "write", result)
             if not result:
                 self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"File not found: {path}")
-            perms, owner, type_ = result
+            inode, owner, perms, type_ = result[:4]
             if type_ != "file":
                 self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a file: {path}")
-            if not self._check_permissions(path, self.current_user, "write"):
+            if not self._check_permissions(path, self.current_user, "write", result):
                 self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No write permission: {path}")
             mtime = time.time()
-            size = len(content.encode())
-            self.db.execute("UPDATE files SET content = ?, size = ?, mtime = ? WHERE path = ?", (content, size, mtime, path))
-            self.cache[path] = content
-            self._log_journal("write", path, f"Wrote to file: {path}")
+            data = content.encode()
+            size = len(data)
+            # blobs неизменяемы: запись в разделяемый blob создает новый, а со старого снимается ссылка
+            blobs = self.store.store_content(inode, data)
+            self._index_content(inode, content)
+            self.store.set_stat(inode, size=size, mtime=mtime)
+            self._account(self._split(path)[0], size=size - (result.size or 0), owners=(owner,))
+            self.dentries.put_stat(result._replace(size=size, mtime=mtime))
+            self.cache.put(path, content, owner, perms, type_, size)
+            self._log_journal("write", path, f"Wrote to file: {path}", {
+                "extents": [[path, idx, blob] for idx, blob in enumerate(blobs)],
+                "set": [[path, {"size": size, "mtime": mtime}]],
+            })
             self.logger.info(f"File written: {path}")
         return True
 
+    def open(self, path: str, mode: str = "r") -> TNFSFile:
+        """Открывает файл и возвращает дескриптор для потокового чтения и записи."""
+        self.logger.info(f"Opening file: {path} (mode={mode})")
+        if mode.replace("b", "") not in ("r", "w", "a", "r+", "w+", "a+"):
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid open mode: {mode}")
+        reading = mode[0] == "r" or "+" in mode
+        writing = mode[0] in "wa" or "+" in mode
+        if mode[0] in "wa" and self.path_type(path) is None:
+            self.create_file(path, "", owner=self.current_user)
+        with self._op():
+            result = self._entry(path)
+            for operation in (["read"] if reading else []) + (["write"] if writing else []):
+                self._selinux_check(path, operation, result)
+            if not result:
+                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"File not found: {path}")
+            inode, owner, perms, type_, size = result[:5]
+            if type_ != "file":
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a file: {path}")
+            if reading and not self._perm_allows(path, owner, perms, self.current_user, "read"):
+                self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No read permission: {path}")
+            if writing and not self._perm_allows(path, owner, perms, self.current_user, "write"):
+                self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No write permission: {path}")
+            if mode[0] == "w" and size:
+                mtime = time.time()
+                self.store.release_content(inode)
+                self.store.set_stat(inode, size=0, mtime=mtime)
+                self._account(self._split(path)[0], size=-size)
+                self._index_content(inode, "")
+                self.dentries.invalidate_inode(inode)
+                self.cache.invalidate(path)
+                self._log_journal("write", path, f"Truncated file: {path}", {"set": [[path, {"size": 0, "mtime": mtime}]]})
+                size = 0
+        if reading:
+            self._log_read("read", path, f"Opened file for reading: {path}")
+        handle = TNFSFile(self, path, inode, size, mode, CHUNK_SIZE)
+        if mode[0] == "a":
+            handle.seek(0, 2)
+        return handle
+
+    def _handle_write(self, handle: TNFSFile, offset: int, data: bytes) -> int:
+        """Записывает данные открытого файла с указанного смещения. Возвращает новый размер."""
+        with self._op():
+            size = self.store.write_range(handle.inode, offset, data, handle.size)
+            mtime = time.time()
+            self.store.set_stat(handle.inode, size=size, mtime=mtime)
+            if size != handle.size:
+                path, entry = handle.path, self._entry(handle.path)
+                if entry is None or entry.inode != handle.inode:
+                    # файл переименован после открытия: путь восстанавливается по иноду
+                    path = self._path_of(handle.inode, self.store, {})
+                    entry = path and self._entry(path)
+                if entry:
+                    self._account(self._split(path)[0], size=size - handle.size, owners=(entry.owner,))
+            self.store.mark_stale([handle.inode])
+            self.dentries.invalidate_inode(handle.inode)
+            self.cache.invalidate(handle.path)
+            # в журнал попадают только переписанные блоки: запись за концом файла дополняет нулями и блоки от старого конца
+            first = min(offset, handle.size) // CHUNK_SIZE
+            last = (offset + len(data) - 1) // CHUNK_SIZE
+            changed = self.store.extents(handle.inode, first, last)
+            self._log_journal("write", handle.path, f"Wrote {len(data)} bytes at offset {offset}: {handle.path}", {
+                "extents": [[handle.path, idx, blob] for idx, blob in changed],
+                "set": [[handle.path, {"size": size, "mtime": mtime}]],
+            })
+        return size
+
     def rename_file(self, old_path: str, new_path: str) -> bool:
         """Переименовывает файл."""
         self.logger.info(f"Renaming file: {old_path} to {new_path}")
-        if not self.selinux.check_access(old_path, "write", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied write on {old_path} for {self.current_user} ({self.current_role})")
-        if not self.selinux.check_access(new_path, "write", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied write on {new_path} for {self.current_user} ({self.current_role})")
-        with self.db:
-            cursor = self.db.execute("SELECT type, perms, owner FROM files WHERE path = ?", (old_path,))
-            result = cursor.fetchone()
+        with self._op():
+            result = self._entry(old_path)
+            target = self._entry(new_path)
+            self._selinux_check(old_path, "write", result)
+            self._selinux_check(new_path, "write", target)
             if not result:
                 self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"File not found: {old_path}")
-            type_, perms, owner = result
+            owner, perms, type_ = result[1:4]
             if type_ != "file":
                 self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a file: {old_path}")
-            if not self._check_permissions(old_path, self.current_user, "write"):
+            if not self._check_permissions(old_path, self.current_user, "write", result):
                 self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No write permission: {old_path}")
-            parent_dir = os.path.dirname(new_path) or "/"
-            if not self.db.execute("SELECT path FROM files WHERE path = ? AND type = 'directory'", (parent_dir,)).fetchone():
-                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Parent directory not found: {parent_dir}")
-            if self.db.execute("SELECT path FROM files WHERE path = ?", (new_path,)).fetchone():
+            self._parent_entry(new_path)
+            if target is not None:
                 self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path already exists: {new_path}")
-            self.db.execute("UPDATE files SET path = ? WHERE path = ?", (new_path, old_path))
-            if old_path in self.cache:
-                self.cache[new_path] = self.cache.pop(old_path)
-            self._log_journal("rename", old_path, f"Renamed file {old_path} to {new_path}")
+            self._move_entry(old_path, new_path)
+            self.cache.invalidate(old_path)
+            self.cache.invalidate(new_path)
+            self._log_journal("rename", old_path, f"Renamed file {old_path} to {new_path}", {"rename": [[old_path, new_path]]})
             self.logger.info(f"File renamed: {old_path} to {new_path}")
         return True
 
     def copy_file(self, src_path: str, dst_path: str) -> bool:
         """Копирует файл."""
         self.logger.info(f"Copying file: {src_path} to {dst_path}")
-        if not self.selinux.check_access(src_path, "read", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied read on {src_path} for {self.current_user} ({self.current_role})")
-        if not self.selinux.check_access(dst_path, "write", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied write on {dst_path} for {self.current_user} ({self.current_role})")
-        with self.db:
-            cursor = self.db.execute("SELECT content, owner, perms, type FROM files WHERE path = ?", (src_path,))
-            result = cursor.fetchone()
+        with self._op():
+            result = self._entry(src_path)
+            target = self._entry(dst_path)
+            self._selinux_check(src_path, "read", result)
+            self._selinux_check(dst_path, "write", target)
             if not result:
                 self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"File not found: {src_path}")
-            content, owner, perms, type_ = result
+            src_inode, owner, perms, type_, size = result[:5]
             if type_ != "file":
                 self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a file: {src_path}")
-            if not self._check_permissions(src_path, self.current_user, "read"):
+            if not self._check_permissions(src_path, self.current_user, "read", result):
                 self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No read permission: {src_path}")
-            parent_dir = os.path.dirname(dst_path) or "/"
-            if not self.db.execute("SELECT path FROM files WHERE path = ? AND type = 'directory'", (parent_dir,)).fetchone():
-                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Parent directory not found: {parent_dir}")
-            if self.db.execute("SELECT path FROM files WHERE path = ?", (dst_path,)).fetchone():
+            self._parent_entry(dst_path)
+            if target is not None:
                 self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path already exists: {dst_path}")
-            inode = self._create_inode()
-            ctime = mtime = time.time()
-            size = len(content.encode())
-            self.db.execute(
-                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (dst_path, inode, content, owner, perms, "file", size, ctime, mtime)
-            )
-            self.cache[dst_path] = content
-            self._log_journal("copy", src_path, f"Copied file {src_path} to {dst_path}")
+            ctime = time.time()
+            self._copy_entry(result, dst_path, ctime)
+            self._log_journal("copy", src_path, f"Copied file {src_path} to {dst_path}", {"copy": [[src_path, dst_path, ctime]]})
             self.logger.info(f"File copied: {src_path} to {dst_path}")
         return True
 
     def move_file(self, src_path: str, dst_path: str) -> bool:
         """Перемещает файл."""
-        if self.rename_file(src_path, dst_path):
+        with self._op():
+            if not self.rename_file(src_path, dst_path):
+                return False
             self._log_journal("move", src_path, f"Moved file {src_path} to {dst_path}")
-            self.logger.info(f"File moved: {src_path} to {dst_path}")
-            return True
-        return False
+        self.logger.info(f"File moved: {src_path} to {dst_path}")
+        return True
 
     def chmod(self, path: str, perms: int) -> bool:
         """Изменяет права доступа."""
         self.logger.info(f"Changing permissions: {path} to {oct(perms)}")
-        if not self.selinux.check_access(path, "write", self.current_user, self.current_role, self.user_manager.current_session_id):
-            self.crash_handler.raise_crash("FS", "0xSAD0ERR", f"SELinux: Denied write on {path} for {self.current_user} ({self.current_role})")
-        with self.db:
-            cursor = self.db.execute("SELECT owner, type FROM files WHERE path = ?", (path,))
-            result = cursor.fetchone()
+        with self._op():
+            result = self._entry(path)
+            self._selinux_check(path, "write", result)
             if not result:
                 self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Path not found: {path}")
-            owner, type_ = result
+            inode, owner = result[:2]
             if self.current_user != owner and self.current_user != "root":
                 self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No permission to change perms: {path}")
-            self.db.execute("UPDATE files SET perms = ? WHERE path = ?", (perms, path))
-            self._log_journal("chmod", path, f"Changed permissions to {oct(perms)}: {path}")
+            self.store.set_stat(inode, perms=perms)
+            self.dentries.put_stat(result._replace(perms=perms))
+            self.cache.update_meta(path, perms=perms)
+            self._log_journal("chmod", path, f"Changed permissions to {oct(perms)}: {path}", {"set": [[path, {"perms": perms}]]})
             self.logger.info(f"Permissions changed: {path} to {oct(perms)}")
-        return True
\ No newline at end of file
+        return True
+
+    def _host_owner(self, uid: int) -> str:
+        """Владелец импортируемой записи: root сохраняет владельца с хоста, остальные пользователи получают записи себе."""
+        if self.current_user != "root" or pwd is None:
+            return self.current_user
+        try:
+            return pwd.getpwuid(uid).pw_name
+        except KeyError:
+            return self.current_user
+
+    @staticmethod
+    def _host_ctime(st: os.stat_result) -> float:
+        return getattr(st, "st_birthtime", st.st_ctime)
+
+    def import_tree(self, host_dir: str, tnfs_path: str, progress: Optional[Callable[[int, Optional[int]], None]] = None,
+                    cancel: Optional[threading.Event] = None) -> int:
+        """Импортирует дерево каталогов хоста в новую директорию tnfs_path пакетами по IMPORT_BATCH_SIZE записей. Возвращает число записей."""
+        self.logger.info(f"Importing host directory: {host_dir} to {tnfs_path}")
+        if not os.path.isdir(host_dir):
+            self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Host directory not found: {host_dir}")
+        # писатель занят до конца импорта: номера инодов выделяются подряд и не пересекаются с чужими операциями
+        with self._write_lock:
+            with self._op():
+                target = self._entry(tnfs_path)
+                self._selinux_check(tnfs_path, "write", target)
+                parent = self._parent_entry(tnfs_path)
+                if not self._check_permissions(os.path.dirname(tnfs_path) or "/", self.current_user, "write", parent):
+                    self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No write permission for {os.path.dirname(tnfs_path) or '/'}")
+                if target is not None:
+                    self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path already exists: {tnfs_path}")
+                st = os.stat(host_dir)
+                root = self._create_inode()
+                root_path = "/" + "/".join(self._components(tnfs_path))
+                row = [root_path, "directory", self._host_owner(st.st_uid), st.st_mode & 0o777, 0, self._host_ctime(st), st.st_mtime]
+                self._insert_entry(root_path, root, row[2], row[3], "directory", 0, row[5], row[6])
+                self._log_journal("create", tnfs_path, f"Created directory: {tnfs_path}", {"create": [row]})
+            next_inode = self.store.allocate_inodes()
+            inodes, entries, blobs, extents, resized, indexed, stale, dirs = [], [], [], [], [], [], [], []
+            redo = {"create": [], "extents": [], "set": []}  # то же содержимое пакета по путям, для журнала
+            owners = {}
+            buffered = imported = 0
+            # счетчики места пакета: директория импорта -> [файлы, директории, байты]; parents ведет к корню импорта
+            usage: Dict[int, List[int]] = {}
+            parents = {root: None}
+
+            def charge(node: Optional[int], files: int, directories: int, size: int):
+                while node is not None:
+                    counters = usage.setdefault(node, [0, 0, 0])
+                    counters[0] += files
+                    counters[1] += directories
+                    counters[2] += size
+                    node = parents[node]
+
+            def flush():
+                nonlocal buffered
+                if not (inodes or extents or resized or indexed or stale):
+                    return
+                with self._op():
+                    self.store.insert_entries(inodes, entries)
+                    self.store.create_usage(dirs)
+                    self.store.account_many([(*counters, node) for node, counters in usage.items()])
+                    self._account(self._split(root_path)[0], *usage.get(root, (0, 0, 0)), owners.values())
+                    self.store.put_blobs(blobs)
+                    self.store.insert_extents(extents)
+                    self.store.set_sizes(resized)
+                    self.store.index_many(indexed)
+                    self.store.mark_stale(stale)
+                    self._log_journal("import", tnfs_path, f"Imported {len(entries)} entries from {host_dir}",
+                                      {key: rows for key, rows in redo.items() if rows})
+                for rows in (inodes, entries, blobs, extents, resized, indexed, stale, dirs, usage, *redo.values()):
+                    rows.clear()
+                buffered = 0
+                if progress is not None:
+                    progress(imported, None)
+
+            pending = [(host_dir, root, root_path)]
+            while pending:
+                host_path, parent_inode, parent_path = pending.pop()
+                with os.scandir(host_path) as it:
+                    for entry in it:
+                        if cancel is not None and cancel.is_set():
+                            flush()
+                            self.logger.warning(f"Import cancelled after {imported} entries: {host_dir} to {tnfs_path}")
+                            return imported
+                        if entry.is_dir(follow_symlinks=False):
+                            type_, source = "directory", None
+                        elif entry.is_file(follow_symlinks=False):
+                            try:
+                                type_, source = "file", open(entry.path, "rb")
+                            except OSError as e:
+                                self.logger.warning(f"Skipping unreadable host file {entry.path}: {e}")
+                                continue
+                        else:
+                            self.logger.warning(f"Skipping special host file: {entry.path}")
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                        if st.st_uid not in owners:
+                            owners[st.st_uid] = self._host_owner(st.st_uid)
+                        inode = next_inode
+                        next_inode += 1
+                        path = f"{parent_path.rstrip('/')}/{entry.name}"
+                        # запись инода идет в пакет раньше содержимого: сброс посреди большого файла не оставляет ничейных блоков
+                        row = (inode, owners[st.st_uid], st.st_mode & 0o777, type_, st.st_size if source else 0, self._host_ctime(st), st.st_mtime)
+                        inodes.append(row)
+                        entries.append((parent_inode, entry.name, inode))
+                        redo["create"].append([path, type_, *row[1:3], *row[4:]])
+                        imported += 1
+                        charge(parent_inode, type_ == "file", type_ == "directory", row[4])
+                        if source is None:
+                            parents[inode] = parent_inode
+                            dirs.append(inode)
+                            pending.append((entry.path, inode, path))
+                        else:
+                            with source:
+                                size = 0
+                                first = b""
+                                for idx, chunk in enumerate(iter(lambda: source.read(CHUNK_SIZE), b"")):
+                                    first = chunk if idx == 0 else first
+                                    blob = blob_hash(chunk)
+                                    blobs.append((blob, chunk))
+                                    extents.append((inode, idx, blob))
+                                    redo["extents"].append([path, idx, blob])
+                                    size += len(chunk)
+                                    buffered += len(chunk)
+                                    if buffered >= IMPORT_BUFFER_BYTES:
+                                        flush()
+                            if size != st.st_size:
+                                charge(parent_inode, 0, 0, size - st.st_size)
+                                resized.append((size, inode))
+                                redo["set"].append([path, {"size": size}])
+                            # файл из одного блока индексируется сразу, большие - при первом поиске
+                            if size <= CHUNK_SIZE:
+                                indexed.append((inode, first.decode(errors="replace")))
+                            else:
+                                stale.append(inode)
+                        if len(entries) >= IMPORT_BATCH_SIZE:
+                            flush()
+            flush()
+        self.logger.info(f"Host directory imported: {host_dir} to {tnfs_path} ({imported} entries)")
+        return imported
+
+    def _exportable(self, tnfs_path: str, root: Stat, view: StorageBackend):
+        """Записи поддерева для выгрузки: (относительный путь, Stat). Записи без права чтения пропускаются вместе с поддеревом,
+        как в find и grep; запрет SELinux прерывает выгрузку, как read_file."""
+        base = tnfs_path.rstrip("/")
+        skipped = None  # префикс пропущенной директории; walk отдает её потомков сразу за ней
+        for rel, entry in self._walk(root.inode, "", view):
+            rel = rel[1:]
+            if skipped is not None and rel.startswith(skipped):
+                continue
+            path = f"{base}/{rel}"
+            if not self._perm_allows(path, entry.owner, entry.perms, self.current_user, "read"):
+                self.logger.info(f"Export skips {path}: no read permission")
+                skipped = rel + "/" if entry.type == "directory" else None
+                continue
+            self._selinux_check(path, "read", entry)
+            yield rel, entry
+
+    def export_tree(self, tnfs_path: str, target: str, progress: Optional[Callable[[int, Optional[int]], None]] = None) -> int:
+        """Выгружает директорию tnfs_path в новую директорию хоста или в архив .tar/.tar.gz, читая файлы блоками. Возвращает число записей.
+        Записи без права чтения не выгружаются; при ошибке частично записанная выгрузка удаляется."""
+        self.logger.info(f"Exporting directory: {tnfs_path} to {target}")
+        archive = target.endswith((".tar", ".tar.gz", ".tgz"))
+        if os.path.exists(target):
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Host path already exists: {target}")
+        with self.reader() as view:
+            root = self._entry(tnfs_path, view)
+            self._selinux_check(tnfs_path, "read", root)
+            if root.type != "directory":
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Path is not a directory: {tnfs_path}")
+            if not self._check_permissions(tnfs_path, self.current_user, "read", root):
+                self.crash_handler.raise_crash("FS", "0xPDN0ERR", f"No read permission: {tnfs_path}")
+            # walk отдает родителя раньше потомков и держит в памяти только текущие страницы директорий
+            rows = ((rel, *entry) for rel, entry in self._exportable(tnfs_path, root, view))
+            try:
+                exported = self._export_rows(tnfs_path, root, rows, target, archive, progress)
+            except BaseException:
+                if os.path.isdir(target):
+                    shutil.rmtree(target, ignore_errors=True)
+                elif os.path.exists(target):
+                    os.remove(target)
+                raise
+        if progress is not None:
+            progress(exported, exported)
+        self._log_journal("export", tnfs_path, f"Exported {exported} entries to {target}")
+        self.logger.info(f"Directory exported: {tnfs_path} to {target} ({exported} entries)")
+        return exported
+
+    def _export_rows(self, tnfs_path: str, root: Stat, rows, target: str, archive: bool, progress) -> int:
+        """Пишет записи rows в архив или директорию хоста target. Возвращает число записей."""
+        exported = 0
+        if archive:
+            with tarfile.open(target, "w:gz" if target.endswith("gz") else "w", format=tarfile.PAX_FORMAT, copybufsize=CHUNK_SIZE) as tar:
+                for rel, inode, owner, perms, type_, size, ctime, mtime in rows:
+                    info = tarfile.TarInfo(rel)
+                    info.type = tarfile.DIRTYPE if type_ == "directory" else tarfile.REGTYPE
+                    info.mode, info.uname, info.mtime = perms, owner, mtime
+                    info.pax_headers = {"ctime": repr(ctime)}
+                    if type_ == "file":
+                        info.size = size
+                        tar.addfile(info, TNFSFile(self, f"{tnfs_path.rstrip('/')}/{rel}", inode, size, "rb", CHUNK_SIZE))
+                    else:
+                        tar.addfile(info)
+                    exported += 1
+                    if progress is not None and exported % COPY_BATCH_SIZE == 0:
+                        progress(exported, None)
+        else:
+            os.makedirs(target)
+            # права и время директорий ставятся в конце: запись в них меняет mtime, а 0o555 запретила бы запись
+            directories = [(target, root.perms, root.mtime)]
+            for rel, inode, owner, perms, type_, size, ctime, mtime in rows:
+                dest = os.path.join(target, *rel.split("/"))
+                if type_ == "directory":
+                    os.mkdir(dest)
+                    directories.append((dest, perms, mtime))
+                else:
+                    with open(dest, "xb") as out:
+                        for chunk in TNFSFile(self, f"{tnfs_path.rstrip('/')}/{rel}", inode, size, "rb", CHUNK_SIZE):
+                            out.write(chunk)
+                    os.chmod(dest, perms)
+                    os.utime(dest, (mtime, mtime))
+                exported += 1
+                if progress is not None and exported % COPY_BATCH_SIZE == 0:
+                    progress(exported, None)
+            for dest, perms, mtime in reversed(directories):
+                os.chmod(dest, perms)
+                os.utime(dest, (mtime, mtime))
+        return exported
+
+    def _snapshot_path(self, name: str) -> Path:
+        if not SNAPSHOT_NAME.fullmatch(name):
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid snapshot name: {name}")
+        return self.snapshot_dir / (name + SNAPSHOT_SUFFIX)
+
+    def snapshot_create(self, name: str, wait: bool = False) -> SnapshotJob:
+        """Запускает создание снимка образа в фоновом потоке; wait=True ждет его завершения."""
+        self._require_root("create snapshots")
+        self._require_feature("snapshots", "snapshots")
+        target = self._snapshot_path(name)
+        with self._snapshot_lock:
+            job = self._snapshots.get(name)
+            if target.exists() or (job is not None and job.is_alive()):
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Snapshot already exists: {name}")
+            if self.transaction_active:
+                self.logger.warning(f"Snapshot {name} does not include the uncommitted transaction")
+            with self._op():
+                self._log_journal("snapshot", name, f"Created snapshot {name}")
+            self.flush()
+            self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+            job = SnapshotJob(self.db_path, target, self.readers.busy_timeout, self.logger)
+            self._snapshots[name] = job
+            job.start()
+        self.logger.info(f"Snapshot started: {name}")
+        if wait:
+            job.join()
+            if job.error is not None:
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Snapshot {name} failed: {job.error}")
+        return job
+
+    def snapshot_list(self) -> List[Dict]:
+        """Возвращает снимки по времени создания: готовые с размером, создаваемые с прогрессом, неудачные с ошибкой."""
+        snapshots = {}
+        if self.snapshot_dir.is_dir():
+            for file in self.snapshot_dir.glob("*" + SNAPSHOT_SUFFIX):
+                st = file.stat()
+                snapshots[file.stem] = {"name": file.stem, "state": "ready", "created": st.st_mtime, "size": st.st_size}
+        with self._snapshot_lock:
+            for name, job in self._snapshots.items():
+                if job.is_alive():
+                    snapshots[name] = {"name": name, "state": "running", "created": job.started, "done": job.done, "total": job.total}
+                elif job.error is not None and name not in snapshots:
+                    snapshots[name] = {"name": name, "state": "failed", "created": job.started, "error": str(job.error)}
+        return sorted(snapshots.values(), key=lambda snapshot: snapshot["created"])
+
+    def snapshot_restore(self, name: str, progress: Optional[Callable[[int, int], None]] = None) -> bool:
+        """Заменяет образ содержимым снимка без перезапуска: читатели видят либо старый образ, либо восстановленный."""
+        self._require_root("restore snapshots")
+        self._require_feature("snapshots", "snapshots")
+        source_path = self._snapshot_path(name)
+        if not source_path.exists():
+            self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Snapshot not found: {name}")
+        if self.transaction_active:
+            self.crash_handler.raise_crash("FS", "0xV0E0ERR", "Cannot restore a snapshot inside a transaction")
+        self.logger.info(f"Restoring snapshot: {name}")
+        snapshot = sqlite3.connect(f"{source_path.as_uri()}?mode=ro", uri=True)
+        try:
+            tables = {row[0] for row in snapshot.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if "inodes" not in tables and "files" not in tables:
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Snapshot is not a TNFS image: {name}")
+            if snapshot.execute("PRAGMA user_version").fetchone()[0] > SCHEMA_VERSION:
+                self.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Snapshot was made by a newer TNFS: {name}")
+            with self._write_lock:
+                self.flush()
+                # backup пишет в образ одной транзакцией писателя: до фиксации читатели из пула видят старый образ
+                snapshot.backup(self.db, pages=SNAPSHOT_STEP_PAGES, sleep=0,
+                                progress=None if progress is None else lambda status, remaining, total: progress(total - remaining, total))
+                self._commit_seq += 1
+                self._init_schema()  # мигрирует снимки старых версий и сбрасывает кэши
+                with self._op():
+                    self._log_journal("snapshot_restore", name, f"Restored snapshot {name}")
+                if self.recovery is not None:
+                    # журнал образа заменен журналом снимка: старые контрольные точки ему больше не предшествуют
+                    self.recovery.reset(self)
+        finally:
+            snapshot.close()
+        self.logger.info(f"Snapshot restored: {name}")
+        return True
+
+    def snapshot_delete(self, name: str) -> bool:
+        """Удаляет снимок; создаваемый снимок сначала отменяется."""
+        self._require_root("delete snapshots")
+        target = self._snapshot_path(name)
+        with self._snapshot_lock:
+            job = self._snapshots.pop(name, None)
+        if job is not None and job.is_alive():
+            job.cancel()
+            job.join()
+        elif not target.exists():
+            self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Snapshot not found: {name}")
+        target.unlink(missing_ok=True)
+        with self._op():
+            self._log_journal("snapshot_delete", name, f"Deleted snapshot {name}")
+        self.logger.info(f"Snapshot deleted: {name}")
+        return True
+
+    def snapshot_wait(self):
+        """Ждет завершения всех создаваемых снимков (при остановке ядра)."""
+        with self._snapshot_lock:
+            jobs = [job for job in self._snapshots.values() if job.is_alive()]
+        for job in jobs:
+            self.logger.info(f"Waiting for snapshot: {job.target.stem}")
+            job.join()
@@ -0,0 +1,1720 @@
+#TNFS storage backends
+#created by SKATT
+import bisect
+import hashlib
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import os
+import sys
+INIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(INIT_DIR)
+from TNFS.cache import Stat
+from TNFS.compress import encode, decode
+from TNFS.pool import ReaderPool, READER_POOL_SIZE, BUSY_TIMEOUT
+
+BACKENDS = ("sqlite", "memory", "log")  # хранилища, которые TNFS создает по имени
+SCHEMA_VERSION = 7
+ROOT_PARENT = 0  # parent корневой записи в dentries
+CHUNK_SIZE = 64 * 1024  # размер блока содержимого файла
+STAT_FIELDS = ("owner", "perms", "type", "size", "ctime", "mtime")  # поля инода, которые меняет set_stat
+INDEX_PRUNE_MIN = 1000  # мертвых записей индекса, после которых он может перестраиваться
+CONTENT_INDEX_SQL = "CREATE VIRTUAL TABLE IF NOT EXISTS content_index USING fts5(content, tokenize = 'trigram', detail = 'none', content = '')"
+
+def blob_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def index_key(blobs: List[str]) -> Optional[str]:
+    """Ключ записи полнотекстового индекса по хэшам блоков файла: у файла из одного блока это хэш blob, у большего - хэш
+    списка хэшей, у пустого файла записи нет. Файлы с одинаковым содержимым, в том числе копии, делят одну запись."""
+    if len(blobs) <= 1:
+        return blobs[0] if blobs else None
+    return blob_hash(",".join(blobs).encode())
+
+def components(path: str) -> List[str]:
+    return [part for part in path.split("/") if part]
+
+def split_path(path: str):
+    """Делит путь на (родительский путь, имя); для корня возвращает (None, "/")."""
+    parts = components(path)
+    if not parts:
+        return None, "/"
+    return "/" + "/".join(parts[:-1]), parts[-1]
+
+def parent_of(path: str) -> Optional[str]:
+    """Возвращает родительскую директорию пути (None для корня)."""
+    if path == "/":
+        return None
+    return os.path.dirname(path) or "/"
+
+class StorageBackend:
+    """Хранилище образа TNFS под проверками прав и SELinux: иноды, записи директорий, блоки содержимого,
+    полнотекстовый индекс, счетчики места, журнал и счетчики обращений.
+
+    TNFS работает с путями, кэшами и политиками, а хранилище - только с инодами. Методы чтения есть и у самого
+    хранилища (видит изменения открытой транзакции), и у представления из reader(). Изменения идут внутри begin()
+    и откатываются до точки сохранения или целиком. Блоки адресуются SHA-256 содержимого, на blob ведется счетчик ссылок."""
+
+    name = "abstract"
+    FEATURES: Tuple[str, ...] = ()  # возможности сверх общего контракта: snapshots, compress
+    retain_blobs = False  # blobs без ссылок остаются до контрольной точки TunRecovery
+    compression = "off"  # политика сжатия новых блоков, если хранилище умеет сжимать
+
+    # --- схема и транзакции
+
+    def init_schema(self, logger):
+        """Создает структуры хранилища и мигрирует старые образы."""
+        raise NotImplementedError
+
+    def has_quotas(self) -> bool:
+        """Заданы ли квоты хоть одному владельцу или директории."""
+        raise NotImplementedError
+
+    @contextmanager
+    def reader(self):
+        """Представление для чтения из другого потока; видит только зафиксированные изменения, если хранилище это умеет."""
+        raise NotImplementedError
+
+    @property
+    def in_transaction(self) -> bool:
+        raise NotImplementedError
+
+    def begin(self):
+        raise NotImplementedError
+
+    def savepoint(self, name: str):
+        raise NotImplementedError
+
+    def rollback_to(self, name: str):
+        """Откатывает изменения после точки сохранения name и снимает её."""
+        raise NotImplementedError
+
+    def release(self, name: str):
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+    def rollback(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    # --- дерево и иноды
+
+    def root(self) -> Optional[int]:
+        raise NotImplementedError
+
+    def lookup(self, parent: int, name: str) -> Optional[int]:
+        raise NotImplementedError
+
+    def get_stat(self, inode: int) -> Optional[Stat]:
+        raise NotImplementedError
+
+    def lookup_stat(self, parent: int, name: str) -> Optional[Stat]:
+        """Stat записи name директории parent одним обращением."""
+        raise NotImplementedError
+
+    def names(self, parent: int) -> List[str]:
+        """Имена записей директории по порядку."""
+        raise NotImplementedError
+
+    def children(self, parent: int, after: str, limit: int) -> List[Tuple[str, Stat]]:
+        """Страница записей директории: до limit записей с именами больше after, по порядку имен."""
+        raise NotImplementedError
+
+    def count_children(self, parent: int) -> int:
+        raise NotImplementedError
+
+    def has_children(self, parent: int) -> bool:
+        raise NotImplementedError
+
+    def parent_of(self, inode: int) -> Optional[Tuple[int, str]]:
+        """(инод родителя, имя) записи инода или None."""
+        raise NotImplementedError
+
+    def subtree_size(self, inode: int) -> int:
+        """Число потомков директории."""
+        raise NotImplementedError
+
+    def create_inode(self) -> int:
+        raise NotImplementedError
+
+    def allocate_inodes(self) -> int:
+        """Первый свободный номер инода для insert_entries; вызывается внутри транзакции."""
+        raise NotImplementedError
+
+    def link(self, parent: int, name: str, inode: int, owner: str, perms: int, type_: str, size: int, ctime: float, mtime: float):
+        """Записывает метаданные инода и добавляет запись name в директорию parent."""
+        raise NotImplementedError
+
+    def insert_entries(self, inodes: List[tuple], entries: List[tuple]):
+        """Пакетная вставка: inodes - (inode, owner, perms, type, size, ctime, mtime), entries - (parent, name, inode)."""
+        raise NotImplementedError
+
+    def unlink(self, parent: int, name: str):
+        raise NotImplementedError
+
+    def move(self, old_parent: int, old_name: str, new_parent: int, new_name: str):
+        """Переносит одну запись директории: потомки идут за ней без изменений."""
+        raise NotImplementedError
+
+    def set_stat(self, inode: int, **fields):
+        """Меняет поля инода из STAT_FIELDS."""
+        raise NotImplementedError
+
+    def set_sizes(self, rows: List[Tuple[int, int]]):
+        """Пакетно задает размеры: rows - (size, inode)."""
+        raise NotImplementedError
+
+    def drop_inode(self, inode: int):
+        """Удаляет инод вместе с блоками, записью индекса и счетчиками; запись директории снимает unlink."""
+        raise NotImplementedError
+
+    def drop_inodes(self, inodes: List[int]):
+        """Пакетно удаляет иноды вместе с их записями директорий."""
+        raise NotImplementedError
+
+    # --- содержимое
+
+    def blob_put(self, data: bytes) -> str:
+        """Сохраняет блок (или добавляет ссылку на существующий) и возвращает хэш."""
+        raise NotImplementedError
+
+    def blob_ref(self, blob: str) -> bool:
+        """Добавляет ссылку на уже сохраненный blob; False, если его нет."""
+        raise NotImplementedError
+
+    def blob_release(self, blob: Optional[str]):
+        """Снимает ссылку с blob и удаляет его, когда ссылок не осталось (если не задан retain_blobs)."""
+        raise NotImplementedError
+
+    def put_blobs(self, chunks: List[Tuple[str, bytes]]):
+        """Пакетно сохраняет блоки (хэш, байты), по ссылке на каждый."""
+        raise NotImplementedError
+
+    def purge_blobs(self, hashes: List[str]) -> int:
+        """Удаляет из hashes blobs без ссылок. Возвращает число удаленных."""
+        raise NotImplementedError
+
+    def extents(self, inode: int, first: int = 0, last: Optional[int] = None) -> List[Tuple[int, str]]:
+        """(номер блока, хэш) блоков файла с номерами от first до last по порядку."""
+        raise NotImplementedError
+
+    def extent_data(self, inode: int, first: int, last: int) -> List[Tuple[int, str, bytes]]:
+        """(номер блока, хэш, байты) блоков файла с номерами от first до last."""
+        raise NotImplementedError
+
+    def chunks(self, inode: int, first: int = 0, last: Optional[int] = None) -> bytes:
+        """Содержимое блоков файла с номерами от first до last одной строкой байтов."""
+        raise NotImplementedError
+
+    def put_extent(self, inode: int, idx: int, blob: str):
+        """Ставит blob блоком idx файла; ссылки на blobs не меняет."""
+        raise NotImplementedError
+
+    def delete_extent(self, inode: int, idx: int):
+        raise NotImplementedError
+
+    def insert_extents(self, rows: List[Tuple[int, int, str]]):
+        """Пакетно добавляет блоки (inode, idx, blob); ссылки на blobs не меняет."""
+        raise NotImplementedError
+
+    def release_content(self, inode: int):
+        """Снимает ссылки со всех блоков файла и удаляет их."""
+        raise NotImplementedError
+
+    def copy_files(self, pairs: List[Tuple[int, int]]):
+        """Копирует блоки, ссылку на запись индекса и место в очереди переиндексации файлов (старый инод, новый инод)."""
+        raise NotImplementedError
+
+    def check_file(self, inode: int) -> Tuple[int, Optional[int], int, int]:
+        """(число блоков, последний номер, размер содержимого, блоков без blob) для fsck."""
+        raise NotImplementedError
+
+    def check_image(self) -> List[str]:
+        """Проверки всего образа: записи без инодов, недостижимые иноды, счетчики ссылок blobs."""
+        raise NotImplementedError
+
+    def set_extent(self, inode: int, idx: int, data: bytes, old_blob: Optional[str]) -> str:
+        """Записывает блок idx файла; неизменившийся блок не трогает. Возвращает хэш блока."""
+        blob = blob_hash(data)
+        if blob == old_blob:
+            return blob
+        self.blob_put(data)
+        self.put_extent(inode, idx, blob)
+        self.blob_release(old_blob)
+        return blob
+
+    def store_content(self, inode: int, data: bytes) -> List[str]:
+        """Заменяет содержимое файла, переписывая только изменившиеся блоки. Возвращает хэши блоков по порядку."""
+        existing = dict(self.extents(inode))
+        count = (len(data) + CHUNK_SIZE - 1) // CHUNK_SIZE
+        blobs = [self.set_extent(inode, idx, data[idx * CHUNK_SIZE:(idx + 1) * CHUNK_SIZE], existing.get(idx)) for idx in range(count)]
+        self.truncate_extents(inode, count)
+        return blobs
+
+    def truncate_extents(self, inode: int, count: int):
+        """Удаляет блоки файла с номерами от count и снимает ссылки с их blobs."""
+        for idx, blob in self.extents(inode, count):
+            self.delete_extent(inode, idx)
+            self.blob_release(blob)
+
+    def write_range(self, inode: int, offset: int, data: bytes, size: int) -> int:
+        """Пишет байты с указанного смещения, переписывая только затронутые блоки. Возвращает новый размер."""
+        if offset > size:
+            data = b"\0" * (offset - size) + data
+            offset = size
+        end = offset + len(data)
+        if not data:
+            return size
+        first, last = offset // CHUNK_SIZE, (end - 1) // CHUNK_SIZE
+        existing = {idx: (blob, old) for idx, blob, old in self.extent_data(inode, first, last)}
+        for idx in range(first, last + 1):
+            base = idx * CHUNK_SIZE
+            old_blob, old = existing.get(idx, (None, b""))
+            lo = max(offset, base) - base
+            hi = min(end, base + CHUNK_SIZE) - base
+            piece = data[base + lo - offset:base + hi - offset]
+            self.set_extent(inode, idx, old[:lo] + piece + old[hi:], old_blob)
+        return max(size, end)
+
+    # --- полнотекстовый индекс
+
+    def index(self, inode: int, text: Optional[str] = None):
+        """Связывает файл с записью индекса по его текущим блокам (index_key) и снимает его с очереди переиндексации.
+        text нужен только для новой записи; без него текст собирается из блоков."""
+        raise NotImplementedError
+
+    def index_many(self, rows: List[Tuple[int, Optional[str]]]):
+        for inode, text in rows:
+            self.index(inode, text)
+
+    def unindex(self, inode: int):
+        raise NotImplementedError
+
+    def mark_stale(self, inodes: Iterable[int]):
+        """Ставит файлы в очередь переиндексации."""
+        raise NotImplementedError
+
+    def has_stale(self) -> bool:
+        raise NotImplementedError
+
+    def stale(self) -> List[int]:
+        """Иноды существующих файлов из очереди переиндексации."""
+        raise NotImplementedError
+
+    def clear_stale(self):
+        raise NotImplementedError
+
+    def index_garbage(self) -> bool:
+        """True, когда мертвые записи индекса (без файлов) пора убрать через prune_index."""
+        return False
+
+    def prune_index(self) -> int:
+        """Убирает мертвые записи индекса. Возвращает их число."""
+        return 0
+
+    def search(self, pattern: str) -> List[int]:
+        """Иноды-кандидаты, чья запись индекса может содержать pattern."""
+        raise NotImplementedError
+
+    def indexed_text(self, inode: int, pattern: str) -> Optional[str]:
+        """Текст проиндексированного файла, если он содержит pattern."""
+        raise NotImplementedError
+
+    # --- счетчики места и квоты
+
+    def usage(self, inode: int) -> Tuple[int, int, int]:
+        """(файлы, директории, байты) всех потомков директории."""
+        raise NotImplementedError
+
+    def account(self, inodes: List[int], files: int, directories: int, size: int):
+        """Добавляет изменение к счетчикам директорий inodes."""
+        raise NotImplementedError
+
+    def account_many(self, rows: List[Tuple[int, int, int, int]]):
+        """Пакетный account: rows - (файлы, директории, байты, инод)."""
+        raise NotImplementedError
+
+    def create_usage(self, inodes: List[int]):
+        """Заводит нулевые счетчики новых директорий."""
+        raise NotImplementedError
+
+    def copy_usage(self, pairs: List[Tuple[int, int]]):
+        """Задает счетчики директорий (новый инод, инод-источник) по источнику; квоты не копируются."""
+        raise NotImplementedError
+
+    def over_quota(self, inodes: List[int]) -> Optional[Tuple[int, int, int, Optional[int], Optional[int]]]:
+        """(инод, байты, записи, max_bytes, max_entries) первой директории из inodes сверх квоты."""
+        raise NotImplementedError
+
+    def owner_over_quota(self, owner: str) -> Optional[Tuple[int, int, Optional[int], Optional[int]]]:
+        """(байты, записи, max_bytes, max_entries) владельца, если он сверх квоты."""
+        raise NotImplementedError
+
+    def set_dir_quota(self, inode: int, max_bytes: Optional[int], max_entries: Optional[int]):
+        raise NotImplementedError
+
+    def set_owner_quota(self, owner: str, max_bytes: Optional[int], max_entries: Optional[int]):
+        raise NotImplementedError
+
+    def owner_usage(self) -> List[Tuple[str, int, int, int, Optional[int], Optional[int]]]:
+        """(владелец, файлы, директории, байты, max_bytes, max_entries) по всем владельцам."""
+        raise NotImplementedError
+
+    def dir_quotas(self) -> List[Tuple[int, int, int, int, Optional[int], Optional[int]]]:
+        """(инод, файлы, директории, байты, max_bytes, max_entries) директорий с квотами."""
+        raise NotImplementedError
+
+    def stored_bytes(self, inodes: List[int]) -> int:
+        """Сколько занимают хранимые (сжатые) блоки файлов inodes."""
+        raise NotImplementedError
+
+    def image_size(self) -> Tuple[int, int]:
+        """(размер образа, свободное в нем место) в байтах."""
+        raise NotImplementedError
+
+    def storage_stats(self) -> Dict:
+        """Число blobs, исходный и хранимый объем, число blobs по кодекам."""
+        raise NotImplementedError
+
+    # --- журнал и счетчики обращений
+
+    def append_journal(self, records: List[tuple]):
+        """Добавляет записи (operation, path, timestamp, details, user, payload)."""
+        raise NotImplementedError
+
+    def insert_journal(self, record: tuple):
+        """Добавляет запись журнала с заданным номером (id, operation, path, timestamp, details, user, payload)."""
+        raise NotImplementedError
+
+    def journal(self, after: int = 0, limit: Optional[int] = None) -> List[tuple]:
+        """Записи журнала с номерами больше after по порядку."""
+        raise NotImplementedError
+
+    def write_access(self, rows: List[tuple]):
+        """Прибавляет счетчики обращений (path, operation, count, last_access, user)."""
+        raise NotImplementedError
+
+    def access(self, operation: str) -> List[Tuple[str, int, float]]:
+        """(путь, число обращений, последнее обращение) операции по убыванию числа обращений."""
+        raise NotImplementedError
+
+
+class SQLiteView(StorageBackend):
+    """Чтение образа SQLite через одно соединение: писателя или читателя из пула (снимок WAL)."""
+
+    name = "sqlite"
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def root(self) -> Optional[int]:
+        row = self.conn.execute("SELECT inode FROM dentries WHERE parent = ? AND name = '/'", (ROOT_PARENT,)).fetchone()
+        return row and row[0]
+
+    def lookup(self, parent: int, name: str) -> Optional[int]:
+        row = self.conn.execute("SELECT inode FROM dentries WHERE parent = ? AND name = ?", (parent, name)).fetchone()
+        return row and row[0]
+
+    def get_stat(self, inode: int) -> Optional[Stat]:
+        row = self.conn.execute("SELECT inode, owner, perms, type, size, ctime, mtime FROM inodes WHERE inode = ?", (inode,)).fetchone()
+        return row and Stat(*row)
+
+    def lookup_stat(self, parent: int, name: str) -> Optional[Stat]:
+        row = self.conn.execute(
+            "SELECT i.inode, i.owner, i.perms, i.type, i.size, i.ctime, i.mtime "
+            "FROM dentries d JOIN inodes i ON i.inode = d.inode WHERE d.parent = ? AND d.name = ?",
+            (parent, name)
+        ).fetchone()
+        return row and Stat(*row)
+
+    def names(self, parent: int) -> List[str]:
+        return [row[0] for row in self.conn.execute("SELECT name FROM dentries WHERE parent = ? ORDER BY name", (parent,))]
+
+    def children(self, parent: int, after: str, limit: int) -> List[Tuple[str, Stat]]:
+        # страницы по первичному ключу dentries (name > последнего прочитанного)
+        return [(name, Stat(*meta)) for name, *meta in self.conn.execute(
+            "SELECT d.name, i.inode, i.owner, i.perms, i.type, i.size, i.ctime, i.mtime "
+            "FROM dentries d JOIN inodes i ON i.inode = d.inode WHERE d.parent = ? AND d.name > ? ORDER BY d.name LIMIT ?",
+            (parent, after, limit)
+        )]
+
+    def count_children(self, parent: int) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM dentries WHERE parent = ?", (parent,)).fetchone()[0]
+
+    def has_children(self, parent: int) -> bool:
+        return self.conn.execute("SELECT 1 FROM dentries WHERE parent = ? LIMIT 1", (parent,)).fetchone() is not None
+
+    def parent_of(self, inode: int) -> Optional[Tuple[int, str]]:
+        return self.conn.execute("SELECT parent, name FROM dentries WHERE inode = ?", (inode,)).fetchone()
+
+    def subtree_size(self, inode: int) -> int:
+        return self.conn.execute("""
+            WITH RECURSIVE sub(inode) AS (
+                SELECT inode FROM dentries WHERE parent = ?
+                UNION ALL
+                SELECT d.inode FROM dentries d JOIN sub ON d.parent = sub.inode
+            )
+            SELECT COUNT(*) FROM sub
+        """, (inode,)).fetchone()[0]
+
+    def extents(self, inode: int, first: int = 0, last: Optional[int] = None) -> List[Tuple[int, str]]:
+        if last is None:
+            return self.conn.execute("SELECT idx, blob FROM extents WHERE inode = ? AND idx >= ? ORDER BY idx", (inode, first)).fetchall()
+        return self.conn.execute(
+            "SELECT idx, blob FROM extents WHERE inode = ? AND idx BETWEEN ? AND ? ORDER BY idx", (inode, first, last)
+        ).fetchall()
+
+    def extent_data(self, inode: int, first: int, last: int) -> List[Tuple[int, str, bytes]]:
+        return [(idx, blob, decode(codec, stored)) for idx, blob, codec, stored in self.conn.execute(
+            "SELECT e.idx, e.blob, b.codec, b.content FROM extents e JOIN blobs b ON b.hash = e.blob WHERE e.inode = ? AND e.idx BETWEEN ? AND ?",
+            (inode, first, last)
+        )]
+
+    def chunks(self, inode: int, first: int = 0, last: Optional[int] = None) -> bytes:
+        if last is None:
+            cursor = self.conn.execute(
+                "SELECT b.codec, b.content FROM extents e JOIN blobs b ON b.hash = e.blob WHERE e.inode = ? ORDER BY e.idx", (inode,)
+            )
+        else:
+            cursor = self.conn.execute(
+                "SELECT b.codec, b.content FROM extents e JOIN blobs b ON b.hash = e.blob WHERE e.inode = ? AND e.idx BETWEEN ? AND ? ORDER BY e.idx",
+                (inode, first, last)
+            )
+        return b"".join(decode(codec, stored) for codec, stored in cursor)
+
+    def check_file(self, inode: int) -> Tuple[int, Optional[int], int, int]:
+        return self.conn.execute(
+            "SELECT COUNT(*), MAX(e.idx), COALESCE(SUM(b.size), 0), SUM(b.hash IS NULL) "
+            "FROM extents e LEFT JOIN blobs b ON b.hash = e.blob WHERE e.inode = ?", (inode,)
+        ).fetchone()
+
+    def check_image(self) -> List[str]:
+        problems = []
+        for parent, name in self.conn.execute(
+            "SELECT d.parent, d.name FROM dentries d LEFT JOIN inodes i ON i.inode = d.inode WHERE i.inode IS NULL"
+        ):
+            problems.append(f"dentry {name!r} in directory inode {parent} points to a missing inode")
+        for (inode,) in self.conn.execute("SELECT inode FROM inodes WHERE inode NOT IN (SELECT inode FROM dentries)"):
+            problems.append(f"inode {inode} is not linked into the tree")
+        for blob, refs, used in self.conn.execute("""
+            SELECT b.hash, b.ref_count, COALESCE(e.n, 0) FROM blobs b
+            LEFT JOIN (SELECT blob, COUNT(*) AS n FROM extents GROUP BY blob) e ON e.blob = b.hash
+            WHERE b.ref_count != COALESCE(e.n, 0)
+        """):
+            problems.append(f"blob {blob[:12]} has ref_count {refs} but {used} extents")
+        return problems
+
+    def has_stale(self) -> bool:
+        return self.conn.execute("SELECT 1 FROM content_stale LIMIT 1").fetchone() is not None
+
+    def index_garbage(self) -> bool:
+        dead = self.conn.execute("SELECT COUNT(*) FROM content_docs WHERE ref_count <= 0").fetchone()[0]
+        return dead >= INDEX_PRUNE_MIN and dead * 2 >= self.conn.execute("SELECT COUNT(*) FROM content_docs").fetchone()[0]
+
+    def search(self, pattern: str) -> List[int]:
+        if len(pattern) >= 3:
+            # триграммный индекс без позиций отдает записи, содержащие все триграммы строки; точное совпадение проверяет indexed_text.
+            # Мертвые записи отсекает соединение с content_files
+            trigrams = {pattern[i:i + 3] for i in range(len(pattern) - 2)}
+            query = " AND ".join('"' + t.replace('"', '""') + '"' for t in sorted(trigrams))
+            return [row[0] for row in self.conn.execute(
+                "SELECT f.inode FROM content_index c JOIN content_files f ON f.doc = c.rowid WHERE content_index MATCH ?", (query,)
+            )]
+        return [row[0] for row in self.conn.execute("SELECT inode FROM content_files")]
+
+    def indexed_text(self, inode: int, pattern: str) -> Optional[str]:
+        # индекс без содержимого: текст собирается из blobs
+        text = self.chunks(inode).decode(errors="replace")
+        return text if pattern in text else None
+
+    def usage(self, inode: int) -> Tuple[int, int, int]:
+        return self.conn.execute("SELECT files, directories, bytes FROM dir_usage WHERE inode = ?", (inode,)).fetchone()
+
+    def over_quota(self, inodes: List[int]):
+        return self.conn.execute(
+            f"SELECT inode, bytes, files + directories, max_bytes, max_entries FROM dir_usage "
+            f"WHERE inode IN ({','.join('?' * len(inodes))}) AND (bytes > max_bytes OR files + directories > max_entries) LIMIT 1",
+            inodes
+        ).fetchone()
+
+    def owner_over_quota(self, owner: str):
+        return self.conn.execute(
+            "SELECT bytes, files + directories, max_bytes, max_entries FROM owner_usage "
+            "WHERE owner = ? AND (bytes > max_bytes OR files + directories > max_entries)", (owner,)
+        ).fetchone()
+
+    def owner_usage(self):
+        return self.conn.execute("SELECT owner, files, directories, bytes, max_bytes, max_entries FROM owner_usage").fetchall()
+
+    def dir_quotas(self):
+        return self.conn.execute(
+            "SELECT inode, files, directories, bytes, max_bytes, max_entries FROM dir_usage "
+            "WHERE max_bytes IS NOT NULL OR max_entries IS NOT NULL"
+        ).fetchall()
+
+    def has_quotas(self) -> bool:
+        return bool(self.conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM owner_usage WHERE max_bytes IS NOT NULL OR max_entries IS NOT NULL) "
+            "OR EXISTS (SELECT 1 FROM dir_usage WHERE max_bytes IS NOT NULL OR max_entries IS NOT NULL)"
+        ).fetchone()[0])
+
+    def stored_bytes(self, inodes: List[int]) -> int:
+        return self.conn.execute(
+            f"SELECT COALESCE(SUM(length(b.content)), 0) FROM extents e JOIN blobs b ON b.hash = e.blob WHERE e.inode IN ({','.join('?' * len(inodes))})",
+            inodes
+        ).fetchone()[0]
+
+    def image_size(self) -> Tuple[int, int]:
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        pages = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return pages * page_size, free * page_size
+
+    def storage_stats(self) -> Dict:
+        stats = {"blobs": 0, "bytes": 0, "stored": 0, "codecs": {}}
+        for codec, count, size, stored in self.conn.execute(
+            "SELECT codec, COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(length(content)), 0) FROM blobs WHERE ref_count > 0 GROUP BY codec"
+        ):
+            stats["blobs"] += count
+            stats["bytes"] += size
+            stats["stored"] += stored
+            stats["codecs"][codec or "raw"] = count
+        return stats
+
+    def raw_blobs(self, after: str, min_size: int, limit: int) -> List[Tuple[str, bytes]]:
+        """Несжатые blobs от min_size байт с хэшем больше after (для compress)."""
+        return self.conn.execute(
+            "SELECT hash, content FROM blobs WHERE hash > ? AND codec IS NULL AND size >= ? ORDER BY hash LIMIT ?",
+            (after, min_size, limit)
+        ).fetchall()
+
+    def count_raw_blobs(self, min_size: int) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM blobs WHERE codec IS NULL AND size >= ?", (min_size,)).fetchone()[0]
+
+    def journal(self, after: int = 0, limit: Optional[int] = None) -> List[tuple]:
+        return self.conn.execute(
+            "SELECT id, operation, path, timestamp, details, user, payload FROM journal WHERE id > ? ORDER BY id LIMIT ?",
+            (after, -1 if limit is None else limit)
+        ).fetchall()
+
+    def access(self, operation: str) -> List[Tuple[str, int, float]]:
+        return self.conn.execute(
+            "SELECT path, count, last_access FROM access_stats WHERE operation = ? ORDER BY count DESC, path", (operation,)
+        ).fetchall()
+
+
+class SQLiteBackend(SQLiteView):
+    """Образ в файле SQLite (WAL): единственный писатель и пул читателей, которые видят зафиксированный снимок."""
+
+    FEATURES = ("snapshots", "compress")
+
+    def __init__(self, db_path: Path, compression: str = "auto", reader_pool_size: int = READER_POOL_SIZE, busy_timeout: float = BUSY_TIMEOUT):
+        self.db_path = Path(db_path)
+        self.compression = compression
+        self.db = sqlite3.connect(self.db_path, timeout=busy_timeout, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+        self.readers = ReaderPool(self.db_path, reader_pool_size, busy_timeout)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self.db
+
+    @contextmanager
+    def reader(self):
+        with self.readers.connection() as conn:
+            yield SQLiteView(conn)
+
+    def close(self):
+        self.readers.close()
+        self.db.close()
+
+    def init_schema(self, logger):
+        self.logger = logger
+        fresh = self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('files', 'inodes')").fetchone() is None
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS inodes (
+                inode INTEGER PRIMARY KEY AUTOINCREMENT,
+                ref_count INTEGER DEFAULT 1,
+                owner TEXT,
+                perms INTEGER,
+                type TEXT CHECK(type IN ('file', 'directory')),
+                size INTEGER,
+                ctime REAL,
+                mtime REAL
+            )
+        """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS dentries (
+                parent INTEGER,
+                name TEXT,
+                inode INTEGER,
+                PRIMARY KEY(parent, name),
+                FOREIGN KEY(inode) REFERENCES inodes(inode)
+            ) WITHOUT ROWID
+        """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                content BLOB,
+                size INTEGER,
+                ref_count INTEGER DEFAULT 1,
+                codec TEXT
+            )
+        """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS extents (
+                inode INTEGER,
+                idx INTEGER,
+                blob TEXT,
+                PRIMARY KEY(inode, idx),
+                FOREIGN KEY(blob) REFERENCES blobs(hash)
+            ) WITHOUT ROWID
+        """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS journal (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                operation TEXT,
+                path TEXT,
+                timestamp REAL,
+                details TEXT,
+                user TEXT,
+                payload TEXT
+            )
+        """)
+        # счетчики обращений для режима aggregated: строка на путь и операцию вместо строки журнала на каждое чтение
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS access_stats (
+                path TEXT,
+                operation TEXT,
+                count INTEGER,
+                last_access REAL,
+                last_user TEXT,
+                PRIMARY KEY (path, operation)
+            ) WITHOUT ROWID
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS access_stats_hot ON access_stats(operation, count)")
+        # счетчики места: по владельцам их ведут триггеры inodes, по директориям (все потомки, без самой директории) - операции TNFS
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS owner_usage (
+                owner TEXT PRIMARY KEY,
+                files INTEGER DEFAULT 0,
+                directories INTEGER DEFAULT 0,
+                bytes INTEGER DEFAULT 0,
+                max_bytes INTEGER,
+                max_entries INTEGER
+            )
+        """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS dir_usage (
+                inode INTEGER PRIMARY KEY,
+                files INTEGER DEFAULT 0,
+                directories INTEGER DEFAULT 0,
+                bytes INTEGER DEFAULT 0,
+                max_bytes INTEGER,
+                max_entries INTEGER
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS dir_usage_quota ON dir_usage(inode) WHERE max_bytes IS NOT NULL OR max_entries IS NOT NULL")
+        # полнотекстовый индекс содержимого: триграммы позволяют искать любые подстроки. Индекс без содержимого (content=''),
+        # rowid = запись content_docs; файлы с одинаковыми блоками (копии) делят запись, текст читается из blobs
+        self.db.execute(CONTENT_INDEX_SQL)
+        self.db.execute("CREATE TABLE IF NOT EXISTS content_docs (doc INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, ref_count INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS content_docs_dead ON content_docs(doc) WHERE ref_count <= 0")
+        self.db.execute("CREATE TABLE IF NOT EXISTS content_files (inode INTEGER PRIMARY KEY, doc INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS content_files_doc ON content_files(doc)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS content_stale (inode INTEGER PRIMARY KEY)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_dentries_inode ON dentries(inode)")
+        try:
+            self.db.execute("ALTER TABLE journal ADD COLUMN user TEXT")
+            self.logger.info("Added 'user' column to journal table")
+        except sqlite3.OperationalError:
+            pass
+        try:
+            self.db.execute("ALTER TABLE blobs ADD COLUMN codec TEXT")
+            self.logger.info("Added 'codec' column to blobs table")
+        except sqlite3.OperationalError:
+            pass
+        try:
+            self.db.execute("ALTER TABLE journal ADD COLUMN payload TEXT")
+            self.logger.info("Added 'payload' column to journal table")
+        except sqlite3.OperationalError:
+            pass
+        version = SCHEMA_VERSION if fresh else self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self._migrate_parent_index()
+        if version < 2:
+            self._migrate_blobs()
+        if version < 3:
+            self._migrate_extents()
+        if version < 4:
+            self._migrate_dentries()
+        if version < 5:
+            self._migrate_content_index()
+        if version < 6:
+            self._migrate_usage()
+        if 5 <= version < 7:
+            self._migrate_content_docs()
+        # триггеры создаются после миграций: в образах до v4 у inodes еще нет этих столбцов
+        self.db.execute("""
+            CREATE TRIGGER IF NOT EXISTS owner_usage_insert AFTER INSERT ON inodes WHEN new.type IS NOT NULL BEGIN
+                INSERT OR IGNORE INTO owner_usage (owner) VALUES (new.owner);
+                UPDATE owner_usage SET files = files + (new.type = 'file'), directories = directories + (new.type = 'directory'),
+                    bytes = bytes + COALESCE(new.size, 0) WHERE owner = new.owner;
+            END
+        """)
+        self.db.execute("""
+            CREATE TRIGGER IF NOT EXISTS owner_usage_update AFTER UPDATE OF owner, type, size ON inodes BEGIN
+                UPDATE owner_usage SET files = files - (old.type = 'file'), directories = directories - (old.type = 'directory'),
+                    bytes = bytes - COALESCE(old.size, 0) WHERE owner = old.owner AND old.type IS NOT NULL;
+                INSERT OR IGNORE INTO owner_usage (owner) SELECT new.owner WHERE new.type IS NOT NULL;
+                UPDATE owner_usage SET files = files + (new.type = 'file'), directories = directories + (new.type = 'directory'),
+                    bytes = bytes + COALESCE(new.size, 0) WHERE owner = new.owner AND new.type IS NOT NULL;
+            END
+        """)
+        self.db.execute("""
+            CREATE TRIGGER IF NOT EXISTS owner_usage_delete AFTER DELETE ON inodes WHEN old.type IS NOT NULL BEGIN
+                UPDATE owner_usage SET files = files - (old.type = 'file'), directories = directories - (old.type = 'directory'),
+                    bytes = bytes - COALESCE(old.size, 0) WHERE owner = old.owner;
+            END
+        """)
+        # files - представление для диагностики и SQL-запросов по полным путям; сама TNFS его не использует
+        self.db.execute("""
+            CREATE VIEW IF NOT EXISTS files AS
+            WITH RECURSIVE tree(path, inode, parent) AS (
+                SELECT '/', inode, NULL FROM dentries WHERE parent = 0
+                UNION ALL
+                SELECT CASE tree.path WHEN '/' THEN '/' || d.name ELSE tree.path || '/' || d.name END, d.inode, tree.path
+                FROM dentries d JOIN tree ON d.parent = tree.inode
+            )
+            SELECT tree.path, tree.inode, i.owner, i.perms, i.type, i.size, i.ctime, i.mtime, tree.parent
+            FROM tree JOIN inodes i ON i.inode = tree.inode
+        """)
+        self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.commit()
+
+    def _migrate_parent_index(self):
+        """Миграция v1: у каждой записи хранится родительская директория, по ней строится индекс."""
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(files)")]
+        if "parent" not in columns:
+            self.db.execute("ALTER TABLE files ADD COLUMN parent TEXT")
+        rows = self.db.execute("SELECT path FROM files WHERE parent IS NULL AND path != '/'").fetchall()
+        self.db.executemany("UPDATE files SET parent = ? WHERE path = ?", [(parent_of(path), path) for (path,) in rows])
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_files_parent ON files(parent, path)")
+        self.logger.info(f"Migrated TNFS image to parent-indexed entries ({len(rows)} rows)")
+
+    def _migrate_blobs(self):
+        """Миграция v2: содержимое файлов переносится в таблицу blobs с подсчетом ссылок."""
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(files)")]
+        if "blob" not in columns:
+            self.db.execute("ALTER TABLE files ADD COLUMN blob TEXT")
+        if "content" not in columns:
+            return
+        rows = self.db.execute("SELECT path, content FROM files WHERE type = 'file' AND blob IS NULL").fetchall()
+        for path, content in rows:
+            self.db.execute("UPDATE files SET blob = ?, content = NULL WHERE path = ?", (self.blob_put((content or "").encode()), path))
+        self.logger.info(f"Migrated TNFS image to content-addressed blobs ({len(rows)} files)")
+
+    def _migrate_extents(self):
+        """Миграция v3: blob файла разбивается на блоки по CHUNK_SIZE и записывается в extents."""
+        self.db.execute("UPDATE blobs SET content = CAST(content AS BLOB) WHERE typeof(content) = 'text'")
+        rows = self.db.execute(
+            "SELECT f.inode, f.blob, b.content FROM files f JOIN blobs b ON b.hash = f.blob WHERE f.type = 'file'"
+        ).fetchall()
+        for inode, blob, data in rows:
+            if 0 < len(data) <= CHUNK_SIZE:
+                # Ссылка файла на blob переходит к единственному блоку без изменения ref_count
+                self.db.execute("INSERT INTO extents (inode, idx, blob) VALUES (?, 0, ?)", (inode, blob))
+            else:
+                self.store_content(inode, data)
+                self.blob_release(blob)
+        self.db.execute("UPDATE files SET blob = NULL")
+        self.logger.info(f"Migrated TNFS image to chunked extents ({len(rows)} files)")
+
+    def _migrate_dentries(self):
+        """Миграция v4: дерево хранится как dentries (инод родителя + имя), метаданные переезжают в inodes."""
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(inodes)")]
+        for column, decl in (("owner", "TEXT"), ("perms", "INTEGER"), ("type", "TEXT"), ("size", "INTEGER"), ("ctime", "REAL"), ("mtime", "REAL")):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE inodes ADD COLUMN {column} {decl}")
+        rows = self.db.execute("SELECT path, inode, owner, perms, type, size, ctime, mtime FROM files ORDER BY length(path)").fetchall()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO inodes (inode, ref_count, owner, perms, type, size, ctime, mtime) VALUES (?, 1, ?, ?, ?, ?, ?, ?)",
+            [row[1:] for row in rows]
+        )
+        inodes = {}
+        for path, inode, *_ in rows:
+            path = "/" + "/".join(components(path))
+            parent_path, name = split_path(path)
+            parent = ROOT_PARENT if parent_path is None else self._migrate_ancestor(parent_path, inodes)
+            self.db.execute("INSERT OR IGNORE INTO dentries (parent, name, inode) VALUES (?, ?, ?)", (parent, name, inode))
+            inodes[path] = inode
+        self.db.execute("DROP TABLE files")
+        self.logger.info(f"Migrated TNFS image to inode-based directory entries ({len(rows)} entries)")
+
+    def _migrate_content_index(self):
+        """Миграция v5: все файлы ставятся в очередь индексации, индекс строится при первом поиске."""
+        cursor = self.db.execute("INSERT OR IGNORE INTO content_stale (inode) SELECT inode FROM inodes WHERE type = 'file'")
+        self.logger.info(f"Queued TNFS files for content indexing ({cursor.rowcount} files)")
+
+    def _migrate_content_docs(self):
+        """Миграция v7: индекс с собственной копией текста каждого файла заменяется индексом без содержимого; файлы
+        ставятся в очередь индексации, индекс строится при первом поиске."""
+        self.db.execute("DROP TABLE content_index")
+        self.db.execute(CONTENT_INDEX_SQL)
+        self.db.execute("DELETE FROM content_files")
+        self.db.execute("DELETE FROM content_docs")
+        cursor = self.db.execute("INSERT OR IGNORE INTO content_stale (inode) SELECT inode FROM inodes WHERE type = 'file'")
+        self.logger.info(f"Queued TNFS files for content indexing ({cursor.rowcount} files)")
+
+    def _migrate_usage(self):
+        """Миграция v6: счетчики места по владельцам и директориям считаются один раз, дальше их ведут операции."""
+        self.db.execute("DELETE FROM owner_usage")
+        self.db.execute("""
+            INSERT INTO owner_usage (owner, files, directories, bytes)
+            SELECT owner, SUM(type = 'file'), SUM(type = 'directory'), SUM(COALESCE(size, 0)) FROM inodes WHERE type IS NOT NULL GROUP BY owner
+        """)
+        self.db.execute("DELETE FROM dir_usage")
+        self.db.execute(f"""
+            WITH RECURSIVE up(dir, inode) AS (
+                SELECT parent, inode FROM dentries WHERE parent != {ROOT_PARENT}
+                UNION ALL
+                SELECT d.parent, up.inode FROM up JOIN dentries d ON d.inode = up.dir WHERE d.parent != {ROOT_PARENT}
+            )
+            INSERT INTO dir_usage (inode, files, directories, bytes)
+            SELECT up.dir, SUM(i.type = 'file'), SUM(i.type = 'directory'), SUM(COALESCE(i.size, 0)) FROM up JOIN inodes i ON i.inode = up.inode GROUP BY up.dir
+        """)
+        self.db.execute("INSERT OR IGNORE INTO dir_usage (inode) SELECT inode FROM inodes WHERE type = 'directory'")
+        count = self.db.execute("SELECT COUNT(*) FROM dir_usage").fetchone()[0]
+        self.logger.info(f"Computed TNFS usage counters ({count} directories)")
+
+    def _migrate_ancestor(self, path: str, inodes: Dict[str, int]) -> int:
+        """Возвращает инод директории-предка; потерянные старым rename_directory предки создаются заново."""
+        if path in inodes:
+            return inodes[path]
+        parent_path, name = split_path(path)
+        parent = ROOT_PARENT if parent_path is None else self._migrate_ancestor(parent_path, inodes)
+        inode = self.create_inode()
+        now = time.time()
+        self.link(parent, name, inode, "root", 0o755, "directory", 0, now, now)
+        inodes[path] = inode
+        self.logger.warning(f"Restored missing directory for orphaned entries: {path}")
+        return inode
+
+    @property
+    def in_transaction(self) -> bool:
+        return self.db.in_transaction
+
+    def begin(self):
+        self.db.execute("BEGIN")
+
+    def savepoint(self, name: str):
+        self.db.execute(f"SAVEPOINT {name}")
+
+    def rollback_to(self, name: str):
+        self.db.execute(f"ROLLBACK TO {name}")
+        self.db.execute(f"RELEASE {name}")
+
+    def release(self, name: str):
+        self.db.execute(f"RELEASE {name}")
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def create_inode(self) -> int:
+        return self.db.execute("INSERT INTO inodes (ref_count) VALUES (1)").lastrowid
+
+    def allocate_inodes(self) -> int:
+        return self.db.execute(
+            "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'inodes'), 0), COALESCE((SELECT MAX(inode) FROM inodes), 0)) + 1"
+        ).fetchone()[0]
+
+    def link(self, parent: int, name: str, inode: int, owner: str, perms: int, type_: str, size: int, ctime: float, mtime: float):
+        self.db.execute(
+            "UPDATE inodes SET owner = ?, perms = ?, type = ?, size = ?, ctime = ?, mtime = ? WHERE inode = ?",
+            (owner, perms, type_, size, ctime, mtime, inode)
+        )
+        self.db.execute("INSERT INTO dentries (parent, name, inode) VALUES (?, ?, ?)", (parent, name, inode))
+        if type_ == "directory":
+            self.db.execute("INSERT OR REPLACE INTO dir_usage (inode) VALUES (?)", (inode,))
+
+    def insert_entries(self, inodes: List[tuple], entries: List[tuple]):
+        self.db.executemany(
+            "INSERT INTO inodes (inode, ref_count, owner, perms, type, size, ctime, mtime) VALUES (?, 1, ?, ?, ?, ?, ?, ?)", inodes
+        )
+        self.db.executemany("INSERT INTO dentries (parent, name, inode) VALUES (?, ?, ?)", entries)
+
+    def unlink(self, parent: int, name: str):
+        self.db.execute("DELETE FROM dentries WHERE parent = ? AND name = ?", (parent, name))
+
+    def move(self, old_parent: int, old_name: str, new_parent: int, new_name: str):
+        self.db.execute(
+            "UPDATE dentries SET parent = ?, name = ? WHERE parent = ? AND name = ?",
+            (new_parent, new_name, old_parent, old_name)
+        )
+
+    def set_stat(self, inode: int, **fields):
+        columns = [column for column in STAT_FIELDS if column in fields]
+        self.db.execute(f"UPDATE inodes SET {', '.join(column + ' = ?' for column in columns)} WHERE inode = ?",
+                        (*(fields[column] for column in columns), inode))
+
+    def set_sizes(self, rows: List[Tuple[int, int]]):
+        self.db.executemany("UPDATE inodes SET size = ? WHERE inode = ?", rows)
+
+    def drop_inode(self, inode: int):
+        self.db.execute("DELETE FROM dir_usage WHERE inode = ?", (inode,))
+        self.db.execute("UPDATE inodes SET ref_count = ref_count - 1 WHERE inode = ?", (inode,))
+        self.release_content(inode)
+        self.db.execute("DELETE FROM inodes WHERE inode = ? AND ref_count <= 0", (inode,))
+        self.unindex(inode)
+
+    def drop_inodes(self, inodes: List[int]):
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS drop_set (inode INTEGER PRIMARY KEY)")
+        self.db.execute("DELETE FROM drop_set")
+        self.db.executemany("INSERT INTO drop_set (inode) VALUES (?)", [(inode,) for inode in inodes])
+        self.db.execute("""
+            WITH counts(blob, n) AS (
+                SELECT e.blob, COUNT(*) FROM drop_set s JOIN extents e ON e.inode = s.inode GROUP BY e.blob
+            )
+            UPDATE blobs SET ref_count = ref_count - (SELECT n FROM counts WHERE counts.blob = blobs.hash)
+            WHERE hash IN (SELECT blob FROM counts)
+        """)
+        if not self.retain_blobs:
+            self.db.execute("DELETE FROM blobs WHERE ref_count <= 0 AND hash IN (SELECT e.blob FROM drop_set s JOIN extents e ON e.inode = s.inode)")
+        self.db.execute("DELETE FROM extents WHERE inode IN (SELECT inode FROM drop_set)")
+        self.db.execute("""
+            WITH counts(doc, n) AS (
+                SELECT f.doc, COUNT(*) FROM drop_set s JOIN content_files f ON f.inode = s.inode GROUP BY f.doc
+            )
+            UPDATE content_docs SET ref_count = ref_count - (SELECT n FROM counts WHERE counts.doc = content_docs.doc)
+            WHERE doc IN (SELECT doc FROM counts)
+        """)
+        self.db.execute("DELETE FROM content_files WHERE inode IN (SELECT inode FROM drop_set)")
+        self.db.execute("DELETE FROM content_stale WHERE inode IN (SELECT inode FROM drop_set)")
+        self.db.execute("DELETE FROM dentries WHERE inode IN (SELECT inode FROM drop_set)")
+        self.db.execute("DELETE FROM dir_usage WHERE inode IN (SELECT inode FROM drop_set)")
+        self.db.execute("DELETE FROM inodes WHERE inode IN (SELECT inode FROM drop_set)")
+        self.db.execute("DELETE FROM drop_set")
+
+    def blob_put(self, data: bytes) -> str:
+        # хэш и size - от исходных байтов; новый блок сжимается по политике compression (TNFS/compress.py)
+        blob = blob_hash(data)
+        if not self.blob_ref(blob):
+            codec, stored = encode(data, self.compression)
+            self.db.execute("INSERT INTO blobs (hash, content, size, ref_count, codec) VALUES (?, ?, ?, 1, ?)", (blob, stored, len(data), codec))
+        return blob
+
+    def blob_ref(self, blob: str) -> bool:
+        return self.db.execute("UPDATE blobs SET ref_count = ref_count + 1 WHERE hash = ?", (blob,)).rowcount > 0
+
+    def blob_release(self, blob: Optional[str]):
+        if blob is None:
+            return
+        self.db.execute("UPDATE blobs SET ref_count = ref_count - 1 WHERE hash = ?", (blob,))
+        if not self.retain_blobs:
+            self.db.execute("DELETE FROM blobs WHERE hash = ? AND ref_count <= 0", (blob,))
+
+    def put_blobs(self, chunks: List[Tuple[str, bytes]]):
+        self.db.executemany(
+            "INSERT INTO blobs (hash, codec, content, size, ref_count) VALUES (?, ?, ?, ?, 1) "
+            "ON CONFLICT(hash) DO UPDATE SET ref_count = ref_count + 1",
+            [(blob, *encode(data, self.compression), len(data)) for blob, data in chunks]
+        )
+
+    def purge_blobs(self, hashes: List[str]) -> int:
+        before = self.db.total_changes
+        self.db.executemany("DELETE FROM blobs WHERE hash = ? AND ref_count <= 0", [(blob,) for blob in hashes])
+        return self.db.total_changes - before
+
+    def set_codecs(self, updates: List[Tuple[str, bytes, str]]):
+        """Заменяет представление несжатых blobs: updates - (codec, content, hash)."""
+        self.db.executemany("UPDATE blobs SET codec = ?, content = ? WHERE hash = ? AND codec IS NULL", updates)
+
+    def put_extent(self, inode: int, idx: int, blob: str):
+        self.db.execute("INSERT OR REPLACE INTO extents (inode, idx, blob) VALUES (?, ?, ?)", (inode, idx, blob))
+
+    def delete_extent(self, inode: int, idx: int):
+        self.db.execute("DELETE FROM extents WHERE inode = ? AND idx = ?", (inode, idx))
+
+    def insert_extents(self, rows: List[Tuple[int, int, str]]):
+        self.db.executemany("INSERT INTO extents (inode, idx, blob) VALUES (?, ?, ?)", rows)
+
+    def release_content(self, inode: int):
+        self.db.execute(
+            "UPDATE blobs SET ref_count = ref_count - (SELECT COUNT(*) FROM extents e WHERE e.inode = ? AND e.blob = blobs.hash) "
+            "WHERE hash IN (SELECT blob FROM extents WHERE inode = ?)",
+            (inode, inode)
+        )
+        if not self.retain_blobs:
+            self.db.execute("DELETE FROM blobs WHERE ref_count <= 0 AND hash IN (SELECT blob FROM extents WHERE inode = ?)", (inode,))
+        self.db.execute("DELETE FROM extents WHERE inode = ?", (inode,))
+
+    def copy_files(self, pairs: List[Tuple[int, int]]):
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS copy_map (old INTEGER PRIMARY KEY, new INTEGER)")
+        self.db.execute("DELETE FROM copy_map")
+        self.db.executemany("INSERT INTO copy_map (old, new) VALUES (?, ?)", pairs)
+        self.db.execute("""
+            WITH counts(blob, n) AS (
+                SELECT e.blob, COUNT(*) FROM copy_map m JOIN extents e ON e.inode = m.old GROUP BY e.blob
+            )
+            UPDATE blobs SET ref_count = ref_count + (SELECT n FROM counts WHERE counts.blob = blobs.hash)
+            WHERE hash IN (SELECT blob FROM counts)
+        """)
+        self.db.execute("INSERT INTO extents (inode, idx, blob) SELECT m.new, e.idx, e.blob FROM copy_map m JOIN extents e ON e.inode = m.old")
+        # копия ссылается на запись индекса источника, текст не переписывается
+        self.db.execute("""
+            WITH counts(doc, n) AS (
+                SELECT f.doc, COUNT(*) FROM copy_map m JOIN content_files f ON f.inode = m.old GROUP BY f.doc
+            )
+            UPDATE content_docs SET ref_count = ref_count + (SELECT n FROM counts WHERE counts.doc = content_docs.doc)
+            WHERE doc IN (SELECT doc FROM counts)
+        """)
+        self.db.execute("INSERT INTO content_files (inode, doc) SELECT m.new, f.doc FROM copy_map m JOIN content_files f ON f.inode = m.old")
+        self.db.execute("INSERT OR IGNORE INTO content_stale (inode) SELECT m.new FROM copy_map m JOIN content_stale s ON s.inode = m.old")
+        self.db.execute("DELETE FROM copy_map")
+
+    def index(self, inode: int, text: Optional[str] = None):
+        self.unindex(inode)
+        key = index_key([blob for _, blob in self.extents(inode)])
+        if key is None:
+            return
+        # запись со ссылками 0 еще лежит в индексе до prune_index и оживает без повторной вставки текста
+        row = self.db.execute("SELECT doc FROM content_docs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            if text is None:
+                text = self.chunks(inode).decode(errors="replace")
+            doc = self.db.execute("INSERT INTO content_docs (key, ref_count) VALUES (?, 1)", (key,)).lastrowid
+            self.db.execute("INSERT INTO content_index (rowid, content) VALUES (?, ?)", (doc, text))
+        else:
+            doc = row[0]
+            self.db.execute("UPDATE content_docs SET ref_count = ref_count + 1 WHERE doc = ?", (doc,))
+        self.db.execute("INSERT INTO content_files (inode, doc) VALUES (?, ?)", (inode, doc))
+
+    def unindex(self, inode: int):
+        # запись индекса без содержимого нельзя удалить без её текста: она остается мертвой до prune_index
+        self.db.execute("UPDATE content_docs SET ref_count = ref_count - 1 WHERE doc = (SELECT doc FROM content_files WHERE inode = ?)", (inode,))
+        self.db.execute("DELETE FROM content_files WHERE inode = ?", (inode,))
+        self.db.execute("DELETE FROM content_stale WHERE inode = ?", (inode,))
+
+    def prune_index(self) -> int:
+        """Перестраивает индекс без мертвых записей: текст живых записей читается из blobs одного из их файлов."""
+        dead = self.db.execute("DELETE FROM content_docs WHERE ref_count <= 0").rowcount
+        self.db.execute("INSERT INTO content_index (content_index) VALUES ('delete-all')")
+        for doc, inode in self.db.execute("SELECT doc, MIN(inode) FROM content_files GROUP BY doc").fetchall():
+            self.db.execute("INSERT INTO content_index (rowid, content) VALUES (?, ?)", (doc, self.chunks(inode).decode(errors="replace")))
+        return dead
+
+    def mark_stale(self, inodes: Iterable[int]):
+        self.db.executemany("INSERT OR IGNORE INTO content_stale (inode) VALUES (?)", [(inode,) for inode in inodes])
+
+    def stale(self) -> List[int]:
+        return [row[0] for row in self.db.execute("SELECT s.inode FROM content_stale s JOIN inodes i ON i.inode = s.inode")]
+
+    def clear_stale(self):
+        self.db.execute("DELETE FROM content_stale")
+
+    def account(self, inodes: List[int], files: int, directories: int, size: int):
+        self.db.execute(
+            f"UPDATE dir_usage SET files = files + ?, directories = directories + ?, bytes = bytes + ? WHERE inode IN ({','.join('?' * len(inodes))})",
+            (files, directories, size, *inodes)
+        )
+
+    def account_many(self, rows: List[Tuple[int, int, int, int]]):
+        self.db.executemany("UPDATE dir_usage SET files = files + ?, directories = directories + ?, bytes = bytes + ? WHERE inode = ?", rows)
+
+    def create_usage(self, inodes: List[int]):
+        self.db.executemany("INSERT INTO dir_usage (inode) VALUES (?)", [(inode,) for inode in inodes])
+
+    def copy_usage(self, pairs: List[Tuple[int, int]]):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO dir_usage (inode, files, directories, bytes) SELECT ?, files, directories, bytes FROM dir_usage WHERE inode = ?", pairs
+        )
+
+    def set_dir_quota(self, inode: int, max_bytes: Optional[int], max_entries: Optional[int]):
+        self.db.execute("UPDATE dir_usage SET max_bytes = ?, max_entries = ? WHERE inode = ?", (max_bytes, max_entries, inode))
+
+    def set_owner_quota(self, owner: str, max_bytes: Optional[int], max_entries: Optional[int]):
+        self.db.execute("INSERT OR IGNORE INTO owner_usage (owner) VALUES (?)", (owner,))
+        self.db.execute("UPDATE owner_usage SET max_bytes = ?, max_entries = ? WHERE owner = ?", (max_bytes, max_entries, owner))
+
+    def append_journal(self, records: List[tuple]):
+        self.db.executemany("INSERT INTO journal (operation, path, timestamp, details, user, payload) VALUES (?, ?, ?, ?, ?, ?)", records)
+
+    def insert_journal(self, record: tuple):
+        self.db.execute("INSERT INTO journal (id, operation, path, timestamp, details, user, payload) VALUES (?, ?, ?, ?, ?, ?, ?)", record)
+
+    def write_access(self, rows: List[tuple]):
+        self.db.executemany(
+            "INSERT INTO access_stats (path, operation, count, last_access, last_user) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (path, operation) DO UPDATE SET count = count + excluded.count, "
+            "last_access = max(last_access, excluded.last_access), last_user = excluded.last_user",
+            rows
+        )
+
+
+_MISSING = object()
+
+class _Blob:
+    __slots__ = ("data", "ref_count")
+
+    def __init__(self, data: bytes, ref_count: int):
+        self.data = data
+        self.ref_count = ref_count
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def referenced(self, delta: int) -> "_Blob":
+        return _Blob(self.data, self.ref_count + delta)
+
+class _Usage:
+    __slots__ = ("files", "directories", "bytes", "max_bytes", "max_entries")
+
+    def __init__(self, files: int = 0, directories: int = 0, bytes: int = 0, max_bytes: Optional[int] = None, max_entries: Optional[int] = None):
+        self.files = files
+        self.directories = directories
+        self.bytes = bytes
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+    def added(self, files: int, directories: int, size: int) -> "_Usage":
+        return _Usage(self.files + files, self.directories + directories, self.bytes + size, self.max_bytes, self.max_entries)
+
+    def over(self) -> bool:
+        return ((self.max_bytes is not None and self.bytes > self.max_bytes)
+                or (self.max_entries is not None and self.files + self.directories > self.max_entries))
+
+class _Access:
+    __slots__ = ("count", "last_access", "last_user")
+
+    def __init__(self, count: int, last_access: float, last_user: str):
+        self.count = count
+        self.last_access = last_access
+        self.last_user = last_user
+
+
+class MemoryBackend(StorageBackend):
+    """Образ в памяти процесса на словарях: без файлов и ввода-вывода, для тестов, замеров и временных сессий.
+
+    Записи неизменяемы: изменение заменяет запись в словаре, а журнал отката хранит прежнее значение ключа,
+    поэтому точка сохранения - это просто длина журнала отката. Читатели из других потоков видят изменения
+    открытой транзакции (снимков, как у WAL, нет); каждый вызов по отдельности согласован."""
+
+    name = "memory"
+
+    def __init__(self):
+        self.inodes: Dict[int, Stat] = {}
+        self.dentries: Dict[Tuple[int, str], int] = {}  # (родитель, имя) -> инод
+        self.parents: Dict[int, Tuple[int, str]] = {}  # инод -> (родитель, имя)
+        self.listing: Dict[int, List[str]] = {}  # родитель -> отсортированные имена записей
+        self.blobs: Dict[str, _Blob] = {}
+        self.extent_map: Dict[int, Dict[int, str]] = {}  # инод -> номер блока -> хэш
+        self.content_index: Dict[int, str] = {}  # инод -> ключ записи индекса (index_key)
+        self.content_docs: Dict[str, Tuple[str, int]] = {}  # ключ -> (текст, число файлов); копии делят запись
+        self.content_stale: Dict[int, bool] = {}
+        self.dir_usage: Dict[int, _Usage] = {}
+        self.owners: Dict[str, _Usage] = {}
+        self.journal_records: Dict[int, tuple] = {}
+        self.access_stats: Dict[Tuple[str, str], _Access] = {}
+        self._next_inode = 1
+        self._next_journal = 1
+        self._undo: Optional[list] = None  # (словарь, ключ, прежнее значение) или функция отката
+        self._savepoints: Dict[str, int] = {}
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def reader(self):
+        yield self
+
+    def close(self):
+        pass
+
+    def init_schema(self, logger):
+        pass
+
+    def has_quotas(self) -> bool:
+        return any(usage.max_bytes is not None or usage.max_entries is not None
+                   for usage in list(self.owners.values()) + list(self.dir_usage.values()))
+
+    # --- транзакции: журнал отката
+
+    def _set(self, table: dict, key, value):
+        old = table.get(key, _MISSING)
+        table[key] = value
+        if self._undo is not None:
+            self._undo.append((table, key, old))
+
+    def _pop(self, table: dict, key):
+        old = table.pop(key, _MISSING)
+        if old is not _MISSING and self._undo is not None:
+            self._undo.append((table, key, old))
+        return None if old is _MISSING else old
+
+    def _undo_to(self, mark: int):
+        while len(self._undo) > mark:
+            entry = self._undo.pop()
+            if callable(entry):
+                entry()
+                continue
+            table, key, old = entry
+            if old is _MISSING:
+                table.pop(key, None)
+            else:
+                table[key] = old
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._undo is not None
+
+    def begin(self):
+        self._undo = []
+
+    def savepoint(self, name: str):
+        self._savepoints[name] = len(self._undo)
+
+    def rollback_to(self, name: str):
+        with self._lock:
+            self._undo_to(self._savepoints.pop(name))
+
+    def release(self, name: str):
+        self._savepoints.pop(name, None)
+
+    def commit(self):
+        self._undo = None
+        self._savepoints.clear()
+
+    def rollback(self):
+        if self._undo is not None:
+            with self._lock:
+                self._undo_to(0)
+        self.commit()
+
+    # --- дерево и иноды
+
+    def root(self) -> Optional[int]:
+        return self.dentries.get((ROOT_PARENT, "/"))
+
+    def lookup(self, parent: int, name: str) -> Optional[int]:
+        return self.dentries.get((parent, name))
+
+    def get_stat(self, inode: int) -> Optional[Stat]:
+        return self.inodes.get(inode)
+
+    def lookup_stat(self, parent: int, name: str) -> Optional[Stat]:
+        inode = self.dentries.get((parent, name))
+        return None if inode is None else self.inodes.get(inode)
+
+    def names(self, parent: int) -> List[str]:
+        return list(self.listing.get(parent, ()))
+
+    def children(self, parent: int, after: str, limit: int) -> List[Tuple[str, Stat]]:
+        with self._lock:
+            names = self.listing.get(parent, [])
+            start = bisect.bisect_right(names, after) if after else 0
+            return [(name, self.inodes[self.dentries[(parent, name)]]) for name in names[start:start + limit]]
+
+    def count_children(self, parent: int) -> int:
+        return len(self.listing.get(parent, ()))
+
+    def has_children(self, parent: int) -> bool:
+        return bool(self.listing.get(parent))
+
+    def parent_of(self, inode: int) -> Optional[Tuple[int, str]]:
+        return self.parents.get(inode)
+
+    def subtree_size(self, inode: int) -> int:
+        count, pending = 0, [inode]
+        while pending:
+            parent = pending.pop()
+            for name in self.listing.get(parent, ()):
+                count += 1
+                child = self.dentries[(parent, name)]
+                if child in self.listing:
+                    pending.append(child)
+        return count
+
+    def create_inode(self) -> int:
+        with self._lock:
+            inode = self._next_inode
+            self._next_inode += 1
+        return inode
+
+    def allocate_inodes(self) -> int:
+        return self._next_inode
+
+    def _put_inode(self, stat: Stat):
+        """Записывает инод и ведет счетчики владельцев (как триггеры owner_usage в SQLite)."""
+        old = self.inodes.get(stat.inode)
+        if old is not None:
+            self._charge_owner(old, -1)
+        self._set(self.inodes, stat.inode, stat)
+        self._charge_owner(stat, 1)
+
+    def _charge_owner(self, stat: Stat, sign: int):
+        usage = self.owners.get(stat.owner) or _Usage()
+        self._set(self.owners, stat.owner, usage.added(sign * (stat.type == "file"), sign * (stat.type == "directory"), sign * (stat.size or 0)))
+
+    def _add_entry(self, parent: int, name: str, inode: int):
+        self._set(self.dentries, (parent, name), inode)
+        self._set(self.parents, inode, (parent, name))
+        names = self.listing.get(parent)
+        if names is None:
+            names = []
+            self._set(self.listing, parent, names)
+        bisect.insort(names, name)
+        if self._undo is not None:
+            self._undo.append(lambda: names.remove(name))
+        self._next_inode = max(self._next_inode, inode + 1)
+
+    def _remove_entry(self, parent: int, name: str) -> Optional[int]:
+        inode = self._pop(self.dentries, (parent, name))
+        if inode is None:
+            return None
+        if self.parents.get(inode) == (parent, name):
+            self._pop(self.parents, inode)
+        names = self.listing[parent]
+        names.pop(bisect.bisect_left(names, name))
+        if self._undo is not None:
+            self._undo.append(lambda: bisect.insort(names, name))
+        return inode
+
+    def link(self, parent: int, name: str, inode: int, owner: str, perms: int, type_: str, size: int, ctime: float, mtime: float):
+        with self._lock:
+            self._put_inode(Stat(inode, owner, perms, type_, size, ctime, mtime))
+            self._add_entry(parent, name, inode)
+            if type_ == "directory":
+                self._set(self.dir_usage, inode, _Usage())
+
+    def insert_entries(self, inodes: List[tuple], entries: List[tuple]):
+        with self._lock:
+            for row in inodes:
+                self._put_inode(Stat(*row))
+            for parent, name, inode in entries:
+                self._add_entry(parent, name, inode)
+
+    def unlink(self, parent: int, name: str):
+        with self._lock:
+            self._remove_entry(parent, name)
+
+    def move(self, old_parent: int, old_name: str, new_parent: int, new_name: str):
+        with self._lock:
+            inode = self._remove_entry(old_parent, old_name)
+            if inode is not None:
+                self._add_entry(new_parent, new_name, inode)
+
+    def set_stat(self, inode: int, **fields):
+        with self._lock:
+            stat = self.inodes.get(inode)
+            if stat is not None:
+                self._put_inode(stat._replace(**{column: fields[column] for column in STAT_FIELDS if column in fields}))
+
+    def set_sizes(self, rows: List[Tuple[int, int]]):
+        for size, inode in rows:
+            self.set_stat(inode, size=size)
+
+    def drop_inode(self, inode: int):
+        with self._lock:
+            self._pop(self.dir_usage, inode)
+            self.release_content(inode)
+            stat = self._pop(self.inodes, inode)
+            if stat is not None:
+                self._charge_owner(stat, -1)
+            self.unindex(inode)
+
+    def drop_inodes(self, inodes: List[int]):
+        with self._lock:
+            for inode in inodes:
+                entry = self.parents.get(inode)
+                if entry is not None:
+                    self._remove_entry(*entry)
+                self.drop_inode(inode)
+
+    # --- содержимое
+
+    def _new_blob(self, data: bytes) -> _Blob:
+        return _Blob(data, 1)
+
+    def blob_put(self, data: bytes) -> str:
+        blob = blob_hash(data)
+        with self._lock:
+            if not self.blob_ref(blob):
+                self._set(self.blobs, blob, self._new_blob(data))
+        return blob
+
+    def blob_ref(self, blob: str) -> bool:
+        with self._lock:
+            record = self.blobs.get(blob)
+            if record is None:
+                return False
+            self._set(self.blobs, blob, record.referenced(1))
+            return True
+
+    def blob_release(self, blob: Optional[str]):
+        if blob is None:
+            return
+        with self._lock:
+            record = self.blobs.get(blob)
+            if record is None:
+                return
+            if record.ref_count <= 1 and not self.retain_blobs:
+                self._pop(self.blobs, blob)
+            else:
+                self._set(self.blobs, blob, record.referenced(-1))
+
+    def put_blobs(self, chunks: List[Tuple[str, bytes]]):
+        with self._lock:
+            for blob, data in chunks:
+                if not self.blob_ref(blob):
+                    self._set(self.blobs, blob, self._new_blob(data))
+
+    def purge_blobs(self, hashes: List[str]) -> int:
+        purged = 0
+        with self._lock:
+            for blob in hashes:
+                record = self.blobs.get(blob)
+                if record is not None and record.ref_count <= 0:
+                    self._pop(self.blobs, blob)
+                    purged += 1
+        return purged
+
+    def extents(self, inode: int, first: int = 0, last: Optional[int] = None) -> List[Tuple[int, str]]:
+        extents = self.extent_map.get(inode)
+        if not extents:
+            return []
+        return sorted((idx, blob) for idx, blob in list(extents.items()) if idx >= first and (last is None or idx <= last))
+
+    def extent_data(self, inode: int, first: int, last: int) -> List[Tuple[int, str, bytes]]:
+        with self._lock:
+            return [(idx, blob, self.blobs[blob].data) for idx, blob in self.extents(inode, first, last)]
+
+    def chunks(self, inode: int, first: int = 0, last: Optional[int] = None) -> bytes:
+        with self._lock:
+            return b"".join(self.blobs[blob].data for _, blob in self.extents(inode, first, last))
+
+    def _extents_of(self, inode: int) -> Dict[int, str]:
+        extents = self.extent_map.get(inode)
+        if extents is None:
+            extents = {}
+            self._set(self.extent_map, inode, extents)
+        return extents
+
+    def put_extent(self, inode: int, idx: int, blob: str):
+        with self._lock:
+            self._set(self._extents_of(inode), idx, blob)
+
+    def delete_extent(self, inode: int, idx: int):
+        with self._lock:
+            extents = self.extent_map.get(inode)
+            if extents is not None:
+                self._pop(extents, idx)
+
+    def insert_extents(self, rows: List[Tuple[int, int, str]]):
+        with self._lock:
+            for inode, idx, blob in rows:
+                self._set(self._extents_of(inode), idx, blob)
+
+    def release_content(self, inode: int):
+        with self._lock:
+            extents = self._pop(self.extent_map, inode)
+            for blob in (extents or {}).values():
+                self.blob_release(blob)
+
+    def copy_files(self, pairs: List[Tuple[int, int]]):
+        with self._lock:
+            for old, new in pairs:
+                extents = self.extent_map.get(old)
+                if extents:
+                    for blob in extents.values():
+                        self.blob_ref(blob)
+                    self._set(self.extent_map, new, dict(extents))
+                key = self.content_index.get(old)
+                if key is not None:
+                    text, refs = self.content_docs[key]
+                    self._set(self.content_docs, key, (text, refs + 1))
+                    self._set(self.content_index, new, key)
+                if old in self.content_stale:
+                    self._set(self.content_stale, new, True)
+
+    def check_file(self, inode: int) -> Tuple[int, Optional[int], int, int]:
+        extents = self.extents(inode)
+        size = sum(self.blobs[blob].size for _, blob in extents if blob in self.blobs)
+        missing = sum(blob not in self.blobs for _, blob in extents)
+        return len(extents), extents[-1][0] if extents else None, size, missing or None
+
+    def check_image(self) -> List[str]:
+        problems = []
+        with self._lock:
+            for (parent, name), inode in self.dentries.items():
+                if inode not in self.inodes:
+                    problems.append(f"dentry {name!r} in directory inode {parent} points to a missing inode")
+            for inode in self.inodes:
+                if inode not in self.parents:
+                    problems.append(f"inode {inode} is not linked into the tree")
+            used: Dict[str, int] = {}
+            for extents in self.extent_map.values():
+                for blob in extents.values():
+                    used[blob] = used.get(blob, 0) + 1
+            for blob, record in self.blobs.items():
+                if record.ref_count != used.get(blob, 0):
+                    problems.append(f"blob {blob[:12]} has ref_count {record.ref_count} but {used.get(blob, 0)} extents")
+        return problems
+
+    # --- полнотекстовый индекс: поиск подстроки перебором записей
+
+    def index(self, inode: int, text: Optional[str] = None):
+        with self._lock:
+            self.unindex(inode)
+            key = index_key([blob for _, blob in self.extents(inode)])
+            if key is None:
+                return
+            doc = self.content_docs.get(key)
+            if doc is None:
+                doc = (self.chunks(inode).decode(errors="replace") if text is None else text, 0)
+            self._set(self.content_docs, key, (doc[0], doc[1] + 1))
+            self._set(self.content_index, inode, key)
+
+    def unindex(self, inode: int):
+        with self._lock:
+            key = self._pop(self.content_index, inode)
+            if key is not None:
+                text, refs = self.content_docs[key]
+                if refs > 1:
+                    self._set(self.content_docs, key, (text, refs - 1))
+                else:
+                    self._pop(self.content_docs, key)
+            self._pop(self.content_stale, inode)
+
+    def mark_stale(self, inodes: Iterable[int]):
+        with self._lock:
+            for inode in inodes:
+                self._set(self.content_stale, inode, True)
+
+    def has_stale(self) -> bool:
+        return bool(self.content_stale)
+
+    def stale(self) -> List[int]:
+        return [inode for inode in list(self.content_stale) if inode in self.inodes]
+
+    def clear_stale(self):
+        with self._lock:
+            for inode in list(self.content_stale):
+                self._pop(self.content_stale, inode)
+
+    def search(self, pattern: str) -> List[int]:
+        keys = {key for key, (text, _) in list(self.content_docs.items()) if pattern in text}
+        return [inode for inode, key in list(self.content_index.items()) if key in keys]
+
+    def indexed_text(self, inode: int, pattern: str) -> Optional[str]:
+        doc = self.content_docs.get(self.content_index.get(inode))
+        return doc[0] if doc is not None and pattern in doc[0] else None
+
+    # --- счетчики места и квоты
+
+    def usage(self, inode: int) -> Tuple[int, int, int]:
+        usage = self.dir_usage[inode]
+        return usage.files, usage.directories, usage.bytes
+
+    def account(self, inodes: List[int], files: int, directories: int, size: int):
+        with self._lock:
+            for inode in inodes:
+                usage = self.dir_usage.get(inode)
+                if usage is not None:
+                    self._set(self.dir_usage, inode, usage.added(files, directories, size))
+
+    def account_many(self, rows: List[Tuple[int, int, int, int]]):
+        for files, directories, size, inode in rows:
+            self.account([inode], files, directories, size)
+
+    def create_usage(self, inodes: List[int]):
+        with self._lock:
+            for inode in inodes:
+                self._set(self.dir_usage, inode, _Usage())
+
+    def copy_usage(self, pairs: List[Tuple[int, int]]):
+        with self._lock:
+            for new, old in pairs:
+                usage = self.dir_usage.get(old)
+                if usage is not None:
+                    self._set(self.dir_usage, new, _Usage(usage.files, usage.directories, usage.bytes))
+
+    def over_quota(self, inodes: List[int]):
+        for inode in inodes:
+            usage = self.dir_usage.get(inode)
+            if usage is not None and usage.over():
+                return inode, usage.bytes, usage.files + usage.directories, usage.max_bytes, usage.max_entries
+        return None
+
+    def owner_over_quota(self, owner: str):
+        usage = self.owners.get(owner)
+        if usage is None or not usage.over():
+            return None
+        return usage.bytes, usage.files + usage.directories, usage.max_bytes, usage.max_entries
+
+    def set_dir_quota(self, inode: int, max_bytes: Optional[int], max_entries: Optional[int]):
+        with self._lock:
+            usage = self.dir_usage[inode]
+            self._set(self.dir_usage, inode, _Usage(usage.files, usage.directories, usage.bytes, max_bytes, max_entries))
+
+    def set_owner_quota(self, owner: str, max_bytes: Optional[int], max_entries: Optional[int]):
+        with self._lock:
+            usage = self.owners.get(owner) or _Usage()
+            self._set(self.owners, owner, _Usage(usage.files, usage.directories, usage.bytes, max_bytes, max_entries))
+
+    def owner_usage(self):
+        return [(owner, u.files, u.directories, u.bytes, u.max_bytes, u.max_entries) for owner, u in list(self.owners.items())]
+
+    def dir_quotas(self):
+        return [(inode, u.files, u.directories, u.bytes, u.max_bytes, u.max_entries) for inode, u in list(self.dir_usage.items())
+                if u.max_bytes is not None or u.max_entries is not None]
+
+    def stored_bytes(self, inodes: List[int]) -> int:
+        with self._lock:
+            return sum(self.blobs[blob].size for inode in inodes for _, blob in self.extents(inode) if blob in self.blobs)
+
+    def image_size(self) -> Tuple[int, int]:
+        return sum(record.size for record in list(self.blobs.values())), 0
+
+    def storage_stats(self) -> Dict:
+        live = [record for record in list(self.blobs.values()) if record.ref_count > 0]
+        size = sum(record.size for record in live)
+        return {"blobs": len(live), "bytes": size, "stored": size, "codecs": {"raw": len(live)} if live else {}}
+
+    # --- журнал и счетчики обращений
+
+    def append_journal(self, records: List[tuple]):
+        with self._lock:
+            for record in records:
+                self._set(self.journal_records, self._next_journal, (self._next_journal, *record))
+                self._next_journal += 1
+
+    def insert_journal(self, record: tuple):
+        with self._lock:
+            self._set(self.journal_records, record[0], tuple(record))
+            self._next_journal = max(self._next_journal, record[0] + 1)
+
+    def journal(self, after: int = 0, limit: Optional[int] = None) -> List[tuple]:
+        records = sorted(record for id_, record in list(self.journal_records.items()) if id_ > after)
+        return records if limit is None else records[:limit]
+
+    def write_access(self, rows: List[tuple]):
+        with self._lock:
+            for path, operation, count, last_access, user in rows:
+                old = self.access_stats.get((path, operation))
+                if old is not None:
+                    count, last_access = old.count + count, max(old.last_access, last_access)
+                self._set(self.access_stats, (path, operation), _Access(count, last_access, user))
+
+    def access(self, operation: str) -> List[Tuple[str, int, float]]:
+        rows = [(path, stats.count, stats.last_access) for (path, op), stats in list(self.access_stats.items()) if op == operation]
+        return sorted(rows, key=lambda row: (-row[1], row[0]))
@@ -0,0 +1,213 @@
+#TNFS content cache
+#created by SKATT
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024  # бюджет кэша по умолчанию 64 мегабайта
+DEFAULT_DENTRY_ENTRIES = 65536  # сколько разрешенных путей хранит кэш dentries
+
+class CacheEntry(NamedTuple):
+    content: str
+    owner: str
+    perms: int
+    type: str
+    size: int
+
+class Stat(NamedTuple):
+    """Неизменяемая запись о пути: все, что проверкам SELinux, прав и типа нужно знать об иноде."""
+    inode: int
+    owner: str
+    perms: int
+    type: str
+    size: int
+    ctime: float
+    mtime: float
+
+class ContentCache:
+    """LRU-кэш содержимого файлов TNFS с ограничением по байтам."""
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._undo: Optional[Dict[str, Optional[CacheEntry]]] = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, path: str) -> Optional[CacheEntry]:
+        """Возвращает запись и отмечает её как последнюю использованную."""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return entry
+
+    def put(self, path: str, content: str, owner: str, perms: int, type_: str, size: int):
+        """Кладет содержимое и метаданные файла в кэш, вытесняя самые старые записи."""
+        with self._lock:
+            self._remember(path)
+            self._discard(path)
+            if size > self.max_bytes:
+                return
+            self._entries[path] = CacheEntry(content, owner, perms, type_, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.current_bytes -= old.size
+                self.evictions += 1
+
+    def update_meta(self, path: str, **meta):
+        """Обновляет метаданные закэшированной записи (owner, perms)."""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._remember(path)
+                self._entries[path] = entry._replace(**meta)
+
+    def invalidate(self, path: str):
+        """Удаляет запись о пути из кэша."""
+        with self._lock:
+            self._remember(path)
+            self._discard(path)
+
+    def invalidate_tree(self, path: str):
+        """Удаляет из кэша путь и всех его потомков."""
+        prefix = path.rstrip("/") + "/"
+        with self._lock:
+            for cached in [p for p in self._entries if p == path or p.startswith(prefix)]:
+                self._remember(cached)
+                self._discard(cached)
+
+    def begin(self):
+        """Начинает запись изменений кэша для отката транзакции."""
+        with self._lock:
+            self._undo = {}
+
+    def commit(self):
+        with self._lock:
+            self._undo = None
+
+    def rollback(self):
+        """Возвращает записи, измененные с начала транзакции, в прежнее состояние."""
+        with self._lock:
+            undo, self._undo = self._undo or {}, None
+            for path, entry in undo.items():
+                self._discard(path)
+                if entry is not None:
+                    self._entries[path] = entry
+                    self.current_bytes += entry.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict:
+        """Возвращает статистику кэша."""
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remember(self, path: str):
+        if self._undo is not None and path not in self._undo:
+            self._undo[path] = self._entries.get(path)
+
+    def _discard(self, path: str):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.current_bytes -= entry.size
+
+class DentryCache:
+    """LRU-кэш разрешения путей: полный путь -> инод, и инод -> запись Stat."""
+
+    def __init__(self, max_entries: int = DEFAULT_DENTRY_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stat_hits = 0
+        self.stat_misses = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._stats: "OrderedDict[int, Stat]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, path: str) -> Optional[int]:
+        with self._lock:
+            inode = self._entries.get(path)
+            if inode is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return inode
+
+    def put(self, path: str, inode: int):
+        with self._lock:
+            self._entries[path] = inode
+            self._entries.move_to_end(path)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_stat(self, inode: int) -> Optional[Stat]:
+        with self._lock:
+            stat = self._stats.get(inode)
+            if stat is None:
+                self.stat_misses += 1
+                return None
+            self._stats.move_to_end(inode)
+            self.stat_hits += 1
+            return stat
+
+    def put_stat(self, stat: Stat):
+        with self._lock:
+            self._stats[stat.inode] = stat
+            self._stats.move_to_end(stat.inode)
+            if len(self._stats) > self.max_entries:
+                self._stats.popitem(last=False)
+
+    def invalidate_inode(self, inode: int):
+        """Удаляет запись Stat инода (после изменения его метаданных)."""
+        with self._lock:
+            self._stats.pop(inode, None)
+
+    def invalidate_tree(self, path: str):
+        """Удаляет путь и всех его потомков (при переименовании или удалении директории)."""
+        prefix = path.rstrip("/") + "/"
+        with self._lock:
+            for cached in [p for p in self._entries if p == path or p.startswith(prefix)]:
+                del self._entries[cached]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._entries),
+            "stat_entries": len(self._stats),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stat_hits": self.stat_hits,
+            "stat_misses": self.stat_misses,
+        }
@@ -0,0 +1,45 @@
+#TNFS compression
+#created by SKATT
+import lzma
+import zlib
+from typing import Optional, Tuple
+
+COMPRESSION_MODES = ("auto", "zlib", "lzma", "off")
+COMPRESS_MIN_BYTES = 4096  # блоки меньше хранятся как есть: выигрыш не окупает распаковку
+COMPRESS_MAX_RATIO = 0.9  # блок, который сжимается хуже, хранится как есть
+LZMA_MIN_BYTES = 32 * 1024  # в режиме auto lzma пробуется только для больших блоков
+LZMA_TRY_RATIO = 0.2  # ... и только если zlib сжал хуже: хорошо сжатый zlib блок быстрее читать
+LZMA_MIN_GAIN = 0.2  # lzma читается в ~5 раз медленнее zlib: он выбирается, только если меньше результата zlib на 20%
+LZMA_SAMPLE_BYTES = 8192  # сначала lzma пробуется на начале блока: полное сжатие дорого, а обычно проигрывает
+ZLIB_LEVEL = 6
+LZMA_PRESET = 6
+
+def encode(data: bytes, mode: str = "auto") -> Tuple[Optional[str], bytes]:
+    """Сжимает блок по политике mode. Возвращает (кодек, хранимые байты); кодек None - блок хранится как есть."""
+    if mode == "off" or len(data) < COMPRESS_MIN_BYTES:
+        return None, data
+    codec, stored = None, data
+    if mode in ("auto", "zlib"):
+        packed = zlib.compress(data, ZLIB_LEVEL)
+        if len(packed) <= len(data) * COMPRESS_MAX_RATIO:
+            codec, stored = "zlib", packed
+    if mode == "lzma" or (mode == "auto" and codec is not None and len(data) >= LZMA_MIN_BYTES
+                          and len(stored) > len(data) * LZMA_TRY_RATIO and _lzma_promising(data[:LZMA_SAMPLE_BYTES])):
+        packed = lzma.compress(data, preset=LZMA_PRESET)
+        limit = len(data) * COMPRESS_MAX_RATIO if codec is None else len(stored) * (1 - LZMA_MIN_GAIN)
+        if len(packed) <= limit:
+            codec, stored = "lzma", packed
+    return codec, stored
+
+def _lzma_promising(sample: bytes) -> bool:
+    return len(lzma.compress(sample, preset=LZMA_PRESET)) <= len(zlib.compress(sample, ZLIB_LEVEL)) * (1 - LZMA_MIN_GAIN)
+
+def decode(codec: Optional[str], stored: bytes) -> bytes:
+    """Возвращает исходные байты блока, сохраненного кодеком codec."""
+    if codec is None:
+        return stored
+    if codec == "zlib":
+        return zlib.decompress(stored)
+    if codec == "lzma":
+        return lzma.decompress(stored)
+    raise ValueError(f"Unknown blob codec: {codec}")
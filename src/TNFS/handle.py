@@ -0,0 +1,84 @@
+#TNFS file handle
+#created by SKATT
+import codecs
+from typing import Union
+
+class TNFSFile:
+    """Открытый файл TNFS: потоковое чтение и запись по смещению без загрузки всего содержимого."""
+
+    def __init__(self, tnfs, path: str, inode: int, size: int, mode: str, chunk_size: int):
+        self.tnfs = tnfs
+        self.path = path
+        self.inode = inode
+        self.size = size
+        self.mode = mode
+        self.binary = "b" in mode
+        self.readable = mode[0] == "r" or "+" in mode
+        self.writable = mode[0] in "wa" or "+" in mode
+        self.chunk_size = chunk_size
+        self.closed = False
+        self._pos = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def read(self, n: int = -1) -> Union[str, bytes]:
+        """Читает до n байтов с текущей позиции (все до конца при n < 0)."""
+        self._check_open("read")
+        if not self.readable:
+            self.tnfs.crash_handler.raise_crash("FS", "0xV0E0ERR", f"File not open for reading: {self.path}")
+        data = self.tnfs._read_range(self.inode, self._pos, n, self.size)
+        self._pos += len(data)
+        if self.binary:
+            return data
+        return self._decoder.decode(data, final=self._pos >= self.size)
+
+    def write(self, data: Union[str, bytes]) -> int:
+        """Пишет данные с текущей позиции, переписывая только затронутые блоки."""
+        self._check_open("write")
+        if not self.writable:
+            self.tnfs.crash_handler.raise_crash("FS", "0xV0E0ERR", f"File not open for writing: {self.path}")
+        if isinstance(data, str):
+            data = data.encode()
+        if self.mode[0] == "a":
+            self._pos = self.size
+        self.size = self.tnfs._handle_write(self, self._pos, data)
+        self._pos += len(data)
+        return len(data)
+
+    def append(self, data: Union[str, bytes]) -> int:
+        """Дописывает данные в конец файла."""
+        self.seek(0, 2)
+        return self.write(data)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        """Перемещает позицию (в байтах): whence 0 - от начала, 1 - от текущей, 2 - от конца."""
+        self._check_open("seek")
+        base = {0: 0, 1: self._pos, 2: self.size}.get(whence)
+        if base is None or base + offset < 0:
+            self.tnfs.crash_handler.raise_crash("FS", "0xV0E0ERR", f"Invalid seek: offset={offset}, whence={whence}")
+        self._pos = base + offset
+        self._decoder.reset()
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self):
+        self.closed = True
+
+    def __iter__(self):
+        """Отдает содержимое файла блоками по chunk_size байтов."""
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _check_open(self, operation: str):
+        if self.closed:
+            self.tnfs.crash_handler.raise_crash("FS", "0xV0E0ERR", f"I/O operation {operation} on closed file: {self.path}")
@@ -0,0 +1,439 @@
+#TNFS log-structured storage
+#created by SKATT
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import sys
+INIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(INIT_DIR)
+from TNFS.backend import MemoryBackend, _Usage, _Access, _MISSING
+from TNFS.cache import Stat
+
+SEGMENT_SIZE = 16 * 1024 * 1024  # емкость сегмента; запись, которая не помещается, открывает следующий
+SEGMENT_SUFFIX = ".seg"
+COMPACT_INTERVAL = 5.0  # секунд между проверками фонового уплотнения
+COMPACT_LIVE_RATIO = 0.5  # сегмент уплотняется, когда живые блоки занимают меньше этой доли его размера
+RECORD_HEADER = struct.Struct("<BII")  # вид записи, длина тела, crc32 тела
+DATA, META, CHECKPOINT = 1, 2, 3  # блок содержимого, изменения транзакции, полное состояние образа
+
+class _Segment:
+    """Файл сегмента, отображенный в память. Активный сегмент сразу создается емкостью capacity и дописывается через
+    отображение; запечатанный сегмент обрезан до записанного размера и открыт только для чтения."""
+
+    def __init__(self, number: int, path: Path, capacity: int = 0):
+        self.number = number
+        self.path = path
+        self.capacity = capacity
+        self.valid = 0
+        if capacity:
+            with open(path, "w+b") as file:
+                file.truncate(capacity)
+                self.map = mmap.mmap(file.fileno(), capacity)
+            self.size = 0
+        else:
+            self.size = path.stat().st_size
+            self.map = self._map_readonly()
+
+    def _map_readonly(self) -> Optional[mmap.mmap]:
+        if not self.size:
+            return None
+        with open(self.path, "rb") as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def fits(self, length: int) -> bool:
+        return self.size + RECORD_HEADER.size + length <= self.capacity
+
+    def append(self, kind: int, payload) -> int:
+        """Дописывает запись и возвращает смещение её тела."""
+        offset = self.size + RECORD_HEADER.size
+        self.map[self.size:offset] = RECORD_HEADER.pack(kind, len(payload), zlib.crc32(payload))
+        self.map[offset:offset + len(payload)] = payload
+        self.size = offset + len(payload)
+        return offset
+
+    def read(self, offset: int, length: int) -> bytes:
+        return self.map[offset:offset + length]
+
+    def view(self, offset: int, length: int) -> memoryview:
+        return memoryview(self.map)[offset:offset + length]
+
+    def records(self) -> Iterator[Tuple[int, int, int]]:
+        """Записи сегмента (вид, смещение тела, длина) до конца записанной части; self.valid - конец последней целой записи.
+        Контрольная сумма проверяется у записей состояния: блоки содержимого адресуются хэшем, их проверяет fsck."""
+        position, end = 0, self.size if self.map is not None else 0
+        while position + RECORD_HEADER.size <= end:
+            kind, length, crc = RECORD_HEADER.unpack_from(self.map, position)
+            offset = position + RECORD_HEADER.size
+            if kind not in (DATA, META, CHECKPOINT) or offset + length > end:
+                break
+            if kind != DATA and zlib.crc32(self.view(offset, length)) != crc:
+                break
+            yield kind, offset, length
+            position = self.valid = offset + length
+
+    def flush(self):
+        if self.capacity:
+            self.map.flush()
+
+    def seal(self):
+        """Обрезает активный сегмент до записанного размера и переоткрывает его только для чтения."""
+        self.map.flush()
+        self.map.close()
+        os.truncate(self.path, self.size)
+        self.capacity = 0
+        self.map = self._map_readonly()
+
+    def truncate(self, size: int):
+        """Отбрасывает хвост сегмента после size байт (недописанные записи после сбоя)."""
+        if self.map is not None:
+            self.map.close()
+        os.truncate(self.path, size)
+        self.size = size
+        self.map = self._map_readonly()
+
+    def close(self):
+        if self.capacity:
+            self.seal()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def remove(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.path.unlink(missing_ok=True)
+
+class _LogBlob:
+    """Запись blob: место тела в сегменте вместо самих байт."""
+    __slots__ = ("segment", "offset", "size", "ref_count")
+
+    def __init__(self, segment: Optional[_Segment], offset: int, size: int, ref_count: int):
+        self.segment = segment
+        self.offset = offset
+        self.size = size
+        self.ref_count = ref_count
+
+    @property
+    def data(self) -> bytes:
+        return self.segment.read(self.offset, self.size)
+
+    def view(self) -> memoryview:
+        return self.segment.view(self.offset, self.size)
+
+    def referenced(self, delta: int) -> "_LogBlob":
+        return _LogBlob(self.segment, self.offset, self.size, self.ref_count + delta)
+
+
+class LogBackend(MemoryBackend):
+    """Образ в журнале сегментов только на дописывание: состояние образа и индекс blob -> (сегмент, смещение, длина)
+    держатся в памяти (таблицы MemoryBackend), а на диск только дописываются записи.
+
+    Тело нового blob сразу дописывается в активный сегмент, фиксация дописывает одну запись META с текущими значениями
+    измененных транзакцией ключей; запись с целой контрольной суммой применяется при открытии целиком, недописанная
+    отбрасывается. Чтение идет из отображенных в память сегментов без системных вызовов. Фоновое уплотнение переносит
+    живые блоки из сегментов, где их мало, пишет контрольную точку состояния без журнала операций и удаляет освобожденные сегменты.
+    Фиксация не вызывает fsync (как synchronous=NORMAL в SQLite): сегмент сбрасывается на диск при запечатывании,
+    уплотнении и закрытии."""
+
+    name = "log"
+
+    def __init__(self, directory: Path, segment_size: int = SEGMENT_SIZE, compact_interval: Optional[float] = COMPACT_INTERVAL):
+        super().__init__()
+        self.directory = Path(directory)
+        self.segment_size = segment_size
+        self.compact_interval = compact_interval  # None - без фонового уплотнения, только compact()
+        self.segments: Dict[int, _Segment] = {}
+        self.logger = None
+        self._active: Optional[_Segment] = None
+        self._next_segment = 1
+        self._codecs = {
+            "inode": (self.inodes, lambda stat: list(stat[1:]), lambda key, value: Stat(key, *value)),
+            "dentry": (self.dentries, None, None),
+            "blob": (self.blobs, lambda blob: [blob.segment.number, blob.offset, blob.size, blob.ref_count],
+                     lambda key, value: _LogBlob(self.segments.get(value[0]), *value[1:])),
+            "extents": (self.extent_map, lambda extents: sorted(extents.items()), lambda key, value: {idx: blob for idx, blob in value}),
+            "usage": (self.dir_usage, self._encode_usage, lambda key, value: _Usage(*value)),
+            "owner": (self.owners, self._encode_usage, lambda key, value: _Usage(*value)),
+            "journal": (self.journal_records, list, lambda key, value: tuple(value)),
+            "access": (self.access_stats, lambda stats: [stats.count, stats.last_access, stats.last_user], lambda key, value: _Access(*value)),
+        }
+        self._tables = {id(table): name for name, (table, _, _) in self._codecs.items()}
+        # производные таблицы строятся при открытии: дерево по dentries, полнотекстовый индекс заново из блоков
+        self._tables.update({id(table): None for table in (self.parents, self.listing, self.content_index, self.content_docs, self.content_stale)})
+        # журнал только дописывается: его записи идут в META своей фиксации, а не в контрольную точку
+        self._checkpointed = [name for name in self._codecs if name != "journal"]
+        self._journal_segments: Dict[int, int] = {}  # номер записи журнала -> сегмент с её записью META
+        self._extent_owner: Dict[int, int] = {}  # id словаря блоков файла -> инод
+        self._dirty: Dict[Tuple[str, object], None] = {}  # (таблица, ключ), измененные после последней фиксации
+        self._txn_lock = threading.Lock()  # уплотнение идет между транзакциями
+        self._commits = 0
+        self._compacted_at = 0
+        self._compact_wake = threading.Event()
+        self._compactor: Optional[threading.Thread] = None
+        self._closed = False
+
+    @staticmethod
+    def _encode_usage(usage: _Usage) -> list:
+        return [usage.files, usage.directories, usage.bytes, usage.max_bytes, usage.max_entries]
+
+    def init_schema(self, logger):
+        if self.logger is not None:
+            return
+        self.logger = logger
+        self._load()
+        if self.compact_interval is None:
+            return
+        self._compactor = threading.Thread(target=self._compact_loop, name="tnfs-compactor", daemon=True)
+        self._compactor.start()
+
+    def close(self):
+        self._closed = True
+        self._compact_wake.set()
+        if self._compactor is not None and self._compactor is not threading.current_thread():
+            self._compactor.join()
+        with self._lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments.clear()
+            self._active = None
+
+    # --- открытие: повтор записей сегментов
+
+    def _segment_path(self, number: int) -> Path:
+        return self.directory / f"{number:08d}{SEGMENT_SUFFIX}"
+
+    def _load(self):
+        """Восстанавливает состояние образа повтором записей META и CHECKPOINT всех сегментов по порядку."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        numbers = sorted(int(path.stem) for path in self.directory.glob(f"*{SEGMENT_SUFFIX}") if path.stem.isdigit())
+        for number in numbers:
+            segment = _Segment(number, self._segment_path(number))
+            if not segment.size:
+                segment.remove()
+                continue
+            self.segments[number] = segment
+        for segment in self.segments.values():
+            for kind, offset, length in segment.records():
+                if kind == CHECKPOINT:
+                    self._reset()
+                if kind != DATA:
+                    for table, key, value in json.loads(segment.read(offset, length)):
+                        self._apply(table, key, value)
+                        if table == "journal":
+                            self._place_journal(key, value, segment.number)
+            if segment.valid < segment.size:
+                if segment.read(segment.valid, segment.size - segment.valid).strip(b"\0"):
+                    self.logger.warning(f"Segment {segment.path.name} has a damaged tail: {segment.size - segment.valid} bytes after offset {segment.valid} discarded")
+                segment.truncate(segment.valid)
+        self._next_segment = max(numbers, default=0) + 1
+        for (parent, name), inode in self.dentries.items():
+            self.parents[inode] = (parent, name)
+            self.listing.setdefault(parent, []).append(name)
+        for names in self.listing.values():
+            names.sort()
+        self._next_inode = max(self.inodes, default=0) + 1
+        self._next_journal = max(self.journal_records, default=0) + 1
+        # индекс не хранится в сегментах: все файлы переиндексируются из блоков при первом поиске
+        for inode, stat in self.inodes.items():
+            if stat.type == "file":
+                self.content_stale[inode] = True
+        if self.segments:
+            self.logger.info(f"TNFS log loaded: {len(self.segments)} segments, {len(self.inodes)} inodes, {len(self.blobs)} blobs")
+
+    def _reset(self):
+        for name in self._checkpointed:
+            self._codecs[name][0].clear()
+        self._extent_owner.clear()
+
+    def _place_journal(self, key: int, value, number: int):
+        if value is None:
+            self._journal_segments.pop(key, None)
+        else:
+            self._journal_segments[key] = number
+
+    def _apply(self, table: str, key, value):
+        """Применяет запись [таблица, ключ, значение] из сегмента; значение None удаляет ключ."""
+        if isinstance(key, list):
+            key = tuple(key)
+        if table == "extent":
+            inode, idx = key
+            extents = self.extent_map.get(inode)
+            if value is not None:
+                if extents is None:
+                    extents = self.extent_map[inode] = {}
+                    self._extent_owner[id(extents)] = inode
+                extents[idx] = value
+            elif extents is not None:
+                extents.pop(idx, None)
+            return
+        if table not in self._codecs:  # производные таблицы из сегментов прежних версий
+            return
+        target, _, decode = self._codecs[table]
+        if value is None:
+            target.pop(key, None)
+            return
+        target[key] = decode(key, value) if decode else value
+        if table == "extents":
+            self._extent_owner[id(target[key])] = key
+
+    # --- запись: учет измененных ключей и дописывание
+
+    def _set(self, table: dict, key, value):
+        super()._set(table, key, value)
+        self._touch(table, key, value)
+
+    def _pop(self, table: dict, key):
+        self._touch(table, key, None)
+        return super()._pop(table, key)
+
+    def _touch(self, table: dict, key, value):
+        name = self._tables.get(id(table), _MISSING)
+        if name is _MISSING:  # словарь блоков одного файла
+            self._dirty[("extent", (self._extent_owner[id(table)], key))] = None
+        elif name is not None:
+            if name == "extents" and value is not None:
+                self._extent_owner[id(value)] = key
+            self._dirty[(name, key)] = None
+
+    def _encode(self, table: str, key) -> list:
+        """Запись [таблица, ключ, текущее значение] для сегмента; None - ключ удален."""
+        if table == "extent":
+            inode, idx = key
+            return [table, key, self.extent_map.get(inode, {}).get(idx)]
+        target, encode, _ = self._codecs[table]
+        value = target.get(key)
+        return [table, key, None if value is None else encode(value) if encode else value]
+
+    def _append(self, kind: int, payload) -> Tuple[_Segment, int]:
+        """Дописывает запись в активный сегмент (под self._lock); заполненный сегмент запечатывается и будит уплотнение."""
+        segment = self._active
+        if segment is None or not segment.fits(len(payload)):
+            if segment is not None:
+                segment.seal()
+                self._compact_wake.set()
+            number = self._next_segment
+            self._next_segment += 1
+            segment = _Segment(number, self._segment_path(number), max(self.segment_size, RECORD_HEADER.size + len(payload)))
+            self.segments[number] = segment
+            self._active = segment
+        return segment, segment.append(kind, payload)
+
+    def _new_blob(self, data: bytes) -> _LogBlob:
+        segment, offset = self._append(DATA, data)
+        return _LogBlob(segment, offset, len(data), 1)
+
+    def begin(self):
+        self._txn_lock.acquire()
+        super().begin()
+
+    def commit(self):
+        with self._lock:
+            if self._dirty:
+                changes = [self._encode(table, key) for table, key in self._dirty]
+                segment, _ = self._append(META, json.dumps(changes, separators=(",", ":")).encode())
+                for table, key, value in changes:
+                    if table == "journal":
+                        self._place_journal(key, value, segment.number)
+                self._dirty = {}
+                self._commits += 1
+        held = self._undo is not None
+        super().commit()
+        if held:
+            self._txn_lock.release()
+
+    def rollback(self):
+        self._dirty = {}
+        super().rollback()
+
+    # --- чтение из отображенных сегментов
+
+    def chunks(self, inode: int, first: int = 0, last: Optional[int] = None) -> bytes:
+        # одна копия: join собирает bytes прямо из представлений отображения, без промежуточных bytes на блок.
+        # Сами представления наружу не отдаются: seal и уплотнение закрывают отображение, а mmap.close при живых
+        # представлениях падает с BufferError
+        with self._lock:
+            return b"".join([self.blobs[blob].view() for _, blob in self.extents(inode, first, last)])
+
+    def check_image(self) -> List[str]:
+        problems = super().check_image()
+        with self._lock:
+            for blob, record in self.blobs.items():
+                if record.segment is None or self.segments.get(record.segment.number) is not record.segment:
+                    problems.append(f"blob {blob[:12]} points to a missing segment")
+        return problems
+
+    def image_size(self) -> Tuple[int, int]:
+        with self._lock:
+            return sum(segment.size for segment in self.segments.values()), 0
+
+    def storage_stats(self) -> Dict:
+        stats = super().storage_stats()
+        with self._lock:
+            stats["segments"] = len(self.segments)
+            stats["segment_bytes"] = sum(segment.size for segment in self.segments.values())
+        return stats
+
+    # --- уплотнение
+
+    def _compact_loop(self):
+        while not self._closed:
+            self._compact_wake.wait(self.compact_interval)
+            self._compact_wake.clear()
+            if self._closed or self._commits == self._compacted_at or len(self.segments) < 2:
+                continue
+            try:
+                freed = self.compact(timeout=self.compact_interval)
+                if freed:
+                    self.logger.info(f"TNFS log compacted: {freed} bytes reclaimed")
+            except Exception as e:
+                self.logger.error(f"TNFS log compaction failed: {e}")
+
+    def compact(self, force: bool = False, timeout: float = -1) -> int:
+        """Переносит живые blobs из запечатанных сегментов, где они занимают меньше COMPACT_LIVE_RATIO (force - из всех),
+        в активный сегмент, дописывает контрольную точку состояния и удаляет освобожденные сегменты. Идет между
+        транзакциями; читатели не ждут переноса. Возвращает число освобожденных байт."""
+        if not self._txn_lock.acquire(timeout=timeout):
+            return 0
+        try:
+            with self._lock:
+                self._compacted_at = self._commits
+                live: Dict[int, int] = {}
+                for record in self.blobs.values():
+                    if record.segment is not None:
+                        live[record.segment.number] = live.get(record.segment.number, 0) + record.size
+                victims = [segment for segment in self.segments.values()
+                           if segment is not self._active and (force or live.get(segment.number, 0) < segment.size * COMPACT_LIVE_RATIO)]
+                if not victims:
+                    return 0
+                numbers = {segment.number for segment in victims}
+                moving = [blob for blob, record in self.blobs.items() if record.segment is not None and record.segment.number in numbers]
+            for blob in moving:
+                with self._lock:
+                    record = self.blobs[blob]
+                    segment, offset = self._append(DATA, record.view())
+                    self.blobs[blob] = _LogBlob(segment, offset, record.size, record.ref_count)
+            with self._lock:
+                # записи журнала из удаляемых сегментов переносятся одной записью META, остальные остаются на месте
+                journal = [self._encode("journal", key) for key, number in self._journal_segments.items() if number in numbers]
+                if journal:
+                    segment, _ = self._append(META, json.dumps(journal, separators=(",", ":")).encode())
+                    for _, key, value in journal:
+                        self._place_journal(key, value, segment.number)
+                state = [self._encode(table, key) for table in self._checkpointed for key in list(self._codecs[table][0])]
+                self._append(CHECKPOINT, json.dumps(state, separators=(",", ":")).encode())
+                self._active.flush()
+                self._dirty = {}
+                freed = 0
+                for segment in victims:
+                    freed += segment.size
+                    segment.remove()
+                    del self.segments[segment.number]
+            return freed
+        finally:
+            self._txn_lock.release()
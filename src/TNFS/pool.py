@@ -0,0 +1,129 @@
+#TNFS reader pool
+#created by SKATT
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+READER_POOL_SIZE = 8  # число читающих соединений по умолчанию
+BUSY_TIMEOUT = 10.0  # сколько секунд ждать блокировку SQLite или свободного читателя
+
+class ReaderPool:
+    """Пул read-only соединений SQLite: каждый поток берет свое соединение и читает снимок WAL."""
+
+    def __init__(self, db_path: Path, size: int = READER_POOL_SIZE, busy_timeout: float = BUSY_TIMEOUT):
+        self.db_path = Path(db_path)
+        self.size = max(1, size)
+        self.busy_timeout = busy_timeout
+        self.opened = 0
+        self.waits = 0
+        self._idle = queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(f"{self.db_path.as_uri()}?mode=ro", uri=True, timeout=self.busy_timeout, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self.opened < self.size:
+                self.opened += 1
+                return self._open()
+            self.waits += 1
+        try:
+            return self._idle.get(timeout=self.busy_timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"No free TNFS reader connection after {self.busy_timeout}s")
+
+    @contextmanager
+    def connection(self):
+        """Выдает соединение текущему потоку; вложенные вызовы в том же потоке получают то же соединение."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._acquire()
+        self._local.conn = conn
+        conn.execute("BEGIN")  # один согласованный снимок на все чтения потока
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+            self._local.conn = None
+            self._idle.put(conn)
+
+    def stats(self) -> dict:
+        return {"size": self.size, "opened": self.opened, "idle": self._idle.qsize(), "waits": self.waits}
+
+    def close(self):
+        """Закрывает свободные соединения пула."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self.opened -= 1
+
+class WriterLock:
+    """Реентерабельная блокировка единственного писателя TNFS. В групповом режиме писатель держит ее между операциями,
+    пока фиксация отложена; park() помечает такое удержание, и take_idle() из другого потока (таймер
+    group_commit_latency) забирает блокировку у простаивающего владельца, чтобы зафиксировать группу за него."""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._count = 0
+        self._parked = False
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._count += 1
+                return True
+            if self._owner is not None:
+                if not blocking or not self._cond.wait_for(lambda: self._owner is None, None if timeout < 0 else timeout):
+                    return False
+            self._owner = me
+            self._count = 1
+            return True
+
+    def release(self):
+        with self._cond:
+            if self._owner != threading.get_ident():
+                raise RuntimeError("cannot release un-acquired lock")
+            self._count -= 1
+            if not self._count:
+                self._owner = None
+                self._parked = False
+                self._cond.notify()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def park(self):
+        """Владелец оставляет за собой отложенную фиксацию: когда у него останется один захват, блокировку можно забрать."""
+        with self._cond:
+            self._parked = self._owner == threading.get_ident()
+
+    def take_idle(self) -> Optional[int]:
+        """Передает блокировку текущему потоку, если владелец простаивает с отложенной фиксацией (один захват).
+        Возвращает прежнего владельца или None, если блокировку забрать нельзя."""
+        with self._cond:
+            if not self._parked or self._count != 1:
+                return None
+            owner, self._owner = self._owner, threading.get_ident()
+            self._parked = False
+            return owner
@@ -0,0 +1,72 @@
+#TNFS snapshots
+#created by SKATT
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+SNAPSHOT_STEP_PAGES = 1024  # страниц, которые online backup копирует за один шаг
+SNAPSHOT_SUFFIX = ".db"
+PARTIAL_SUFFIX = ".part"  # недописанный снимок; при сбое остается только он
+
+class SnapshotCancelled(Exception):
+    """Создание снимка отменено; недописанный файл удаляется."""
+
+class SnapshotJob(threading.Thread):
+    """Фоновое создание снимка: online backup API SQLite копирует образ шагами из одного снимка WAL."""
+
+    def __init__(self, db_path: Path, target: Path, busy_timeout: float, logger, step_pages: int = SNAPSHOT_STEP_PAGES):
+        super().__init__(name=f"tnfs-snapshot-{target.stem}")
+        self.logger = logger
+        self.db_path = Path(db_path)
+        self.target = Path(target)
+        self.partial = self.target.with_name(self.target.name + PARTIAL_SUFFIX)
+        self.busy_timeout = busy_timeout
+        self.step_pages = step_pages
+        self.total = 0
+        self.remaining = 0
+        self.started = time.time()
+        self.error: Optional[BaseException] = None
+        self._cancel = threading.Event()
+
+    def run(self):
+        source = sqlite3.connect(f"{self.db_path.as_uri()}?mode=ro", uri=True, timeout=self.busy_timeout, check_same_thread=False)
+        target = None
+        try:
+            # открытая транзакция чтения фиксирует снимок: параллельные записи писателя не перезапускают копирование
+            source.execute("BEGIN")
+            source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            target = sqlite3.connect(self.partial)
+            source.backup(target, pages=self.step_pages, progress=self._progress, sleep=0)
+            target.execute("PRAGMA journal_mode=DELETE")  # снимок - один самодостаточный файл без -wal
+            target.close()
+            target = None
+            os.utime(self.partial, (self.started, self.started))  # время снимка - момент, на который снят образ
+            os.replace(self.partial, self.target)
+            self.logger.info(f"Snapshot created: {self.target.stem} ({self.total} pages in {time.time() - self.started:.1f}s)")
+        except BaseException as e:
+            self.error = e
+            if target is not None:
+                target.close()
+            self.partial.unlink(missing_ok=True)
+            if isinstance(e, SnapshotCancelled):
+                self.logger.info(str(e))
+            else:
+                self.logger.error(f"Snapshot failed: {self.target.stem}: {e}")
+        finally:
+            source.close()
+
+    def _progress(self, status: int, remaining: int, total: int):
+        self.total = total
+        self.remaining = remaining
+        if self._cancel.is_set():
+            raise SnapshotCancelled(f"Snapshot cancelled: {self.target.stem}")
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def done(self) -> int:
+        return self.total - self.remaining
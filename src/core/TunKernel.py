@@ -1,7 +1,7 @@
 #Kernel TunderOS
 #created by SKATT
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional
 import os
 import sys
 INIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -9,6 +9,7 @@ sys.path.append(INIT_DIR)
 from TNFS.TNFS import TNFS
 from core.users import UserManager
 from security.SELinux import SELinux
+from utils.TunRecovery import TunRecovery
 from libs.logging import Logger
 from libs.CrashHandler import CrashHandler
 
@@ -21,12 +22,41 @@ class Kernel:
         self.selinux = SELinux(self.logger, self.crash_handler, self.tnfs)
         self.tnfs.selinux = self.selinux
         self.user_manager.tnfs = self.tnfs
+        self.recovery = TunRecovery(self.logger, self.crash_handler, self.tnfs.db_path)
+        self.recovery.attach(self.tnfs)
         self.processes = {}
         self.memory = {}
         self.next_pid = 1
         self.running = True
         self.logger.info("Kernel initialized")
 
+    def flush(self):
+        self.tnfs.flush()
+
+    def transaction(self):
+        return self.tnfs.transaction()
+
+    def begin(self):
+        self.tnfs.begin()
+
+    def commit(self):
+        self.tnfs.commit()
+
+    def rollback(self):
+        self.tnfs.rollback()
+
+    def shutdown(self):
+        if self.tnfs.transaction_active:
+            self.logger.warning("Rolling back uncommitted TNFS transaction on shutdown")
+            self.tnfs.rollback()
+        self.tnfs.flush_access_stats()
+        self.tnfs.snapshot_wait()
+        self.recovery.detach(self.tnfs)
+        self.tnfs.close()
+        self.selinux.close()
+        self.running = False
+        self.logger.info("Kernel shutdown")
+
     def login(self, username: str, password: str) -> bool:
         return self.user_manager.login(username, password)
 
@@ -54,44 +84,97 @@ class Kernel:
     def read_file(self, path: str) -> str:
         return self.tnfs.read_file(path)
 
+    def open(self, path: str, mode: str = "r"):
+        return self.tnfs.open(path, mode)
+
     def create_file(self, path: str, content: str):
         self.tnfs.create_file(path, content)
 
     def create_directory(self, path: str):
         self.tnfs.create_directory(path)
 
-    def remove(self, path: str):
-        self.tnfs.remove(path)
+    def remove(self, path: str, recursive: bool = False):
+        self.tnfs.remove(path, recursive=recursive)
 
     def chmod(self, path: str, perms: int):
         self.tnfs.chmod(path, perms)
 
     def rename(self, old_path: str, new_path: str):
-        cursor = self.tnfs.db.execute("SELECT type FROM files WHERE path = ?", (old_path,))
-        result = cursor.fetchone()
+        result = self.tnfs.path_type(old_path)
         if not result:
             self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Path not found: {old_path}")
-        if result[0] == "directory":
+        if result == "directory":
             self.tnfs.rename_directory(old_path, new_path)
         else:
             self.tnfs.rename_file(old_path, new_path)
 
-    def copy(self, src_path: str, dst_path: str):
-        cursor = self.tnfs.db.execute("SELECT type FROM files WHERE path = ?", (src_path,))
-        result = cursor.fetchone()
+    def copy(self, src_path: str, dst_path: str, progress=None, cancel=None) -> bool:
+        result = self.tnfs.path_type(src_path)
         if not result:
             self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Path not found: {src_path}")
-        if result[0] == "directory":
-            self.tnfs.copy_directory(src_path, dst_path)
-        else:
-            self.tnfs.copy_file(src_path, dst_path)
+        if result == "directory":
+            return self.tnfs.copy_directory(src_path, dst_path, progress=progress, cancel=cancel)
+        return self.tnfs.copy_file(src_path, dst_path)
+
+    def walk(self, path: str = "/", order: str = "pre"):
+        return self.tnfs.walk(path, order=order)
+
+    def du(self, path: str, stored: bool = False) -> Dict:
+        return self.tnfs.du(path, stored)
+
+    def df(self) -> Dict:
+        return self.tnfs.df()
+
+    def set_quota(self, target: str, max_bytes: Optional[int] = None, max_entries: Optional[int] = None):
+        self.tnfs.set_quota(target, max_bytes, max_entries)
+
+    def quotas(self) -> List[Dict]:
+        return self.tnfs.quotas()
+
+    def fsck(self, path: str = "/") -> List[str]:
+        return self.tnfs.fsck(path)
+
+    def grep(self, pattern: str, path: str = "/"):
+        return self.tnfs.grep(pattern, path)
+
+    def find(self, path: str, name: str = "*") -> List[str]:
+        return self.tnfs.find(path, name)
+
+    def import_tree(self, host_dir: str, tnfs_path: str, progress=None, cancel=None) -> int:
+        return self.tnfs.import_tree(host_dir, tnfs_path, progress=progress, cancel=cancel)
+
+    def export_tree(self, tnfs_path: str, target: str, progress=None) -> int:
+        return self.tnfs.export_tree(tnfs_path, target, progress=progress)
+
+    def snapshot_create(self, name: str, wait: bool = False):
+        return self.tnfs.snapshot_create(name, wait)
+
+    def snapshot_list(self) -> List[Dict]:
+        return self.tnfs.snapshot_list()
+
+    def snapshot_restore(self, name: str, progress=None) -> bool:
+        return self.tnfs.snapshot_restore(name, progress)
+
+    def snapshot_delete(self, name: str) -> bool:
+        return self.tnfs.snapshot_delete(name)
+
+    def compress(self, progress=None, cancel=None) -> Dict:
+        return self.tnfs.compress(progress, cancel)
+
+    def storage_stats(self) -> Dict:
+        return self.tnfs.storage_stats()
+
+    def set_read_journal(self, mode: str):
+        self.tnfs.set_read_journal(mode)
+
+    def hot_files(self, limit: int = 10, operation: str = "read") -> List:
+        return self.tnfs.hot_files(limit, operation)
 
     def move(self, src_path: str, dst_path: str):
-        cursor = self.tnfs.db.execute("SELECT type FROM files WHERE path = ?", (src_path,))
-        result = cursor.fetchone()
+        result = self.tnfs.path_type(src_path)
         if not result:
             self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Path not found: {src_path}")
-        if result[0] == "directory":
+        if result == "directory":
             self.tnfs.move_directory(src_path, dst_path)
         else:
             self.tnfs.move_file(src_path, dst_path)
\ No newline at end of file
@@ -101,7 +101,8 @@ class CrashHandler:
             "0xFNF0ERR": "File not found",
             "0xPNF0ERR": "Path not found",
             "0xPDN0ERR": "Permission denied",
-            "0xDNE0ERR": "Directory not empty"
+            "0xDNE0ERR": "Directory not empty",
+            "0xQEX0ERR": "Quota exceeded"
         },
         "SHELL": {
             "0xS0UNF0ERR": "User not found",
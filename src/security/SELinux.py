@@ -3,8 +3,9 @@
 import json
 import sqlite3
 import time
+import threading
 from pathlib import Path
-from typing import List, Optional, Dict
+from typing import Iterator, List, Optional, Dict, Tuple
 import sys
 import os
 INIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -12,17 +13,24 @@ sys.path.append(INIT_DIR)
 from libs.logging import Logger
 from libs.CrashHandler import CrashHandler, TunderCrash
 from TNFS.TNFS import TNFS
+from security.policy import PolicyTrie
+from security.avc import AccessVectorCache
+from security.store import PolicyStore
+from security.audit import AuditWriter, AUDIT_COLUMNS, AUDIT_INDEXES, AUDIT_PAGE_SIZE, audit_filter, audit_row
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
 SELinux_CONFIG = BASE_DIR / "data" / "selinux.json"
 SELinux_DB = BASE_DIR / "data" / "selinux.db"
+SELinux_POLICIES_JSON = BASE_DIR / "data" / "selinux_policies.json"  # прежнее хранилище политики; переносится в selinux.db
 
 class SELinux:
-    def __init__(self, logger: Logger, crash_handler: CrashHandler, tnfs: TNFS):
+    def __init__(self, logger: Logger, crash_handler: CrashHandler, tnfs: TNFS, db_path: Optional[Path] = None, audit_collapse: bool = True):
         self.logger = logger
         self.crash_handler = crash_handler
         self.tnfs = tnfs
-        self.db = sqlite3.connect(BASE_DIR / "data" / "selinux.db", timeout=10)
+        self.db_path = Path(db_path) if db_path else SELinux_DB
+        self.db = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+        self._db_lock = threading.Lock()
         self.db.execute("""
             CREATE TABLE IF NOT EXISTS selinux_audit (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -33,9 +41,16 @@ class SELinux:
                 operation TEXT,
                 result TEXT CHECK(result IN ('granted', 'denied')),
                 timestamp REAL,
-                mode TEXT CHECK(mode IN ('enforcing', 'permissive'))
+                mode TEXT CHECK(mode IN ('enforcing', 'permissive')),
+                count INTEGER DEFAULT 1
             )
         """)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(selinux_audit)")]
+        if "count" not in columns:
+            self.db.execute("ALTER TABLE selinux_audit ADD COLUMN count INTEGER DEFAULT 1")
+        for name, columns in AUDIT_INDEXES.items():
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS {name} ON selinux_audit ({columns})")
+        self.audit = AuditWriter(self.db, self._db_lock, self.logger, collapse=audit_collapse)
         self.policies = {
             "mode": "enforcing",
             "rules": {
@@ -47,15 +62,24 @@ class SELinux:
                 "/tmp": {"read": ["root", "user", "guest"], "write": ["root", "user", "guest"], "execute": ["root", "user", "guest"], "delete": ["root", "user", "guest"], "type": "directory"}
             }
         }
-        try:
-            with open(BASE_DIR / "data" / "selinux_policies.json", "r") as f:
-                self.policies = json.load(f)
-        except FileNotFoundError:
-            with open(BASE_DIR / "data" / "selinux_policies.json", "w") as f:
-                json.dump(self.policies, f, indent=2)
+        self.store = PolicyStore(self.db, self._db_lock)
+        stored = self.store.load()
+        if stored is not None:
+            self.policies = stored
+        else:
+            legacy = self.db_path.with_name(SELinux_POLICIES_JSON.name)  # прежний файл лежит рядом с базой
+            if legacy.exists():
+                with open(legacy, "r") as f:
+                    self.policies = json.load(f)
+            self.store.save_rules(self.policies["rules"], self.policies["mode"], replace=True)
+            if legacy.exists():
+                # файл больше не читается; переименование не дает править его вместо живой политики
+                legacy.rename(legacy.with_name(legacy.name + ".migrated"))
+                self.logger.info(f"Migrated SELinux policies from {legacy.name} to {self.db_path.name}")
         self.mode = self.policies["mode"]
-        self.db.commit()
-        self.logger.info("Loaded SELinux policies")
+        self.compiled = PolicyTrie(self.policies["rules"])
+        self.avc = AccessVectorCache()
+        self.logger.info(f"Loaded SELinux policies: {self.compiled.size} rules compiled")
         #self.logger.debug(f"Initial policies: {self.policies}")
         self.logger.info(f"SELinux initialized in {self.mode} mode")
 
@@ -63,77 +87,62 @@ class SELinux:
         """Устанавливает режим SELinux (enforcing или permissive)."""
         if mode not in ["enforcing", "permissive"]:
             self.crash_handler.raise_crash("SELINUX", "0xSIM0ERR", f"Invalid SELinux mode: {mode}")
+        self.store.save_mode(mode)
         self.mode = mode
         self.policies["mode"] = mode
-        with open(BASE_DIR / "data" / "selinux_policies.json", "w") as f:
-            json.dump(self.policies, f, indent=2)
-        self.db.commit()
+        self.avc.invalidate()
         self.logger.info(f"SELinux mode set to {mode}")
 
-    def check_access(self, path: str, operation: str, username: str, role: str, session_id: int) -> bool:
-        """Проверяет доступ к пути на основе SELinux-политик."""
-        self.logger.info(f"Checking SELinux access: path={path}, operation={operation}, username={username}, role={role}, session_id={session_id}")
-        
-        if operation != "write" and self.tnfs:
-            with self.tnfs.db:
-                cursor = self.tnfs.db.execute("SELECT path, type FROM files WHERE path = ?", (path,))
-                if not cursor.fetchone():
-                    self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Path not found: {path}")
-
-        result = False
-        parent_dir = os.path.dirname(path) or "/"
-
-        if path in self.policies["rules"]:
-            if operation in self.policies["rules"][path] and role in self.policies["rules"][path][operation]:
-                result = True
-            elif role == "root":
-                result = True
-        else:
-            if parent_dir in self.policies["rules"]:
-                if operation in self.policies["rules"][parent_dir] and role in self.policies["rules"][parent_dir][operation]:
-                    result = True
-                elif role == "root":
-                    result = True
+    def check_access(self, path: str, operation: str, username: str, role: str, session_id: int, stat=None) -> bool:
+        """Проверяет доступ к пути на основе SELinux-политик; stat - уже найденная TNFS запись пути, тогда TNFS не опрашивается.
+        Решение политики берется из AVC; дерево правил обходится и решение логируется только при промахе.
+        Событие аудита только ставится в очередь AuditWriter."""
+        if operation != "write" and self.tnfs and stat is None:
+            if self.tnfs.stat(path) is None:
+                self.crash_handler.raise_crash("FS", "0xFNF0ERR", f"Path not found: {path}")
 
-        self.logger.info(
-            f"SELinux policy check for {path}/{operation}: result={result}, "
-            f"policies={self.policies['rules'].get(path, self.policies['rules'].get(parent_dir, {}))}"
-        )
+        result = self.avc.get(role, path, operation)
+        computed = result is None
+        if computed:
+            self.logger.info(f"Checking SELinux access: path={path}, operation={operation}, username={username}, role={role}, session_id={session_id}")
+            # поколение читается до обхода: решение по политике, которую успели изменить, в кэш не попадет
+            generation = self.avc.generation
+            # самое точное правило пути из скомпилированного дерева; root допускается любым найденным правилом
+            rule = self.compiled.match(path)
+            result = rule is not None and (role == "root" or rule.allows(operation, self.compiled.role_bit(role)))
+            self.avc.put(role, path, operation, result, generation)
+            self.logger.info(
+                f"SELinux policy check for {path}/{operation}: result={result}, "
+                f"rule={rule.pattern if rule else None}: {self.policies['rules'].get(rule.pattern, {}) if rule else {}}"
+            )
 
         if self.mode == "permissive":
             result = True
 
-        with self.db:
-            self.db.execute(
-                "INSERT INTO selinux_audit (session_id, username, role, path, operation, result, timestamp, mode) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (session_id, username, role, path, operation, "granted" if result else "denied", time.time(), self.mode)
-            )
+        self.audit.record((session_id, username, role, path, operation, "granted" if result else "denied", time.time(), self.mode))
 
         if not result and self.mode == "enforcing":
             self.crash_handler.raise_crash("SELINUX", "0xSAD0ERR", f"Denied {operation} on {path} for {username} ({role})")
 
-        self.logger.info(f"SELinux access {'granted' if result else 'denied'}: {operation} on {path} for {username} ({role})")
+        if computed or not result:
+            self.logger.info(f"SELinux access {'granted' if result else 'denied'}: {operation} on {path} for {username} ({role})")
         return result
 
     def add_rule(self, path: str, operation: str, roles: List[str], type_: str):
         """Добавляет новое правило SELinux."""
         self.logger.info(f"Adding SELinux rule: path={path}, operation={operation}, roles={roles}, type={type_}")
         if self.tnfs:
-            with self.tnfs.db:
-                cursor = self.tnfs.db.execute("SELECT type FROM files WHERE path = ?", (path,))
-                result = cursor.fetchone()
-                if not result and path not in self.policies["rules"]:
-                    self.logger.info(f"Path {path} not found in TNFS, allowing rule addition for future file")
-        if path not in self.policies["rules"]:
-            self.policies["rules"][path] = {"read": [], "write": [], "execute": [], "delete": [], "type": type_}
-        if operation not in self.policies["rules"][path]:
-            self.policies["rules"][path][operation] = []
-        self.policies["rules"][path][operation].extend(roles)
-        self.policies["rules"][path][operation] = list(set(self.policies["rules"][path][operation]))
-        with open(BASE_DIR / "data" / "selinux_policies.json", "w") as f:
-            json.dump(self.policies, f, indent=2)
-        self.db.commit()
+            result = self.tnfs.path_type(path)
+            if not result and path not in self.policies["rules"]:
+                self.logger.info(f"Path {path} not found in TNFS, allowing rule addition for future file")
+        rule = self.policies["rules"].get(path, {"read": [], "write": [], "execute": [], "delete": [], "type": type_})
+        rule = {key: list(value) if isinstance(value, list) else value for key, value in rule.items()}
+        rule[operation] = list(set(rule.get(operation, []) + list(roles)))
+        # сначала запись в базу: если она не удалась, память не расходится с сохраненной политикой
+        self.store.save_rule(path, rule)
+        self.policies["rules"][path] = rule
+        self.compiled.set(path, rule)
+        self.avc.invalidate()
         self.logger.info(f"Updated policies: {self.policies['rules'][path]}")
         self.logger.info(f"Added SELinux rule: {operation} on {path} for roles {roles}")
 
@@ -142,14 +151,19 @@ class SELinux:
         self.logger.info(f"Removing SELinux rule: path={path}, operation={operation}, roles={roles}")
         if path not in self.policies["rules"] or operation not in self.policies["rules"][path]:
             self.crash_handler.raise_crash("SELINUX", "0xSRN0ERR", f"No rule found for {operation} on {path}")
-        self.policies["rules"][path][operation] = [r for r in self.policies["rules"][path][operation] if r not in roles]
-        if not self.policies["rules"][path][operation]:
-            del self.policies["rules"][path][operation]
-        if not self.policies["rules"][path]:
+        rule = dict(self.policies["rules"][path])
+        rule[operation] = [r for r in rule[operation] if r not in roles]
+        if not rule[operation]:
+            del rule[operation]
+        if rule:
+            self.store.save_rule(path, rule)
+            self.policies["rules"][path] = rule
+            self.compiled.set(path, rule)
+        else:
+            self.store.delete_rule(path)
             del self.policies["rules"][path]
-        with open(BASE_DIR / "data" / "selinux_policies.json", "w") as f:
-            json.dump(self.policies, f, indent=2)
-        self.db.commit()
+            self.compiled.remove(path)
+        self.avc.invalidate()
         self.logger.info(f"Removed SELinux rule: {operation} on {path} for roles {roles}")
 
     def list_rules(self) -> Dict:
@@ -169,37 +183,114 @@ class SELinux:
                 "/tmp": {"read": ["root", "user", "guest"], "write": ["root", "user", "guest"], "execute": ["root", "user", "guest"], "delete": ["root", "user", "guest"], "type": "directory"}
             }
         }
+        self.store.save_rules(self.policies["rules"], self.policies["mode"], replace=True)
         self.mode = self.policies["mode"]
-        with open(BASE_DIR / "data" / "selinux_policies.json", "w") as f:
-            json.dump(self.policies, f, indent=2)
-        self.db.commit()
+        self.compiled = PolicyTrie(self.policies["rules"])
+        self.avc.invalidate()
         self.logger.info("SELinux policies reset to default")
 
-    def get_audit_logs(self) -> List[Dict]:
+    def load_policy(self, path: str, replace: bool = False) -> int:
+        """Загружает правила из JSON-файла хоста: {"mode": ..., "rules": {шаблон: правило}} или просто {шаблон: правило}.
+        Правило шаблона из файла заменяет прежнее; replace удаляет все правила, которых нет в файле. Все правила пишутся
+        одной транзакцией, дерево правил компилируется один раз. Возвращает число загруженных правил."""
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            self.crash_handler.raise_crash("SELINUX", "0xFNF0ERR", f"Policy file not found: {path}")
+        except (OSError, ValueError) as e:
+            self.crash_handler.raise_crash("SELINUX", "0xV0E0ERR", f"Invalid policy file {path}: {e}")
+        rules = data.get("rules") if isinstance(data, dict) and "rules" in data else data
+        mode = data.get("mode") if rules is not data else None
+        if mode is not None and mode not in ["enforcing", "permissive"]:
+            self.crash_handler.raise_crash("SELINUX", "0xSIM0ERR", f"Invalid SELinux mode: {mode}")
+        if not isinstance(rules, dict):
+            self.crash_handler.raise_crash("SELINUX", "0xV0E0ERR", f"Invalid policy file {path}: rules must be an object")
+        # весь файл проверяется до записи: неверное правило не оставляет политику загруженной наполовину
+        for pattern, rule in rules.items():
+            if not pattern.startswith("/") or not isinstance(rule, dict) or not all(
+                    key == "type" or (isinstance(roles, list) and all(isinstance(role, str) for role in roles)) for key, roles in rule.items()):
+                self.crash_handler.raise_crash("SELINUX", "0xV0E0ERR", f"Invalid policy rule for {pattern} in {path}")
+        self.store.save_rules(rules, mode, replace=replace)
+        merged = dict(rules) if replace else {**self.policies["rules"], **rules}
+        self.policies = {"mode": mode or self.mode, "rules": merged}
+        self.mode = self.policies["mode"]
+        self.compiled = PolicyTrie(merged)
+        self.avc.invalidate()
+        self.logger.info(f"Loaded {len(rules)} SELinux rules from {path}: {self.compiled.size} rules compiled")
+        return len(rules)
+
+    def flush_audit(self):
+        """Ждет записи всех поставленных в очередь событий аудита."""
+        self.audit.flush()
+
+    def close(self):
+        """Записывает очередь аудита, останавливает писателя и закрывает selinux.db."""
+        self.audit.close()
+        self.db.close()
+        self.logger.info("SELinux closed")
+
+    def _audit_filter(self, filters: Dict) -> Tuple[List[str], list]:
+        result = filters.get("result")
+        if result is not None and result not in ("granted", "denied"):
+            self.crash_handler.raise_crash("SELINUX", "0xV0E0ERR", f"Invalid audit result: {result}")
+        return audit_filter(**filters)
+
+    def query_audit_logs(self, limit: int = AUDIT_PAGE_SIZE, before: Optional[Tuple[float, int]] = None, **filters) -> Tuple[List[Dict], Optional[Tuple[float, int]]]:
+        """Страница записей аудита, новые первыми. filters: username, role, path (префикс), operation, result, since, until.
+        Возвращает записи и курсор (timestamp, id) следующей страницы или None, если записей больше нет.
+        Страницы идут по ключу (timestamp, id), а не по OFFSET, поэтому дальняя страница стоит столько же, сколько первая."""
+        if limit < 1:
+            self.crash_handler.raise_crash("SELINUX", "0xV0E0ERR", f"Invalid audit page size: {limit}")
+        where, params = self._audit_filter(filters)
+        if before is not None:
+            where.append("(timestamp, id) < (?, ?)")
+            params.extend(before)
+        self.flush_audit()
+        with self._db_lock:
+            rows = self.db.execute(
+                f"SELECT {', '.join(AUDIT_COLUMNS)} FROM selinux_audit {'WHERE ' + ' AND '.join(where) if where else ''} "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                params + [limit]
+            ).fetchall()
+        logs = [audit_row(row) for row in rows]
+        cursor = (logs[-1]["timestamp"], logs[-1]["id"]) if logs and len(logs) == limit else None
+        return logs, cursor
+
+    def iter_audit_logs(self, page_size: int = AUDIT_PAGE_SIZE, **filters) -> Iterator[Dict]:
+        """Потоково отдает записи аудита, новые первыми; в памяти держится одна страница."""
+        cursor = None
+        while True:
+            logs, cursor = self.query_audit_logs(page_size, cursor, **filters)
+            yield from logs
+            if cursor is None:
+                return
+
+    def follow_audit_logs(self, after_id: int = 0, interval: float = 1.0, **filters) -> Iterator[Dict]:
+        """Бесконечно отдает новые записи аудита с id больше after_id в порядке записи; без новых записей ждет interval секунд."""
+        where, params = self._audit_filter(filters)
+        where.append("id > ?")
+        while True:
+            self.flush_audit()
+            with self._db_lock:
+                rows = self.db.execute(
+                    f"SELECT {', '.join(AUDIT_COLUMNS)} FROM selinux_audit WHERE {' AND '.join(where)} ORDER BY id LIMIT ?",
+                    params + [after_id, AUDIT_PAGE_SIZE]
+                ).fetchall()
+            for row in rows:
+                after_id = row[0]
+                yield audit_row(row)
+            if len(rows) < AUDIT_PAGE_SIZE:
+                time.sleep(interval)
+
+    def get_audit_logs(self, **filters) -> List[Dict]:
+        """Все записи аудита, подходящие под filters, новые первыми. Для больших журналов - query_audit_logs или iter_audit_logs."""
         try:
-            with sqlite3.connect(BASE_DIR / "data" / "selinux.db", timeout=10) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT id, timestamp, username, role, session_id, path, operation, result, mode
-                    FROM selinux_audit
-                    ORDER BY timestamp DESC
-                """)
-                logs = [
-                    {
-                        "id": row[0],
-                        "timestamp": row[1],
-                        "username": row[2],
-                        "role": row[3],
-                        "session_id": row[4],
-                        "path": row[5],
-                        "operation": row[6],
-                        "result": row[7],
-                        "mode": row[8],
-                    }
-                    for row in cursor.fetchall()
-                ]
-                self.logger.info("Retrieved SELinux audit logs")
-                return logs
+            logs = list(self.iter_audit_logs(**filters))
+            self.logger.info("Retrieved SELinux audit logs")
+            return logs
+        except TunderCrash:
+            raise
         except Exception as e:
             self.crash_handler.handle(e, "Failed to retrieve SELinux audit logs")
-            return []
\ No newline at end of file
+            return []
@@ -0,0 +1,202 @@
+#SELinux audit writer
+#created by Antarctica
+import queue
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+AUDIT_QUEUE_SIZE = 65536  # событий в очереди; при полной очереди check_access ждет писателя
+AUDIT_BATCH_SIZE = 1024  # событий в одной транзакции писателя
+AUDIT_BATCH_LATENCY = 0.05  # секунд, которые писатель ждет новые события перед записью пакета
+AUDIT_PUT_TIMEOUT = 1.0  # секунд, которые granted ждет места в очереди; denied ждет всегда
+AUDIT_PAGE_SIZE = 100  # записей на страницу запроса аудита
+AUDIT_COLUMNS = ("id", "timestamp", "username", "role", "session_id", "path", "operation", "result", "mode", "count")
+# индекс -> столбцы; выборка по пользователю или результату идет по индексу уже в порядке времени
+AUDIT_INDEXES = {
+    "selinux_audit_timestamp": "timestamp",
+    "selinux_audit_username": "username, timestamp",
+    "selinux_audit_path": "path",
+    "selinux_audit_result": "result, timestamp",
+}
+
+# (session_id, username, role, path, operation, result, timestamp, mode)
+AuditEvent = Tuple[Optional[int], str, str, str, str, str, float, str]
+
+_STOP = object()
+
+class AuditWriter:
+    """Фоновая запись аудита SELinux в selinux_audit.
+
+    check_access только кладет событие в ограниченную очередь. Поток писателя забирает события пакетами и пишет каждый
+    пакет одной транзакцией через executemany, поэтому fsync приходится на пакет, а не на каждую проверку. Если включен
+    collapse, одинаковые granted события пакета (сессия, пользователь, роль, путь, операция, режим) становятся одной
+    строкой с count и временем последнего события. Отказы не склеиваются и не теряются: при полной очереди denied ждет
+    писателя, а granted ждет AUDIT_PUT_TIMEOUT и отбрасывается с предупреждением. После close события пишутся сразу."""
+
+    def __init__(self, db: sqlite3.Connection, db_lock: threading.Lock, logger, collapse: bool = True,
+                 max_queue: int = AUDIT_QUEUE_SIZE, batch_size: int = AUDIT_BATCH_SIZE, batch_latency: float = AUDIT_BATCH_LATENCY,
+                 put_timeout: float = AUDIT_PUT_TIMEOUT):
+        self.db = db
+        self.db_lock = db_lock
+        self.logger = logger
+        self.collapse = collapse
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.put_timeout = put_timeout
+        self.written = 0  # событий записано
+        self.rows = 0  # строк записано; меньше written на число склеенных событий
+        self.batches = 0
+        self.dropped = 0  # granted, отброшенные при переполнении очереди
+        self.failed = 0  # событий в пакетах, которые не удалось записать
+        self._queue: "queue.Queue" = queue.Queue(max_queue)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="selinux-audit", daemon=True)
+        self._thread.start()
+
+    def record(self, event: AuditEvent):
+        """Ставит событие в очередь писателя."""
+        if self._closed:
+            self._write([event])
+            return
+        if event[5] == "denied":
+            self._queue.put(event)
+            return
+        try:
+            self._queue.put(event, timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                self.logger.warning(f"SELinux audit queue is full, {self.dropped} granted events dropped so far")
+
+    def flush(self):
+        """Ждет, пока писатель запишет все события, поставленные до вызова."""
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        """Записывает очередь и останавливает писателя."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        # события, поставленные одновременно с остановкой
+        late = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is not _STOP:
+                late.append(item)
+        if late:
+            self._write(late)
+
+    def stats(self) -> Dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "rows": self.rows,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch: List[AuditEvent] = []
+            waiters: List[threading.Event] = []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.batch_latency
+            while True:
+                if item is _STOP:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                # flush и остановка не ждут набора пакета: забирается только то, что уже в очереди
+                timeout = 0 if stop or waiters else deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            for waiter in waiters:
+                waiter.set()
+
+    def _rows(self, batch: List[AuditEvent]) -> List[tuple]:
+        """Строки для executemany: событие плюс count; одинаковые granted события пакета склеиваются."""
+        if not self.collapse:
+            return [event + (1,) for event in batch]
+        rows: List[list] = []
+        granted: Dict[tuple, list] = {}
+        for event in batch:
+            session_id, username, role, path, operation, result, timestamp, mode = event
+            if result != "granted":
+                rows.append(list(event) + [1])
+                continue
+            key = (session_id, username, role, path, operation, mode)
+            row = granted.get(key)
+            if row is None:
+                row = granted[key] = list(event) + [1]
+                rows.append(row)
+            else:
+                row[6] = timestamp
+                row[8] += 1
+        return [tuple(row) for row in rows]
+
+    def _write(self, batch: List[AuditEvent]):
+        rows = self._rows(batch)
+        try:
+            with self.db_lock, self.db:
+                self.db.executemany(
+                    "INSERT INTO selinux_audit (session_id, username, role, path, operation, result, timestamp, mode, count) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+        except Exception as e:
+            self.failed += len(batch)
+            self.logger.error(f"Failed to write {len(batch)} SELinux audit events: {e}")
+            for event in batch:
+                if event[5] == "denied":
+                    # отказ остается хотя бы в логе
+                    self.logger.error(f"Unrecorded SELinux denial: {event[4]} on {event[3]} for {event[1]} ({event[2]}) at {event[6]}")
+            return
+        self.written += len(batch)
+        self.rows += len(rows)
+        self.batches += 1
+
+def audit_filter(username: Optional[str] = None, role: Optional[str] = None, path: Optional[str] = None, operation: Optional[str] = None,
+                 result: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None) -> Tuple[List[str], list]:
+    """Условия WHERE и параметры для фильтров аудита. path - префикс пути: сам путь и всё его поддерево."""
+    where, params = [], []
+    for column, value in (("username", username), ("role", role), ("operation", operation), ("result", result)):
+        if value is not None:
+            where.append(f"{column} = ?")
+            params.append(value)
+    if path is not None and path.rstrip("/"):
+        prefix = path.rstrip("/")
+        # диапазон вместо LIKE: работает по индексу и не путает /home с /homework ("0" следует за "/")
+        where.append("(path = ? OR (path >= ? AND path < ?))")
+        params.extend((prefix, prefix + "/", prefix + "0"))
+    if since is not None:
+        where.append("timestamp >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("timestamp < ?")
+        params.append(until)
+    return where, params
+
+def audit_row(row: tuple) -> Dict:
+    return dict(zip(AUDIT_COLUMNS, row))
@@ -0,0 +1,75 @@
+#SELinux access vector cache
+#created by Antarctica
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+DEFAULT_AVC_ENTRIES = 16384  # сколько решений (роль, путь, операция) хранит кэш
+
+class AccessVectorCache:
+    """LRU-кэш решений политики SELinux по ключу (роль, путь, операция).
+
+    Решение запоминается вместе с поколением политики. Любое изменение политики увеличивает поколение (invalidate),
+    и все прежние решения становятся промахами без обхода кэша; устаревшая запись удаляется при обращении к ней."""
+
+    def __init__(self, max_entries: int = DEFAULT_AVC_ENTRIES):
+        self.max_entries = max_entries
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[int, bool]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, role: str, path: str, operation: str) -> Optional[bool]:
+        """Возвращает решение политики или None, если его нет в кэше текущего поколения."""
+        key = (role, path, operation)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != self.generation:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, role: str, path: str, operation: str, allowed: bool, generation: int):
+        """Запоминает решение, принятое по политике поколения generation; решение устаревшей политики не кэшируется."""
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[(role, path, operation)] = (generation, allowed)
+            self._entries.move_to_end((role, path, operation))
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """Отмечает все решения устаревшими: политика изменилась."""
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """Возвращает статистику кэша."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "generation": self.generation,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
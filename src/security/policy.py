@@ -0,0 +1,156 @@
+#SELinux policy trie
+#created by Antarctica
+from fnmatch import fnmatchcase
+from typing import Dict, List, Optional, Tuple
+
+GLOB_CHARS = "*?["
+
+class Rule:
+    """Скомпилированное правило: для каждой операции битовая маска ролей."""
+    __slots__ = ("pattern", "masks")
+
+    def __init__(self, pattern: str, masks: Dict[str, int]):
+        self.pattern = pattern
+        self.masks = masks
+
+    def allows(self, operation: str, role_bit: int) -> bool:
+        return bool(self.masks.get(operation, 0) & role_bit)
+
+class _Node:
+    __slots__ = ("children", "globs", "star", "globstar", "rule")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}  # компонент пути -> узел
+        self.globs: List[tuple] = []  # (шаблон компонента вроде *.txt, узел), более длинные шаблоны раньше
+        self.star: Optional["_Node"] = None  # * - ровно один компонент
+        self.globstar: Optional["_Node"] = None  # ** - один или больше компонентов
+        self.rule: Optional[Rule] = None
+
+    def empty(self) -> bool:
+        return self.rule is None and not self.children and not self.globs and self.star is None and self.globstar is None
+
+class PolicyTrie:
+    """Правила SELinux, скомпилированные в дерево по компонентам пути.
+
+    Шаблон правила - путь, компоненты которого могут быть `*` (один компонент), `**` (один или больше компонентов) или
+    шаблоном fnmatch вроде `*.txt`. Правило действует на всё поддерево совпавшего пути. Путь решает самое точное совпадение:
+    побеждает правило, покрывшее больше компонентов пути, так что `/home/*/secret` важнее `/home/user` для
+    `/home/user/secret`. При равной глубине компоненты сравниваются слева направо: точное имя важнее шаблона компонента,
+    тот важнее `*`, а `*` важнее `**`. Роли хранятся битами, поэтому решение - обход дерева и проверка бита."""
+
+    def __init__(self, rules: Optional[Dict[str, Dict]] = None):
+        self.root = _Node()
+        self.roles: Dict[str, int] = {}  # роль -> бит
+        self.size = 0
+        for pattern, rule in (rules or {}).items():
+            self.set(pattern, rule)
+
+    def role_bit(self, role: str) -> int:
+        """Бит роли; у роли, которой нет ни в одном правиле, бита нет (0)."""
+        return self.roles.get(role, 0)
+
+    def _bit(self, role: str) -> int:
+        bit = self.roles.get(role)
+        if bit is None:
+            bit = self.roles[role] = 1 << len(self.roles)
+        return bit
+
+    @staticmethod
+    def _parts(pattern: str) -> List[str]:
+        return [part for part in pattern.split("/") if part]
+
+    @staticmethod
+    def _child(node: _Node, part: str) -> Optional[_Node]:
+        if part == "**":
+            return node.globstar
+        if part == "*":
+            return node.star
+        if any(char in part for char in GLOB_CHARS):
+            return next((child for glob, child in node.globs if glob == part), None)
+        return node.children.get(part)
+
+    @staticmethod
+    def _attach(node: _Node, part: str, child: Optional[_Node]):
+        """Вешает child на node по компоненту part; None снимает узел."""
+        if part == "**":
+            node.globstar = child
+        elif part == "*":
+            node.star = child
+        elif any(char in part for char in GLOB_CHARS):
+            node.globs = [(glob, other) for glob, other in node.globs if glob != part]
+            if child is not None:
+                node.globs.append((part, child))
+                node.globs.sort(key=lambda item: -len(item[0]))
+        elif child is None:
+            node.children.pop(part, None)
+        else:
+            node.children[part] = child
+
+    def set(self, pattern: str, rule: Dict):
+        """Компилирует правило шаблона pattern ({операция: [роли], "type": ...}), заменяя прежнее."""
+        node = self.root
+        for part in self._parts(pattern):
+            child = self._child(node, part)
+            if child is None:
+                child = _Node()
+                self._attach(node, part, child)
+            node = child
+        if node.rule is None:
+            self.size += 1
+        masks = {}
+        for operation, roles in rule.items():
+            if operation == "type":
+                continue
+            mask = 0
+            for role in roles:
+                mask |= self._bit(role)
+            masks[operation] = mask
+        node.rule = Rule(pattern, masks)
+
+    def remove(self, pattern: str):
+        """Удаляет правило шаблона pattern и опустевшие узлы."""
+        path, node = [], self.root
+        for part in self._parts(pattern):
+            path.append((node, part))
+            node = self._child(node, part)
+            if node is None:
+                return
+        if node.rule is None:
+            return
+        node.rule = None
+        self.size -= 1
+        for parent, part in reversed(path):
+            if not node.empty():
+                break
+            self._attach(parent, part, None)
+            node = parent
+
+    def match(self, path: str) -> Optional[Rule]:
+        """Самое точное правило для пути или None."""
+        found = self._match(self.root, self._parts(path), 0, True)
+        return found[1] if found else None
+
+    def _match(self, node: _Node, parts: List[str], i: int, inherit: bool) -> Optional[Tuple[int, Rule]]:
+        """(глубина, правило): глубина - сколько компонентов пути покрыто совпадением. Побеждает самое глубокое совпадение
+        среди всех ветвей; при равной глубине - найденное раньше, а ветви перебираются от самой точной."""
+        if i == len(parts):
+            return (i, node.rule) if node.rule is not None else None
+        best = (i, node.rule) if inherit and node.rule is not None else None  # правило префикса пути
+        part = parts[i]
+        branches = []
+        child = node.children.get(part)
+        if child is not None:
+            branches.append((child, i + 1, True))
+        branches.extend((child, i + 1, True) for glob, child in node.globs if fnmatchcase(part, glob))
+        if node.star is not None:
+            branches.append((node.star, i + 1, True))
+        if node.globstar is not None:
+            # чем меньше компонентов забирает **, тем больше их сравнивается явно: короткие варианты раньше
+            branches.extend((node.globstar, j, False) for j in range(i + 1, len(parts) + 1))
+        for child, j, child_inherit in branches:
+            found = self._match(child, parts, j, child_inherit)
+            if found is not None and (best is None or found[0] > best[0]):
+                best = found
+                if best[0] == len(parts):
+                    break  # глубже полного совпадения не бывает
+        return best
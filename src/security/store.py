@@ -0,0 +1,59 @@
+#SELinux policy store
+#created by Antarctica
+import json
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+class PolicyStore:
+    """Политика SELinux в таблицах selinux.db: режим - строка selinux_settings, каждое правило - строка selinux_rules.
+
+    Изменение одного правила переписывает одну строку в своей транзакции: время не зависит от размера политики, а сбой
+    посреди записи оставляет прежнее состояние. Правила читаются в порядке добавления, как в словаре политики."""
+
+    def __init__(self, db: sqlite3.Connection, db_lock: threading.Lock):
+        self.db = db
+        self.db_lock = db_lock
+        with self.db_lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS selinux_settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS selinux_rules (pattern TEXT PRIMARY KEY, rule TEXT NOT NULL)")
+
+    def load(self) -> Optional[Dict]:
+        """Политика {"mode": ..., "rules": {...}} или None, если её еще не сохраняли."""
+        with self.db_lock:
+            mode = self.db.execute("SELECT value FROM selinux_settings WHERE key = 'mode'").fetchone()
+            if mode is None:
+                return None
+            rules = {pattern: json.loads(rule) for pattern, rule in self.db.execute("SELECT pattern, rule FROM selinux_rules ORDER BY rowid")}
+        return {"mode": mode[0], "rules": rules}
+
+    def _write_mode(self, mode: str):
+        self.db.execute("INSERT INTO selinux_settings (key, value) VALUES ('mode', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (mode,))
+
+    def save_mode(self, mode: str):
+        with self.db_lock, self.db:
+            self._write_mode(mode)
+
+    def save_rule(self, pattern: str, rule: Dict):
+        # UPSERT, а не INSERT OR REPLACE: строка сохраняет rowid и место в порядке правил
+        with self.db_lock, self.db:
+            self.db.execute(
+                "INSERT INTO selinux_rules (pattern, rule) VALUES (?, ?) ON CONFLICT(pattern) DO UPDATE SET rule = excluded.rule",
+                (pattern, json.dumps(rule))
+            )
+
+    def delete_rule(self, pattern: str):
+        with self.db_lock, self.db:
+            self.db.execute("DELETE FROM selinux_rules WHERE pattern = ?", (pattern,))
+
+    def save_rules(self, rules: Dict[str, Dict], mode: Optional[str] = None, replace: bool = False):
+        """Записывает правила одной транзакцией; replace сначала удаляет все прежние правила."""
+        with self.db_lock, self.db:
+            if replace:
+                self.db.execute("DELETE FROM selinux_rules")
+            if mode is not None:
+                self._write_mode(mode)
+            self.db.executemany(
+                "INSERT INTO selinux_rules (pattern, rule) VALUES (?, ?) ON CONFLICT(pattern) DO UPDATE SET rule = excluded.rule",
+                ((pattern, json.dumps(rule)) for pattern, rule in rules.items())
+            )
@@ -2,8 +2,9 @@ import os
 import sys
 import html
 import sqlite3
+import time
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 from prompt_toolkit import PromptSession, print_formatted_text, HTML
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.keys import Keys
@@ -11,7 +12,7 @@ INIT_DIR = Path(__file__).resolve().parent
 sys.path.append(str(INIT_DIR))
 from core.TunKernel import Kernel
 from src.libs.logging import Logger
-from src.TNFS.TNFS import TNFS
+from src.TNFS.TNFS import TNFS, COPY_BATCH_SIZE
 from src.libs.CrashHandler import CrashHandler, TunderCrash
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
@@ -20,12 +21,21 @@ class Shell:
     COMMANDS = {
         "L.mktxt": "Create a new text file at the specified path. Usage: L.mktxt <path>",
         "L.mkdir": "Create a new directory at the specified path. Usage: L.mkdir <path>",
-        "L.rm": "Remove a file or directory at the specified path. Usage: L.rm <path>",
+        "L.rm": "Remove a file or directory at the specified path. Usage: L.rm [-r] <path> (-r removes a directory with its contents)",
         "L.chmod": "Change permissions of a file or directory. Usage: L.chmod <path> <perms> (e.g., 755)",
         "L.rename": "!!!DEV!!!Rename a file or directory. Usage: L.rename <old_path> <new_path>",
         "L.copy": "!!!DEV!!!Copy a file or directory. Usage: L.copy <src_path> <dst_path>",
         "L.move": "!!!DEV!!!Move a file or directory. Usage: L.move <src_path> <dst_path>",
         "cat": "Display the contents of a file. Usage: cat <path>",
+        "grep": "Search file contents for a string. Usage: grep <pattern> [path] (defaults to /)",
+        "find": "Find files and directories by name. Usage: find <path> -name <glob>",
+        "compress": "Compress TNFS blobs stored uncompressed, in batches (root only). Usage: compress",
+        "hot": "Show the most accessed paths from read statistics. Usage: hot [count] [read|list|grep|find]",
+        "journal": "Show or set how reads are journaled (root only to set). Usage: journal [full|sampled|aggregated|off]",
+        "du": "Show entries and size of a directory subtree; -s also counts space stored on disk (walks the subtree). Usage: du [-s] [path]",
+        "df": "Show TNFS space usage: totals, image file and per-user usage. Usage: df",
+        "quota": "Show quotas or set a user or directory quota (root only); - removes a limit. Usage: quota [<user|path> <max_bytes|-> [max_entries|-]]",
+        "fsck": "Check TNFS consistency of a subtree (whole image checks for /). Usage: fsck [path]",
         "ls": "List contents of a directory. Usage: ls [path] (defaults to /)",
         "adduser": "Add a new user. Usage: adduser <username> <password> [role] (default role: user)",
         "deluser": "Delete a user. Usage: deluser <username>",
@@ -39,8 +49,16 @@ class Shell:
         "rmrule": "Remove an SELinux rule. Usage: rmrule <path> <operation> <subjects...>",
         "listrules": "List all SELinux rules. Usage: listrules",
         "resetSEL": "Reset SELinux policies to default. Usage: resetSEL",
+        "loadpolicy": "Load SELinux rules from a JSON file on the host in one transaction; --replace drops rules missing from the file. Usage: loadpolicy <file> [--replace]",
         "L.warn": "Trigger a test warning. Usage: L.warn",
-        "auditlogs": "Display SELinux audit logs. Usage: auditlogs",
+        "auditlogs": "Display SELinux audit logs, newest first. Usage: auditlogs [--user <name>] [--role <role>] [--path <prefix>] [--op <operation>] "
+                     "[--result granted|denied] [--since <time>] [--until <time>] [--limit N] [--follow] (time: unix timestamp or 30s/15m/2h/1d ago; default limit 100)",
+        "avc": "Show SELinux access vector cache statistics: cached decisions, hits and misses. Usage: avc",
+        "tnfs": "Import a host directory into TNFS or export a TNFS directory. Usage: tnfs import <host_dir> <tnfs_path> | tnfs export <tnfs_path> <host_dir|archive.tar>",
+        "snapshot": "Manage TNFS image snapshots (root only); create runs in the background. Usage: snapshot create|restore|delete <name> | snapshot list",
+        "begin": "Start a TNFS transaction: following commands are applied together. Usage: begin",
+        "commit": "Commit the current TNFS transaction. Usage: commit",
+        "rollback": "Roll back the current TNFS transaction. Usage: rollback",
         "exit": "Exit the shell. Usage: exit",
         "su": "Login as root user(su - super user)",
         "help": "Show this help message or details for a specific command. Usage: help [command]"
@@ -137,8 +155,172 @@ class Shell:
     def _handle_ctrl_c(self, event):
         print_formatted_text(HTML("<ansired>\r\nKeyboardInterrupt: Exiting shell</ansired>\r\n"))
         self.logger.info("Shell interrupted by Ctrl+C")
+        self.kernel.shutdown()
         sys.exit(0)
 
+    def _copy(self, src_path: str, dst_path: str):
+        """Копирует файл или директорию, показывая прогресс для больших деревьев."""
+        def show(done: int, total: int):
+            if total > COPY_BATCH_SIZE:
+                print_formatted_text(HTML(f"<ansiyellow>Copying: {done}/{total} entries</ansiyellow>"), end="\r")
+        try:
+            self.kernel.copy(src_path, dst_path, progress=show)
+        except KeyboardInterrupt:
+            # операция откатывается целиком, частичной копии не остается
+            print_formatted_text(HTML("<ansired>\r\nCopy cancelled</ansired>"))
+            return
+        print_formatted_text(HTML(f"<ansigreen>Copied: {html.escape(src_path)} to {html.escape(dst_path)}</ansigreen>"))
+
+    def _transfer(self, args: List[str]):
+        """Импортирует дерево каталогов хоста в TNFS или выгружает директорию TNFS на хост."""
+        if len(args) < 3 or args[0] not in ("import", "export"):
+            print_formatted_text(HTML(f"<ansired>{html.escape('Usage: tnfs import <host_dir> <tnfs_path> | tnfs export <tnfs_path> <host_dir|archive.tar>')}</ansired>"))
+            return
+        def show(done: int, total):
+            print_formatted_text(HTML(f"<ansiyellow>{args[0].capitalize()}ed: {done} entries</ansiyellow>"), end="\r")
+        try:
+            if args[0] == "import":
+                count = self.kernel.import_tree(args[1], args[2], progress=show)
+            else:
+                count = self.kernel.export_tree(args[1], args[2], progress=show)
+        except KeyboardInterrupt:
+            # импорт фиксируется пакетами: уже записанные пакеты остаются в образе
+            print_formatted_text(HTML(f"<ansired>\r\n{args[0].capitalize()} interrupted</ansired>"))
+            return
+        print_formatted_text(HTML(f"<ansigreen>\r{args[0].capitalize()}ed {count} entries: {html.escape(args[1])} to {html.escape(args[2])}</ansigreen>"))
+
+    def _snapshot(self, args: List[str]):
+        """Создает, показывает, восстанавливает и удаляет снимки образа TNFS."""
+        if not args or args[0] not in ("create", "list", "restore", "delete") or (args[0] != "list" and len(args) < 2):
+            print_formatted_text(HTML(f"<ansired>{html.escape('Usage: snapshot create|restore|delete <name> | snapshot list')}</ansired>"))
+            return
+        if args[0] == "create":
+            self.kernel.snapshot_create(args[1])
+            print_formatted_text(HTML(f"<ansigreen>Snapshot {html.escape(args[1])} is being created in the background (see snapshot list)</ansigreen>"))
+        elif args[0] == "list":
+            for snapshot in self.kernel.snapshot_list():
+                created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["created"]))
+                if snapshot["state"] == "ready":
+                    state = f"{snapshot['size'] / (1024 * 1024):.1f} MB"
+                elif snapshot["state"] == "running":
+                    state = f"running {snapshot['done']}/{snapshot['total']} pages"
+                else:
+                    state = f"failed: {snapshot['error']}"
+                print_formatted_text(HTML(f"<ansigreen>{html.escape(snapshot['name'])}</ansigreen>  {created}  <ansiyellow>{html.escape(state)}</ansiyellow>"))
+        elif args[0] == "restore":
+            def show(done: int, total: int):
+                print_formatted_text(HTML(f"<ansiyellow>Restoring: {done}/{total} pages</ansiyellow>"), end="\r")
+            self.kernel.snapshot_restore(args[1], progress=show)
+            print_formatted_text(HTML(f"<ansigreen>\rSnapshot restored: {html.escape(args[1])}</ansigreen>"))
+        else:
+            self.kernel.snapshot_delete(args[1])
+            print_formatted_text(HTML(f"<ansigreen>Snapshot deleted: {html.escape(args[1])}</ansigreen>"))
+
+    def _compress(self):
+        """Сжимает хранилище TNFS и показывает занятое место до и после."""
+        def show(done: int, total: int):
+            print_formatted_text(HTML(f"<ansiyellow>Compressing: {done}/{total} blobs</ansiyellow>"), end="\r")
+        before = self.kernel.storage_stats()
+        try:
+            report = self.kernel.compress(progress=show)
+        except KeyboardInterrupt:
+            # пакеты фиксируются по отдельности: уже сжатые blobs остаются сжатыми
+            print_formatted_text(HTML("<ansired>\r\nCompression interrupted</ansired>"))
+            return
+        after = self.kernel.storage_stats()
+        print_formatted_text(HTML(f"<ansigreen>\rCompressed {report['compressed']} of {report['blobs']} blobs</ansigreen>"))
+        for label, stats in (("before", before), ("after", after)):
+            print_formatted_text(HTML(f"<ansiblue>{label:>6}</ansiblue>: {stats['bytes'] / 2 ** 20:.1f} MB stored as {stats['stored'] / 2 ** 20:.1f} MB"))
+
+    @staticmethod
+    def _limit(value: Optional[int]) -> str:
+        return "-" if value is None else str(value)
+
+    def _df(self):
+        """Показывает занятое место TNFS по счетчикам: итог, файл образа и использование по пользователям."""
+        usage = self.kernel.df()
+        print_formatted_text(HTML(f"<ansigreen>{usage['files']} files, {usage['directories']} directories, "
+                                  f"{usage['bytes'] / 2 ** 20:.1f} MB</ansigreen>"))
+        print_formatted_text(HTML(f"<ansiblue>image</ansiblue>: {usage['image'] / 2 ** 20:.1f} MB, {usage['free'] / 2 ** 20:.1f} MB free"))
+        for owner, row in usage["owners"].items():
+            print_formatted_text(HTML(f"<ansiyellow>{html.escape(owner):>12}</ansiyellow>  {row['files']:>8} files  {row['directories']:>6} dirs  "
+                                      f"{row['bytes'] / 2 ** 20:>10.1f} MB  quota {self._limit(row['max_bytes'])} bytes, "
+                                      f"{self._limit(row['max_entries'])} entries"))
+
+    def _quota(self, args: List[str]):
+        """Показывает квоты или задает квоту пользователя или директории."""
+        if not args:
+            for quota in self.kernel.quotas():
+                print_formatted_text(HTML(f"<ansigreen>{html.escape(quota['target'])}</ansigreen>  {quota['bytes']} / "
+                                          f"{self._limit(quota['max_bytes'])} bytes  {quota['entries']} / {self._limit(quota['max_entries'])} entries"))
+            return
+        try:
+            limits = [None if value == "-" else int(value) for value in args[1:3]]
+        except ValueError:
+            limits = []
+        if len(args) < 2 or not limits:
+            print_formatted_text(HTML(f"<ansired>{html.escape('Usage: quota [<user|path> <max_bytes|-> [max_entries|-]]')}</ansired>"))
+            return
+        self.kernel.set_quota(args[0], *limits)
+        print_formatted_text(HTML(f"<ansigreen>Quota set for {html.escape(args[0])}</ansigreen>"))
+
+    AUDIT_FLAGS = {"--user": "username", "--role": "role", "--path": "path", "--op": "operation", "--result": "result", "--since": "since", "--until": "until"}
+    TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+    @classmethod
+    def _audit_time(cls, value: str) -> float:
+        """Unix timestamp или давность вида 30s, 15m, 2h, 1d."""
+        if value[-1:] in cls.TIME_UNITS:
+            return time.time() - float(value[:-1]) * cls.TIME_UNITS[value[-1]]
+        return float(value)
+
+    @staticmethod
+    def _print_audit(log: dict):
+        repeated = f" x{log['count']}" if log['count'] > 1 else ""
+        color = "ansigreen" if log["result"] == "granted" else "ansired"
+        print_formatted_text(HTML(
+            f"<{color}>[{html.escape(str(log['timestamp']))}] Session {log['session_id']}: {html.escape(str(log['username']))} ({html.escape(str(log['role']))}) "
+            f"{html.escape(log['result'])} {html.escape(str(log['operation']))} on {html.escape(str(log['path']))} ({html.escape(log['mode'])}){repeated}</{color}>"
+        ))
+
+    def _auditlogs(self, args: List[str]):
+        """Показывает логи аудита SELinux с фильтрами; --follow дописывает новые записи до Ctrl+C."""
+        filters, limit, follow = {}, 100, False
+        try:
+            i = 0
+            while i < len(args):
+                flag = args[i]
+                if flag == "--follow":
+                    follow = True
+                    i += 1
+                    continue
+                if (flag not in self.AUDIT_FLAGS and flag != "--limit") or i + 1 >= len(args):
+                    raise ValueError(flag)
+                value = args[i + 1]
+                if flag == "--limit":
+                    limit = int(value)
+                elif flag in ("--since", "--until"):
+                    filters[self.AUDIT_FLAGS[flag]] = self._audit_time(value)
+                else:
+                    filters[self.AUDIT_FLAGS[flag]] = value
+                i += 2
+        except ValueError:
+            print_formatted_text(HTML(f"<ansired>{html.escape('Usage: auditlogs [--user <name>] [--role <role>] [--path <prefix>] [--op <operation>] [--result granted|denied] [--since <time>] [--until <time>] [--limit N] [--follow]')}</ansired>"))
+            return
+        logs, _ = self.kernel.selinux.query_audit_logs(limit, **filters)
+        if not follow:
+            for log in logs:
+                self._print_audit(log)
+            return
+        # как tail -f: последние записи по порядку, затем новые по мере записи
+        for log in reversed(logs):
+            self._print_audit(log)
+        try:
+            for log in self.kernel.selinux.follow_audit_logs(max((log["id"] for log in logs), default=0), **filters):
+                self._print_audit(log)
+        except KeyboardInterrupt:
+            print_formatted_text(HTML("<ansiyellow>\r\nStopped following audit logs</ansiyellow>"))
+
     def _help(self, args: List[str]):
         """Display help for all commands or a specific command."""
         try:
@@ -181,9 +363,53 @@ class Shell:
                     if not args:
                         print_formatted_text(HTML(f"<ansired>{html.escape('Usage: cat <path>')}</ansired>"))
                     else:
-                        content = self.kernel.read_file(args[0])
-                        if content:
-                            print_formatted_text(HTML(f"<ansiyellow>{html.escape(content)}</ansiyellow>"))
+                        with self.kernel.open(args[0]) as f:
+                            for chunk in f:
+                                print_formatted_text(HTML(f"<ansiyellow>{html.escape(chunk)}</ansiyellow>"), end="")
+                            if f.size:
+                                print_formatted_text("")
+                elif command == "grep":
+                    if not args:
+                        print_formatted_text(HTML(f"<ansired>{html.escape('Usage: grep <pattern> [path]')}</ansired>"))
+                    else:
+                        for path, number, line in self.kernel.grep(args[0], args[1] if len(args) > 1 else "/"):
+                            print_formatted_text(HTML(f"<ansigreen>{html.escape(path)}</ansigreen>:<ansiblue>{number}</ansiblue>: {html.escape(line)}"))
+                elif command == "find":
+                    if not args or (len(args) > 1 and (args[1] != "-name" or len(args) < 3)):
+                        print_formatted_text(HTML(f"<ansired>{html.escape('Usage: find <path> -name <glob>')}</ansired>"))
+                    else:
+                        for path in self.kernel.find(args[0], args[2] if len(args) > 2 else "*"):
+                            print_formatted_text(HTML(f"<ansiyellow>{html.escape(path)}</ansiyellow>"))
+                elif command == "compress":
+                    self._compress()
+                elif command == "hot":
+                    limit = int(args[0]) if args and args[0].isdigit() else 10
+                    operation = next((arg for arg in args if not arg.isdigit()), "read")
+                    for path, count, last_access in self.kernel.hot_files(limit, operation):
+                        accessed = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(last_access))
+                        print_formatted_text(HTML(f"<ansiblue>{count:>8}</ansiblue>  {accessed}  <ansigreen>{html.escape(path)}</ansigreen>"))
+                elif command == "journal":
+                    if args:
+                        self.kernel.set_read_journal(args[0])
+                    print_formatted_text(HTML(f"<ansigreen>Read journal mode: {html.escape(self.kernel.tnfs.read_journal)}</ansigreen>"))
+                elif command == "du":
+                    stored = args[:1] == ["-s"]
+                    path = args[1 if stored else 0] if len(args) > stored else "/"
+                    usage = self.kernel.du(path, stored)
+                    line = f"{usage['files']} files, {usage['directories']} directories, {usage['bytes'] / 2 ** 20:.1f} MB"
+                    if stored:
+                        line += f" ({usage['stored'] / 2 ** 20:.1f} MB stored)"
+                    print_formatted_text(HTML(f"<ansigreen>{html.escape(path)}</ansigreen>: {line}"))
+                elif command == "df":
+                    self._df()
+                elif command == "quota":
+                    self._quota(args)
+                elif command == "fsck":
+                    problems = self.kernel.fsck(args[0] if args else "/")
+                    for problem in problems:
+                        print_formatted_text(HTML(f"<ansired>{html.escape(problem)}</ansired>"))
+                    if not problems:
+                        print_formatted_text(HTML("<ansigreen>No problems found</ansigreen>"))
                 elif command == "L.mktxt":
                     if len(args) < 1:
                         print_formatted_text(HTML(f"<ansired>{html.escape('Usage: L.mktxt <path>')}</ansired>"))
@@ -199,10 +425,13 @@ class Shell:
                         self.kernel.create_directory(args[0])
                         print_formatted_text(HTML(f"<ansigreen>Directory created: {args[0]}</ansigreen>"))
                 elif command == "L.rm":
+                    recursive = args[:1] == ["-r"]
+                    if recursive:
+                        args = args[1:]
                     if not args:
-                        print_formatted_text(HTML(f"<ansired>{html.escape('Usage: L.rm <path>')}</ansired>"))
+                        print_formatted_text(HTML(f"<ansired>{html.escape('Usage: L.rm [-r] <path>')}</ansired>"))
                     else:
-                        self.kernel.remove(args[0])
+                        self.kernel.remove(args[0], recursive=recursive)
                         print_formatted_text(HTML(f"<ansigreen>Path removed: {args[0]}</ansigreen>"))
                 elif command == "L.chmod":
                     if len(args) < 2:
@@ -214,6 +443,15 @@ class Shell:
                             print_formatted_text(HTML(f"<ansigreen>Permissions changed: {args[0]} to {oct(perms)}</ansigreen>"))
                         except ValueError:
                             self.crash_handler.raise_crash("Shell", "0xV0E0ERR", f"Invalid permissions: {args[1]}")
+                elif command == "L.copy":
+                    if len(args) < 2:
+                        print_formatted_text(HTML(f"<ansired>{html.escape('Usage: L.copy <src_path> <dst_path>')}</ansired>"))
+                    else:
+                        self._copy(args[0], args[1])
+                elif command == "tnfs":
+                    self._transfer(args)
+                elif command == "snapshot":
+                    self._snapshot(args)
                 elif command == "adduser":
                     if len(args) < 2:
                         print_formatted_text(HTML(f"<ansired>{html.escape('Usage: adduser <username> <password> [role]')}</ansired>"))
@@ -302,6 +540,12 @@ class Shell:
                         for op, subjects in rule.items():
                             if op != "type":
                                 print_formatted_text(HTML(f"  <ansiblue>{html.escape(op)}: {html.escape(str(subjects))}</ansiblue>"))
+                elif command == "loadpolicy":
+                    if not args or args[1:] not in ([], ["--replace"]):
+                        print_formatted_text(HTML(f"<ansired>{html.escape('Usage: loadpolicy <file> [--replace]')}</ansired>"))
+                    else:
+                        count = self.kernel.selinux.load_policy(args[0], replace=args[1:] == ["--replace"])
+                        print_formatted_text(HTML(f"<ansigreen>Loaded {count} SELinux rules from {html.escape(args[0])}</ansigreen>"))
                 elif command == "resetSEL":
                     self.kernel.selinux.reset_policies()
                     print_formatted_text(HTML(f"<ansigreen>SELinux policies reset to default</ansigreen>"))
@@ -315,17 +559,28 @@ class Shell:
                     else:
                         self.logger.warning("You already rooted")
                 elif command == "auditlogs":
-                    logs = self.kernel.selinux.get_audit_logs()
-                    for log in logs:
-                        print_formatted_text(HTML(
-                            f"<ansigreen>[{html.escape(str(log['timestamp']))}] Session {log['session_id']}: {html.escape(log['username'])} ({html.escape(log['role'])}) "
-                            f"{html.escape(log['result'])} {html.escape(log['operation'])} on {html.escape(log['path'])} ({html.escape(log['mode'])})</ansigreen>"
-                        ))
+                    self._auditlogs(args)
+                elif command == "avc":
+                    stats = self.kernel.selinux.avc.stats()
+                    print_formatted_text(HTML(f"<ansigreen>{stats['entries']}/{stats['max_entries']} decisions, generation {stats['generation']}</ansigreen>"))
+                    print_formatted_text(HTML(f"<ansiblue>{stats['hits']} hits, {stats['misses']} misses ({stats['hit_ratio']:.1%}), "
+                                              f"{stats['evictions']} evictions, {stats['invalidations']} invalidations</ansiblue>"))
+                elif command == "begin":
+                    self.kernel.begin()
+                    print_formatted_text(HTML("<ansigreen>Transaction started</ansigreen>"))
+                elif command == "commit":
+                    self.kernel.commit()
+                    print_formatted_text(HTML("<ansigreen>Transaction committed</ansigreen>"))
+                elif command == "rollback":
+                    self.kernel.rollback()
+                    print_formatted_text(HTML("<ansigreen>Transaction rolled back</ansigreen>"))
                 elif command == "exit":
+                    self.kernel.shutdown()
                     print_formatted_text(HTML("<ansigreen>Exiting shell</ansigreen>"))
                     break
                 else:
                     self.crash_handler.raise_crash("Shell", "0xV0E0ERR", f"Unknown command: {command}")
+                self.kernel.flush()  # Граница команды - точка долговечности для групповой фиксации
                 error_count = 0  # Сброс счетчика ошибок при успешном выполнении
             except TunderCrash as e:
                 print_formatted_text(HTML(f"<ansired>Error: {html.escape(str(e))}</ansired>"))
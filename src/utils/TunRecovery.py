@@ -1 +1,313 @@
-#TunderRecovery
\ No newline at end of file
+#TunderRecovery
+#created by SKATT
+import json
+import lzma
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+import sys
+INIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(INIT_DIR)
+from libs.logging import Logger
+from libs.CrashHandler import CrashHandler
+from TNFS.TNFS import TNFS, TNFS_DB, WALK_BATCH_SIZE
+from TNFS.backend import SQLiteView
+from TNFS.cache import Stat
+from TNFS.snapshot import SnapshotJob, SNAPSHOT_SUFFIX, PARTIAL_SUFFIX
+from TNFS.compress import decode
+
+CHECKPOINT_INTERVAL = 10000  # изменений в журнале между контрольными точками
+CHECKPOINT_KEEP = 2  # сколько готовых контрольных точек хранить
+REPLAY_BATCH_SIZE = 1000  # записей хвоста журнала, читаемых за один запрос
+
+class TunRecovery:
+    """Восстановление образа TNFS после некорректной остановки: контрольные точки образа и повтор хвоста журнала."""
+
+    def __init__(self, logger: Logger, crash_handler: CrashHandler, db_path: Optional[Path] = None,
+                 checkpoint_interval: int = CHECKPOINT_INTERVAL):
+        self.logger = logger
+        self.crash_handler = crash_handler
+        self.db_path = Path(db_path) if db_path else TNFS_DB
+        self.checkpoint_dir = self.db_path.parent / "checkpoints"
+        # отметка открытого образа: есть при старте - прошлая остановка была некорректной
+        self.marker = self.db_path.with_name(self.db_path.name + ".running")
+        self.checkpoint_interval = checkpoint_interval
+        self._changes = 0
+        self._job: Optional[SnapshotJob] = None
+        self._lock = threading.Lock()
+
+    def attach(self, tnfs: TNFS):
+        """Подключается к работающей TNFS: отмечает образ открытым и создает первую контрольную точку, если её нет."""
+        tnfs.recovery = self
+        self.marker.write_text(f"{os.getpid()} {time.time()}\n")
+        if self.latest_checkpoint() is None:
+            self.checkpoint(tnfs)
+
+    def detach(self, tnfs: TNFS):
+        """Чистая остановка: дожидается контрольной точки и снимает отметку открытого образа."""
+        tnfs.flush()
+        tnfs.recovery = None
+        job = self._job
+        if job is not None and job.is_alive():
+            self.logger.info("Waiting for TNFS checkpoint")
+            job.join()
+        self.marker.unlink(missing_ok=True)
+
+    def on_commit(self, tnfs: TNFS, mutations: int):
+        """Вызывается TNFS после фиксации; каждые checkpoint_interval изменений запускает контрольную точку."""
+        self._changes += mutations
+        if self._changes >= self.checkpoint_interval:
+            self.checkpoint(tnfs)
+
+    def checkpoint(self, tnfs: TNFS, wait: bool = False) -> SnapshotJob:
+        """Запускает контрольную точку в фоне (снимок образа, см. TNFS/snapshot.py); идущая точка не дублируется."""
+        with self._lock:
+            if self._job is not None and self._job.is_alive():
+                job = self._job
+            else:
+                self._purge(tnfs)
+                self._prune(CHECKPOINT_KEEP - 1)
+                self._changes = 0
+                self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+                target = self.checkpoint_dir / f"checkpoint-{time.time_ns()}{SNAPSHOT_SUFFIX}"
+                job = SnapshotJob(tnfs.db_path, target, tnfs.readers.busy_timeout, self.logger)
+                self._job = job
+                job.start()
+        if wait:
+            job.join()
+        return job
+
+    def reset(self, tnfs: TNFS):
+        """Удаляет все контрольные точки и начинает новую (после замены образа снимком)."""
+        with self._lock:
+            if self._job is not None and self._job.is_alive():
+                self._job.cancel()
+                self._job.join()
+            self._prune(0)
+        self.checkpoint(tnfs)
+
+    def checkpoints(self) -> List[Path]:
+        """Готовые контрольные точки от старых к новым."""
+        if not self.checkpoint_dir.is_dir():
+            return []
+        return sorted(self.checkpoint_dir.glob(f"checkpoint-*{SNAPSHOT_SUFFIX}"), key=lambda path: int(path.stem.split("-")[1]))
+
+    def latest_checkpoint(self) -> Optional[Path]:
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def _purge(self, tnfs: TNFS):
+        """Удаляет blobs без ссылок, которые были без ссылок уже в последней контрольной точке:
+        повтор хвоста журнала после неё возьмет их из самой точки."""
+        checkpoint = self.latest_checkpoint()
+        if checkpoint is None:
+            return
+        conn = self._connect(checkpoint)
+        try:
+            retired = [row[0] for row in conn.execute("SELECT hash FROM blobs WHERE ref_count <= 0")]
+        finally:
+            conn.close()
+        if retired:
+            self.logger.info(f"Purged {tnfs.purge_blobs(retired)} unreferenced blobs covered by {checkpoint.name}")
+
+    def _prune(self, keep: int):
+        checkpoints = self.checkpoints()
+        for path in checkpoints[:len(checkpoints) - keep] if keep else checkpoints:
+            path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _connect(path: Path) -> sqlite3.Connection:
+        return sqlite3.connect(f"{path.as_uri()}?mode=ro", uri=True)
+
+    def _high_water(self, checkpoint: Path) -> int:
+        """Последняя запись журнала, вошедшая в контрольную точку: точка содержит журнал на момент снимка."""
+        conn = self._connect(checkpoint)
+        try:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM journal").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _open(self, path: Path) -> TNFS:
+        tnfs = TNFS(self.logger, self.crash_handler, None, None, db_path=path, reader_pool_size=1)
+        tnfs.current_user = tnfs.current_role = "root"
+        return tnfs
+
+    @staticmethod
+    def _close(tnfs: TNFS):
+        tnfs.flush()
+        tnfs.readers.close()
+        tnfs.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        tnfs.db.close()
+
+    @staticmethod
+    def _touched(payload: Dict) -> Iterator[str]:
+        """Пути, которые изменила запись журнала."""
+        for key in ("create", "extents", "set"):
+            for row in payload.get(key, []):
+                yield row[0]
+        for row in payload.get("rename", []) + payload.get("copy", []):
+            yield row[1]
+
+    def recover(self, force: bool = False) -> Dict:
+        """Проверяет образ после некорректной остановки и при повреждении пересобирает его из последней контрольной точки
+        и хвоста журнала. force=True пересобирает образ без проверки. Возвращает отчет о восстановлении."""
+        report = {"status": "clean", "checkpoint": None, "tail": 0, "replayed": 0, "problems": []}
+        if not force and not self.marker.exists():
+            return report
+        started = time.monotonic()
+        self.logger.warning("Forced TNFS recovery" if force else "Unclean TNFS shutdown detected, checking the image")
+        for directory in (self.checkpoint_dir, self.db_path.parent / "snapshots"):
+            if directory.is_dir():
+                for partial in directory.glob(f"*{PARTIAL_SUFFIX}*"):
+                    partial.unlink(missing_ok=True)
+        checkpoint = self.latest_checkpoint()
+        since = self._high_water(checkpoint) if checkpoint else 0
+        report["checkpoint"] = checkpoint.name if checkpoint else None
+        if not force:
+            report["tail"], report["problems"] = self._verify(since)
+            for problem in report["problems"]:
+                self.logger.error(f"Recovery: {problem}")
+            if not report["problems"]:
+                report["status"] = "verified"
+                self.marker.unlink(missing_ok=True)
+                self.logger.info(f"TNFS image verified: {report['tail']} journal entries since the last checkpoint ({time.monotonic() - started:.2f}s)")
+                return report
+        if checkpoint is None:
+            report["status"] = "damaged"
+            self.logger.error("TNFS image is damaged and there is no checkpoint to rebuild it from")
+            return report
+        report["tail"], report["replayed"] = self._rebuild(checkpoint, since)
+        report["status"] = "rebuilt"
+        self.marker.unlink(missing_ok=True)
+        self.logger.info(f"TNFS image rebuilt from {checkpoint.name}: replayed {report['replayed']} of {report['tail']} journal entries "
+                         f"({time.monotonic() - started:.2f}s)")
+        return report
+
+    @staticmethod
+    def _lookup(view: SQLiteView, path: str) -> Optional[Stat]:
+        inode = view.root()
+        entry = inode and view.get_stat(inode)
+        for name in (part for part in path.split("/") if part):
+            if entry is None:
+                return None
+            entry = view.lookup_stat(entry.inode, name)
+        return entry
+
+    @classmethod
+    def _files(cls, view: SQLiteView, inode: int, path: str) -> Iterator[tuple]:
+        """Файлы поддерева директории inode: (путь, Stat); записи директорий читаются страницами."""
+        after = ""
+        while True:
+            page = view.children(inode, after, WALK_BATCH_SIZE)
+            if not page:
+                return
+            for name, stat in page:
+                child_path = f"{path.rstrip('/')}/{name}"
+                if stat.type == "directory":
+                    yield from cls._files(view, stat.inode, child_path)
+                else:
+                    yield child_path, stat
+            after = page[-1][0]
+
+    def _verify(self, since: int):
+        """Читает хвост журнала после контрольной точки и проверяет блоки затронутых им файлов: работа растет с хвостом, а не с образом.
+        Образ открывается только для чтения: до решения о пересборке в поврежденный образ ничего не пишется."""
+        tail = 0
+        touched, copies = set(), set()
+        problems = []
+        try:
+            conn = self._connect(self.db_path)
+        except sqlite3.Error as e:
+            return 0, [f"image cannot be opened: {e}"]
+        view = SQLiteView(conn)
+        try:
+            last = since
+            while True:
+                records = view.journal(last, REPLAY_BATCH_SIZE)
+                if not records:
+                    break
+                last = records[-1][0]
+                for record in records:
+                    tail += 1
+                    if record[6] is not None:
+                        payload = json.loads(record[6])
+                        touched.update(self._touched(payload))
+                        copies.update(row[1] for row in payload.get("copy", []))
+            for path in sorted(touched):
+                entry = self._lookup(view, path)
+                if entry is None:
+                    continue  # путь удален или переименован следующими записями
+                if entry.type == "file":
+                    problems.extend(TNFS._check_file(path, entry, view))
+                elif path in copies:
+                    for child_path, child in self._files(view, entry.inode, path):
+                        problems.extend(TNFS._check_file(child_path, child, view))
+        except Exception as e:
+            problems.append(f"image cannot be read: {e}")
+        finally:
+            conn.close()
+        return tail, problems
+
+    def _rebuild(self, checkpoint: Path, since: int):
+        """Копирует контрольную точку и повторяет на ней хвост журнала из поврежденного образа; поврежденный образ сохраняется рядом."""
+        work = self.db_path.with_name(self.db_path.name + ".recovering")
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{work}{suffix}").unlink(missing_ok=True)
+        shutil.copyfile(checkpoint, work)
+        tail = 0
+        try:
+            damaged = self._connect(self.db_path)
+            tail = damaged.execute("SELECT COUNT(*) FROM journal WHERE id > ?", (since,)).fetchone()[0]
+        except sqlite3.Error as e:
+            self.logger.error(f"Recovery: journal of the damaged image is unreadable, restoring the checkpoint only: {e}")
+            damaged = None
+
+        def records():
+            last = since
+            while damaged is not None:
+                try:
+                    rows = damaged.execute(
+                        "SELECT id, operation, path, timestamp, details, user, payload FROM journal WHERE id > ? ORDER BY id LIMIT ?",
+                        (last, REPLAY_BATCH_SIZE)
+                    ).fetchall()
+                except sqlite3.Error as e:
+                    self.logger.error(f"Recovery: journal of the damaged image is unreadable after entry {last}: {e}")
+                    return
+                if not rows:
+                    return
+                yield from rows
+                last = rows[-1][0]
+
+        def fetch_blob(blob: str) -> Optional[bytes]:
+            if damaged is None:
+                return None
+            try:
+                row = damaged.execute("SELECT codec, content FROM blobs WHERE hash = ?", (blob,)).fetchone()
+                return row and decode(*row)
+            except (sqlite3.Error, ValueError, EOFError, zlib.error, lzma.LZMAError):
+                return None
+
+        tnfs = self._open(work)
+        try:
+            with tnfs._op():
+                # записи, которые успела добавить инициализация, заменяются записями хвоста с теми же номерами
+                tnfs.db.execute("DELETE FROM journal WHERE id > ?", (since,))
+            replayed = tnfs.replay(records(), fetch_blob)
+        finally:
+            self._close(tnfs)
+            if damaged is not None:
+                damaged.close()
+        aside = self.db_path.with_name(f"{self.db_path.name}.damaged-{int(time.time())}")
+        for suffix in ("", "-wal", "-shm"):
+            if Path(f"{self.db_path}{suffix}").exists():
+                os.replace(f"{self.db_path}{suffix}", f"{aside}{suffix}")
+        for suffix in ("", "-wal", "-shm"):
+            if Path(f"{work}{suffix}").exists():
+                os.replace(f"{work}{suffix}", f"{self.db_path}{suffix}")
+        self.logger.warning(f"Damaged TNFS image kept as {aside.name}")
+        return tail, replayed
@@ -16,6 +16,7 @@ from src.core.users import UserManager
 from src.TNFS.TNFS import TNFS
 from src.security.SELinux import SELinux
 from src.shell.shell import Shell
+from src.utils.TunRecovery import TunRecovery
 
 AAU = False
 AAR = False
@@ -26,6 +27,8 @@ def parse_args():
     parser.add_argument("--debug", action="store_true", help="Включить отладочное логирование")
     parser.add_argument("--mode", choices=["enforcing", "permissive"], default="permissive",
                         help="Установить начальный режим SELinux")
+    parser.add_argument("--recover", action="store_true",
+                        help="Пересобрать образ TNFS из последней контрольной точки и журнала")
     return parser.parse_args()
 
 def main():
@@ -48,6 +51,13 @@ def main():
         crash_handler = CrashHandler(logger)
         print('CrashHandler...Initialized')
 
+        # Проверка образа TNFS после некорректной остановки (или принудительное восстановление с --recover)
+        print('Checking TNFS image...')
+        report = TunRecovery(logger, crash_handler).recover(force=args.recover)
+        if report["status"] == "damaged":
+            print('TNFS image is damaged and no checkpoint is available, see logs')
+        print(f"Checking TNFS image...{report['status'].upper()}")
+
         # Инициализация UserManager
         print('Initialize UserManager...')
         user_manager = UserManager(logger, crash_handler)
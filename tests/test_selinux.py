@@ -1,6 +1,8 @@
 import pytest
+import json
 import sqlite3
 import time
+import threading
 import os
 import sys
 INIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -9,6 +11,9 @@ from src.libs.logging import Logger
 from src.libs.CrashHandler import CrashHandler, TunderCrash
 from src.TNFS.TNFS import TNFS
 from src.security.SELinux import SELinux
+from src.security.policy import PolicyTrie
+from src.security.avc import AccessVectorCache
+from src.security.audit import AuditWriter
 from src.core.users import UserManager
 
 @pytest.fixture
@@ -140,6 +145,15 @@ def selinux(temp_tnfs_db, temp_selinux_db, temp_users_db):
     tnfs.db.close()
     user_manager.db.close()
 
+@pytest.fixture
+def local_selinux(tmp_path):
+    """SELinux без TNFS со своей базой в tmp_path и политикой по умолчанию."""
+    logger = Logger("test")
+    crash_handler = CrashHandler(logger)
+    selinux = SELinux(logger, crash_handler, None, tmp_path / "selinux.db")
+    yield selinux
+    selinux.close()
+
 def test_check_access_enforcing(selinux):
     selinux.set_mode("enforcing")
     try:
@@ -161,6 +175,7 @@ def test_check_access_permissive(selinux):
     result = selinux.tnfs.db.execute("SELECT path FROM files WHERE path = ?", ("/home/test.txt",)).fetchone()
     assert result is not None, f"File /home/test.txt not found in database"
     assert selinux.check_access("/home/test.txt", "write", "guest", "guest", session_id=selinux.tnfs.user_manager.current_session_id) == True
+    selinux.flush_audit()
     audit = selinux.db.execute("SELECT result, mode FROM selinux_audit WHERE operation = 'write'").fetchone()
     assert audit == ("granted", "permissive")
 
@@ -236,5 +251,178 @@ def test_audit_logging(selinux):
     result = selinux.tnfs.db.execute("SELECT path FROM files WHERE path = ?", ("/home/test.txt",)).fetchone()
     assert result is not None, f"File /home/test.txt not found in database"
     selinux.check_access("/home/test.txt", "read", "user", "user", session_id=selinux.tnfs.user_manager.current_session_id)
+    selinux.flush_audit()
     audit = selinux.db.execute("SELECT session_id, username, operation, result FROM selinux_audit").fetchone()
-    assert audit == (selinux.tnfs.user_manager.current_session_id, "user", "read", "granted")
\ No newline at end of file
+    assert audit == (selinux.tnfs.user_manager.current_session_id, "user", "read", "granted")
+
+def test_policy_trie_picks_most_specific_rule():
+    trie = PolicyTrie({
+        "/": {"read": ["root"]},
+        "/home": {"read": ["user"]},
+        "/home/*": {"read": ["user"], "write": ["user"]},
+        "/home/*/secret": {"read": []},
+        "/home/*/*.txt": {"read": ["guest"]},
+        "/var/**": {"read": ["guest"]},
+        "/var/**/*.log": {"read": ["user"]},
+    })
+    cases = {"/": "/", "/etc": "/", "/home": "/home", "/home/a": "/home/*", "/home/a/b": "/home/*",
+             "/home/a/secret": "/home/*/secret", "/home/a/notes.txt": "/home/*/*.txt", "/var/x/y/z": "/var/**",
+             "/var/x/y/app.log": "/var/**/*.log", "/home/a/b/c/d": "/home/*", "/etc/passwd": "/"}
+    assert {path: getattr(trie.match(path), "pattern", None) for path in cases} == cases
+    assert trie.match("/home/a").allows("write", trie.role_bit("user"))
+    assert not trie.match("/home/a/secret").allows("read", trie.role_bit("user"))
+    assert trie.role_bit("nobody") == 0 and PolicyTrie({"/home": {"read": ["user"]}}).match("/etc") is None
+    trie.remove("/home/*/secret")
+    trie.remove("/home/*/*.txt")
+    trie.remove("/home/*")
+    assert trie.match("/home/a").pattern == "/home" and trie.root.children["home"].star is None and trie.size == 4
+    # полное совпадение шаблона глубже литерального префикса
+    trie = PolicyTrie({"/home/user": {"read": ["user"]}, "/home/*/secret": {"read": []}})
+    assert trie.match("/home/user/secret").pattern == "/home/*/secret"
+    assert trie.match("/home/user/docs").pattern == "/home/user"
+    trie = PolicyTrie({"/home/*": {"read": ["user"]}, "/home/**/x.txt": {"read": []}})
+    assert trie.match("/home/a/b/x.txt").pattern == "/home/**/x.txt"
+    assert trie.match("/home/a/b/y.txt").pattern == "/home/*"
+
+def test_check_access_honors_wildcard_rules(local_selinux):
+    selinux = local_selinux
+    selinux.set_mode("enforcing")
+    selinux.add_rule("/home/*", "write", ["user"], "directory")
+    selinux.add_rule("/home/**/private", "read", ["root"], "directory")
+    assert selinux.check_access("/home/alice/docs/a.txt", "write", "alice", "user", session_id=1)
+    with pytest.raises(TunderCrash, match="Denied read on /home/alice/private"):
+        selinux.check_access("/home/alice/private", "read", "alice", "user", session_id=1)
+    selinux.remove_rule("/home/*", "write", ["user"])
+    with pytest.raises(TunderCrash, match="Denied write on /home/alice/docs"):
+        selinux.check_access("/home/alice/docs", "write", "alice", "user", session_id=1)
+
+def test_access_vector_cache_hits_and_invalidates(local_selinux):
+    selinux = local_selinux
+    selinux.set_mode("enforcing")
+    assert selinux.check_access("/tmp/a", "write", "alice", "user", session_id=1)
+    assert selinux.check_access("/tmp/a", "write", "alice", "user", session_id=1)
+    stats = selinux.avc.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    with pytest.raises(TunderCrash):
+        selinux.check_access("/etc/a", "write", "alice", "user", session_id=1)
+    selinux.add_rule("/etc", "write", ["user"], "directory")
+    assert selinux.check_access("/etc/a", "write", "alice", "user", session_id=1)
+    assert selinux.avc.stats()["misses"] == 3
+    selinux.set_mode("permissive")
+    assert selinux.check_access("/var/a", "write", "alice", "user", session_id=1)
+    selinux.set_mode("enforcing")
+    with pytest.raises(TunderCrash):
+        selinux.check_access("/var/a", "write", "alice", "user", session_id=1)
+
+    avc = AccessVectorCache(max_entries=2)
+    for path in ("/a", "/b", "/c"):
+        avc.put("user", path, "read", True, avc.generation)
+    assert avc.get("user", "/a", "read") is None
+    assert avc.get("user", "/c", "read") is True
+    avc.put("user", "/d", "read", True, avc.generation - 1)
+    assert avc.get("user", "/d", "read") is None
+    assert avc.stats()["evictions"] == 1
+
+def test_audit_writer_batches_collapses_and_keeps_denials(local_selinux):
+    selinux = local_selinux
+    selinux.set_mode("enforcing")
+    started = time.time()
+    for _ in range(5):
+        selinux.check_access("/tmp/a", "read", "auditor", "user", session_id=7)
+    with pytest.raises(TunderCrash):
+        selinux.check_access("/etc/a", "write", "auditor", "user", session_id=7)
+    logs = [log for log in selinux.get_audit_logs() if log["username"] == "auditor" and log["timestamp"] >= started]
+    assert sorted((log["path"], log["result"], log["count"]) for log in logs) == [("/etc/a", "denied", 1), ("/tmp/a", "granted", 5)]
+
+    db = sqlite3.connect(":memory:", check_same_thread=False)
+    db.execute("CREATE TABLE selinux_audit (session_id, username, role, path, operation, result, timestamp, mode, count)")
+    lock = threading.Lock()
+    writer = AuditWriter(db, lock, selinux.logger, max_queue=2, batch_size=1, put_timeout=0.01)
+    event = (1, "u", "user", "/a", "read", "granted", 0.0, "enforcing")
+    with lock:  # писатель занят: очередь заполняется
+        for _ in range(10):
+            writer.record(event)
+        assert writer.dropped > 0
+        denial = threading.Thread(target=writer.record, args=((1, "u", "user", "/a", "write", "denied", 1.0, "enforcing"),))
+        denial.start()
+        denial.join(0.1)
+        assert denial.is_alive()  # отказ ждет места в очереди, а не отбрасывается
+    denial.join()
+    writer.close()
+    assert db.execute("SELECT count(*) FROM selinux_audit WHERE result = 'denied'").fetchone() == (1,)
+    assert db.execute("SELECT sum(count) FROM selinux_audit WHERE result = 'granted'").fetchone() == (10 - writer.dropped,)
+    writer.record(event)  # после close событие пишется сразу
+    assert writer.stats()["written"] == 12 - writer.dropped
+
+def test_audit_log_queries_filter_and_paginate(local_selinux):
+    selinux = local_selinux
+    selinux.audit.collapse = False  # каждая проверка - отдельная строка аудита
+    selinux.set_mode("enforcing")
+    started = time.time()
+    for path in ("/tmp/d", "/tmp/d/x", "/tmp/dx") * 8:
+        selinux.check_access(path, "read", "pager", "user", session_id=9)
+    with pytest.raises(TunderCrash):
+        selinux.check_access("/etc/d", "write", "pager", "user", session_id=9)
+    pages, cursor = [], None
+    while True:
+        logs, cursor = selinux.query_audit_logs(10, cursor, username="pager", since=started)
+        pages.append(logs)
+        if cursor is None:
+            break
+    assert [len(page) for page in pages] == [10, 10, 5]
+    ordered = [log["id"] for page in pages for log in page]
+    assert ordered == sorted(ordered, reverse=True)
+    assert len(list(selinux.iter_audit_logs(page_size=4, username="pager", path="/tmp/d", since=started))) == 16
+    denied = selinux.get_audit_logs(username="pager", result="denied", since=started)
+    assert [(log["path"], log["operation"]) for log in denied] == [("/etc/d", "write")]
+    with pytest.raises(TunderCrash, match="Invalid audit result"):
+        selinux.query_audit_logs(result="maybe")
+    with pytest.raises(TunderCrash, match="Invalid audit page size"):
+        selinux.query_audit_logs(0, username="pager")
+    with pytest.raises(TunderCrash, match="Invalid audit page size"):
+        next(selinux.iter_audit_logs(page_size=0, username="pager"))
+    plan = selinux.db.execute("EXPLAIN QUERY PLAN SELECT id FROM selinux_audit WHERE username = ? ORDER BY timestamp DESC", ("pager",)).fetchall()
+    assert "selinux_audit_username" in str(plan) and "TEMP B-TREE" not in str(plan)
+
+    follow = selinux.follow_audit_logs(ordered[0], interval=0.01, username="pager")
+    selinux.check_access("/tmp/new", "read", "pager", "user", session_id=9)
+    assert next(follow)["path"] == "/tmp/new"
+    follow.close()
+
+def test_policy_store_persists_changes_and_bulk_loads(tmp_path):
+    logger = Logger("test")
+    crash_handler = CrashHandler(logger)
+    selinux = SELinux(logger, crash_handler, None, tmp_path / "selinux.db")
+    selinux.add_rule("/srv/*", "read", ["user"], "directory")
+    selinux.remove_rule("/tmp", "delete", ["guest"])
+    selinux.set_mode("enforcing")
+    selinux.close()
+    selinux = SELinux(logger, crash_handler, None, tmp_path / "selinux.db")
+    assert selinux.mode == "enforcing"
+    assert selinux.policies["rules"]["/srv/*"]["read"] == ["user"]
+    assert "guest" not in selinux.policies["rules"]["/tmp"]["delete"]
+    assert list(selinux.policies["rules"])[-1] == "/srv/*"
+
+    policy = tmp_path / "policy.json"
+    policy.write_text(json.dumps({"rules": {f"/bulk/{i}": {"read": ["guest"], "type": "file"} for i in range(5000)}}))
+    assert selinux.load_policy(str(policy)) == 5000
+    assert selinux.compiled.size == 5007
+    assert selinux.check_access("/bulk/42", "read", "g", "guest", session_id=1)
+    broken = tmp_path / "broken.json"
+    broken.write_text(json.dumps({"/ok": {"read": ["user"]}, "relative": {"read": ["user"]}}))
+    with pytest.raises(TunderCrash, match="Invalid policy rule for relative"):
+        selinux.load_policy(str(broken))
+    assert "/ok" not in selinux.policies["rules"]
+    policy.write_text(json.dumps({"mode": "permissive", "rules": {"/": {"read": ["root"], "type": "directory"}}}))
+    assert selinux.load_policy(str(policy), replace=True) == 1
+    selinux.close()
+    selinux = SELinux(logger, crash_handler, None, tmp_path / "selinux.db")
+    assert selinux.policies == {"mode": "permissive", "rules": {"/": {"read": ["root"], "type": "directory"}}}
+    selinux.close()
+
+    legacy = tmp_path / "selinux_policies.json"  # прежнее хранилище рядом с новой базой
+    legacy.write_text(json.dumps({"mode": "permissive", "rules": {"/legacy": {"read": ["user"], "type": "directory"}}}))
+    selinux = SELinux(logger, crash_handler, None, tmp_path / "migrated.db")
+    assert selinux.policies["rules"] == {"/legacy": {"read": ["user"], "type": "directory"}}
+    assert not legacy.exists() and legacy.with_name("selinux_policies.json.migrated").exists()
+    selinux.close()
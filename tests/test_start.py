@@ -10,12 +10,22 @@ from src.libs.CrashHandler import CrashHandler
 from src.core.TunKernel import Kernel
 from src.shell.shell import Shell
 
-def test_start_with_default_args():
+@pytest.fixture(autouse=True)
+def tnfs_image(tmp_path, monkeypatch):
+    """Образ TNFS и артефакты восстановления лежат в tmp_path, а не в data/."""
+    import start  # загружает модули под обоими путями импорта: src.TNFS.TNFS и TNFS.TNFS
+    image = tmp_path / "tnfs.db"
+    for module in ("src.TNFS.TNFS", "src.utils.TunRecovery", "TNFS.TNFS", "utils.TunRecovery"):
+        monkeypatch.setattr(sys.modules[module], "TNFS_DB", image)
+    return image
+
+def test_start_with_default_args(tnfs_image):
     with patch.object(sys, "argv", ["start.py"]):
         from start import main
         with patch("src.shell.shell.Shell.run") as mock_shell_run:
             main()
             assert mock_shell_run.called
+            assert tnfs_image.exists()
             logger = Logger("system")
             assert logger.last_message == "Shell initialized"
 
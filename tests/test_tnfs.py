@@ -2,7 +2,10 @@
 #created by SKATT
 import pytest
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import os
+import tarfile
 import sys
 INIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(INIT_DIR) 
@@ -11,6 +14,10 @@ from src.libs.logging import Logger
 from src.libs.CrashHandler import CrashHandler, TunderCrash
 from src.core.users import UserManager
 from src.security.SELinux import SELinux
+from src.TNFS.cache import ContentCache
+from src.TNFS.pool import ReaderPool
+from src.TNFS.backend import BACKENDS
+from src.utils.TunRecovery import TunRecovery
 
 @pytest.fixture
 def temp_db(tmp_path):
@@ -71,7 +78,7 @@ def selinux(temp_db):
     yield selinux
 
     # Закрываем соединения после тестов
-    selinux.db.close()
+    selinux.close()
     tnfs.db.close()
 
 def test_check_access_enforcing(selinux):
@@ -87,6 +94,7 @@ def test_check_access_permissive(selinux):
     selinux.tnfs.create_directory("/home", owner="root", perms=755)
     selinux.tnfs.create_file("/home/test.txt", "test", owner="root", perms=644)
     assert selinux.check_access("/home/test.txt", "write", "guest", "guest", session_id=1) == True
+    selinux.flush_audit()
     audit = selinux.db.execute("SELECT result, mode FROM selinux_audit WHERE operation = 'write'").fetchone()
     assert audit == ("granted", "permissive")
 
@@ -142,5 +150,765 @@ def test_audit_logging(selinux):
     selinux.tnfs.create_directory("/home", owner="root", perms=755)
     selinux.tnfs.create_file("/home/test.txt", "test", owner="root", perms=644)
     selinux.check_access("/home/test.txt", "read", "user", "user", session_id=1)
+    selinux.flush_audit()
     audit = selinux.db.execute("SELECT session_id, username, operation, result FROM selinux_audit").fetchone()
-    assert audit == (1, "user", "read", "granted")
\ No newline at end of file
+    assert audit == (1, "user", "read", "granted")
+
+@pytest.fixture(params=BACKENDS)
+def tnfs(request, tmp_path):
+    """TNFS на каждом хранилище из BACKENDS; тесты внутренностей SQLite помечаются sqlite_only."""
+    logger = Logger("test")
+    crash_handler = CrashHandler(logger)
+    user_manager = UserManager(logger, crash_handler)
+    tnfs = TNFS(logger, crash_handler, user_manager, None, db_path=tmp_path / "image.db", backend=getattr(request, "param", "sqlite"))
+    tnfs.current_user = "root"
+    tnfs.current_role = "root"
+    selinux = SELinux(logger, crash_handler, tnfs)
+    selinux.set_mode("permissive")
+    tnfs.selinux = selinux
+    user_manager.tnfs = tnfs
+    yield tnfs
+    selinux.close()
+    tnfs.store.close()
+
+def sqlite_only(reason):
+    """Тест смотрит во внутренности SQLite (tnfs.db, readers) или в его возможности: на остальных хранилищах пропускается."""
+    return pytest.mark.parametrize("tnfs", [backend if backend == "sqlite" else pytest.param(backend, marks=pytest.mark.skip(reason=f"{backend}: {reason}"))
+                                            for backend in BACKENDS], indirect=True)
+
+@sqlite_only("checks the SQLite query plan")
+def test_list_directory_uses_parent_index(tnfs):
+    tnfs.create_directory("/home/docs", owner="root", perms=0o755)
+    tnfs.create_file("/home/docs/a.txt", "a", owner="root", perms=0o644)
+    tnfs.create_file("/home/b.txt", "b", owner="root", perms=0o644)
+    assert tnfs.list_directory("/home") == ["b.txt", "docs"]
+    assert tnfs.list_directory("/home/docs") == ["a.txt"]
+    assert tnfs.count_children("/home") == 2
+    plan = " ".join(row[3] for row in tnfs.db.execute("EXPLAIN QUERY PLAN SELECT name FROM dentries WHERE parent = ?", (1,)))
+    assert "PRIMARY KEY" in plan
+
+def test_remove_non_empty_directory(tnfs):
+    tnfs.create_directory("/home/docs", owner="root", perms=0o755)
+    tnfs.create_file("/home/docs/a.txt", "a", owner="root", perms=0o644)
+    with pytest.raises(TunderCrash, match="Directory not empty"):
+        tnfs.remove("/home/docs")
+    tnfs.remove("/home/docs/a.txt")
+    assert tnfs.remove("/home/docs") == True
+
+@sqlite_only("counts SQLite UPDATE statements")
+def test_rename_directory_moves_subtree_with_one_row(tnfs):
+    tnfs.create_directory("/home/a", owner="root", perms=0o755)
+    tnfs.create_directory("/home/a/b", owner="root", perms=0o755)
+    tnfs.create_file("/home/a/b/c.txt", "deep", owner="root", perms=0o644)
+    assert tnfs.read_file("/home/a/b/c.txt") == "deep"
+    updates = []
+    tnfs.db.set_trace_callback(lambda sql: updates.append(sql) if sql.lstrip().upper().startswith("UPDATE DENTRIES") else None)
+    tnfs.move_directory("/home/a", "/tmp/z")
+    tnfs.db.set_trace_callback(None)
+    assert len(updates) == 1
+    assert tnfs.read_file("/tmp/z/b/c.txt") == "deep"
+    assert tnfs.list_directory("/tmp/z/b") == ["c.txt"]
+    assert tnfs.path_type("/home/a/b/c.txt") is None
+    assert tnfs.db.execute("SELECT path FROM files WHERE path LIKE '/home/a%'").fetchall() == []
+    with pytest.raises(TunderCrash, match="into itself"):
+        tnfs.rename_directory("/tmp/z", "/tmp/z/b/loop")
+
+@sqlite_only("migrates a pre-inode SQLite image")
+def test_migrate_old_image(temp_db, tnfs):
+    conn = sqlite3.connect(temp_db)
+    conn.execute("INSERT INTO files VALUES ('/', 1, '', 'root', 493, 'directory', 0, 0, 0)")
+    conn.execute("INSERT INTO files VALUES ('/home', 2, '', 'root', 493, 'directory', 0, 0, 0)")
+    conn.execute("INSERT INTO files VALUES ('/home/a.txt', 3, 'a', 'root', 420, 'file', 1, 0, 0)")
+    conn.execute("INSERT INTO files VALUES ('/home/b.txt', 4, 'a', 'root', 420, 'file', 1, 0, 0)")
+    conn.commit()
+    conn.close()
+    tnfs.db = sqlite3.connect(temp_db, check_same_thread=False)
+    tnfs.readers = ReaderPool(temp_db)
+    tnfs.init_default_structure()
+    assert tnfs.db.execute("SELECT parent FROM files WHERE path = '/home/a.txt'").fetchone() == ("/home",)
+    assert tnfs.list_directory("/home") == ["a.txt", "b.txt"]
+    assert tnfs.db.execute("SELECT COUNT(*), SUM(ref_count) FROM blobs").fetchone() == (1, 2)
+    assert tnfs.read_file("/home/b.txt") == "a"
+
+@sqlite_only("migrates a pre-inode SQLite image")
+def test_migrate_restores_orphaned_descendants(temp_db, tnfs):
+    conn = sqlite3.connect(temp_db)
+    conn.execute("INSERT INTO files VALUES ('/', 1, '', 'root', 493, 'directory', 0, 0, 0)")
+    conn.execute("INSERT INTO files VALUES ('/new', 2, '', 'root', 493, 'directory', 0, 0, 0)")
+    conn.execute("INSERT INTO files VALUES ('/old/x.txt', 3, 'x', 'root', 420, 'file', 1, 0, 0)")
+    conn.commit()
+    conn.close()
+    tnfs.db = sqlite3.connect(temp_db, check_same_thread=False)
+    tnfs.readers = ReaderPool(temp_db)
+    tnfs.init_default_structure()
+    assert tnfs.path_type("/old") == "directory"
+    assert tnfs.read_file("/old/x.txt") == "x"
+
+def test_content_cache_lru_budget():
+    cache = ContentCache(max_bytes=10)
+    cache.put("/a", "aaaa", "root", 0o644, "file", 4)
+    cache.put("/b", "bbbb", "root", 0o644, "file", 4)
+    assert cache.get("/a").content == "aaaa"
+    cache.put("/c", "cccc", "root", 0o644, "file", 4)
+    assert cache.get("/b") is None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["bytes"] == 8
+
+@sqlite_only("changes permissions behind TNFS through SQL")
+def test_cache_hit_skips_sqlite_permission_lookup(tnfs):
+    tnfs.create_file("/tmp/a.txt", "hello", owner="root", perms=0o644)
+    assert tnfs.read_file("/tmp/a.txt") == "hello"
+    tnfs.db.execute("UPDATE inodes SET perms = 0 WHERE inode = (SELECT inode FROM files WHERE path = '/tmp/a.txt')")
+    tnfs.db.commit()
+    assert tnfs.read_file("/tmp/a.txt") == "hello"
+    assert tnfs.cache.stats()["hits"] >= 1
+
+def test_cache_invalidation(tnfs):
+    tnfs.create_directory("/tmp/d", owner="root", perms=0o755)
+    tnfs.create_file("/tmp/d/a.txt", "a", owner="root", perms=0o644)
+    tnfs.read_file("/tmp/d/a.txt")
+    tnfs.chmod("/tmp/d/a.txt", 0o600)
+    assert tnfs.cache.get("/tmp/d/a.txt").perms == 0o600
+    tnfs.rename_directory("/tmp/d", "/tmp/e")
+    assert "/tmp/d/a.txt" not in tnfs.cache
+
+def test_copy_shares_blob_and_write_is_copy_on_write(tnfs):
+    tnfs.create_file("/tmp/a.txt", "shared", owner="root", perms=0o644)
+    tnfs.copy_file("/tmp/a.txt", "/tmp/b.txt")
+    assert tnfs.storage_stats()["blobs"] == 1 and tnfs.fsck("/") == []
+    tnfs.write_file("/tmp/b.txt", "changed")
+    assert tnfs.read_file("/tmp/a.txt") == "shared"
+    assert tnfs.read_file("/tmp/b.txt") == "changed"
+    tnfs.remove("/tmp/a.txt")
+    tnfs.remove("/tmp/b.txt")
+    assert tnfs.storage_stats()["blobs"] == 0
+
+def test_identical_files_stored_once(tnfs):
+    tnfs.create_file("/home/x.txt", "same", owner="root", perms=0o644)
+    tnfs.create_file("/tmp/y.txt", "same", owner="root", perms=0o644)
+    assert tnfs.storage_stats()["blobs"] == 1
+
+def test_large_file_is_chunked(tnfs):
+    from src.TNFS.TNFS import CHUNK_SIZE
+    content = "x" * (CHUNK_SIZE * 2 + 10)
+    tnfs.create_file("/tmp/big.txt", content, owner="root", perms=0o644)
+    assert len(tnfs.store.extents(tnfs.stat("/tmp/big.txt").inode)) == 3
+    # два одинаковых полных блока хранятся одним blob
+    assert tnfs.storage_stats()["blobs"] == 2
+    assert tnfs.read_file("/tmp/big.txt") == content
+
+def test_open_handle_read_seek_write_append(tnfs):
+    from src.TNFS.TNFS import CHUNK_SIZE
+    tnfs.create_file("/tmp/log.txt", "a" * CHUNK_SIZE, owner="root", perms=0o644)
+    with tnfs.open("/tmp/log.txt", "a") as f:
+        f.append("line\n")
+    with tnfs.open("/tmp/log.txt", "r") as f:
+        f.seek(CHUNK_SIZE - 2)
+        assert f.read(7) == "aaline\n"
+        assert f.read() == ""
+    with tnfs.open("/tmp/log.txt", "r+b") as f:
+        f.seek(1)
+        f.write(b"XY")
+    assert tnfs.read_file("/tmp/log.txt")[:4] == "aXYa"
+    assert tnfs.stat("/tmp/log.txt").size == CHUNK_SIZE + 5
+    with tnfs.open("/tmp/new.txt", "w") as f:
+        f.write("fresh")
+    assert "".join(tnfs.open("/tmp/new.txt")) == "fresh"
+
+def journal_operations(tnfs, prefix):
+    return [record[1] for record in tnfs.store.journal() if record[2].startswith(prefix)]
+
+def count_commits(tnfs, monkeypatch):
+    commits = []
+    commit = tnfs.store.commit
+    def counted():
+        commits.append(1)
+        commit()
+    monkeypatch.setattr(tnfs.store, "commit", counted)
+    return commits
+
+def test_operation_commits_once_with_journal(tnfs, monkeypatch):
+    commits = count_commits(tnfs, monkeypatch)
+    tnfs.create_file("/tmp/a.txt", "a", owner="root", perms=0o644)
+    assert len(commits) == 1
+    assert journal_operations(tnfs, "/tmp/a.txt") == ["create"]
+
+def test_failed_operation_rolls_back_its_journal(tnfs):
+    with pytest.raises(TunderCrash):
+        tnfs.create_file("/nonexistent/a.txt", "a", owner="root", perms=0o644)
+    assert tnfs._journal_buffer == []
+    assert not tnfs.store.in_transaction
+
+def test_group_commit_batches_operations(tmp_path):
+    logger = Logger("test")
+    crash_handler = CrashHandler(logger)
+    user_manager = UserManager(logger, crash_handler)
+    tnfs = TNFS(logger, crash_handler, user_manager, None, db_path=tmp_path / "group.db",
+                journal_mode="group", group_commit_size=10, group_commit_latency=60)
+    tnfs.current_user = tnfs.current_role = "root"
+    tnfs.selinux = SELinux(logger, crash_handler, tnfs)
+    tnfs.selinux.set_mode("permissive")
+    for i in range(5):
+        tnfs.create_file(f"/tmp/{i}.txt", "x", owner="root", perms=0o644)
+    reader = sqlite3.connect(tmp_path / "group.db")
+    assert reader.execute("SELECT COUNT(*) FROM journal WHERE path LIKE '/tmp/%'").fetchone() == (0,)
+    tnfs.flush()
+    assert reader.execute("SELECT COUNT(*) FROM journal WHERE path LIKE '/tmp/%'").fetchone() == (5,)
+    for i in range(5, 14):
+        tnfs.create_file(f"/tmp/{i}.txt", "x", owner="root", perms=0o644)
+    assert reader.execute("SELECT COUNT(*) FROM files WHERE path LIKE '/tmp/%'").fetchone() == (5,)
+    tnfs.create_file("/tmp/14.txt", "x", owner="root", perms=0o644)
+    assert reader.execute("SELECT COUNT(*) FROM files WHERE path LIKE '/tmp/%'").fetchone() == (15,)
+    reader.close()
+    tnfs.selinux.close()
+    tnfs.db.close()
+
+def test_group_commit_latency_holds_without_more_operations(tmp_path):
+    import time
+    logger = Logger("test")
+    crash_handler = CrashHandler(logger)
+    user_manager = UserManager(logger, crash_handler)
+    tnfs = TNFS(logger, crash_handler, user_manager, None, db_path=tmp_path / "group.db",
+                journal_mode="group", group_commit_size=100, group_commit_latency=0.05)
+    tnfs.current_user = tnfs.current_role = "root"
+    tnfs.selinux = SELinux(logger, crash_handler, tnfs)
+    tnfs.selinux.set_mode("permissive")
+    reader = sqlite3.connect(tmp_path / "group.db")
+    count = lambda: reader.execute("SELECT COUNT(*) FROM journal WHERE path LIKE '/tmp/%'").fetchone()[0]
+    def committed(expected):
+        deadline = time.monotonic() + 5
+        while count() < expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return count()
+
+    tnfs.create_file("/tmp/idle.txt", "x", owner="root", perms=0o644)
+    assert count() == 0
+    assert committed(1) == 1
+    # писатель простаивает с отложенной группой: другой поток не ждет его следующей операции
+    tnfs.create_file("/tmp/first.txt", "x", owner="root", perms=0o644)
+    other = threading.Thread(target=tnfs.create_file, args=("/tmp/second.txt", "y"), kwargs={"owner": "root", "perms": 0o644})
+    other.start()
+    other.join(timeout=5)
+    assert not other.is_alive() and committed(3) == 3
+    assert tnfs.read_file("/tmp/first.txt") == "x" and tnfs.read_file("/tmp/second.txt") == "y"
+    reader.close()
+    tnfs.selinux.close()
+    tnfs.close()
+
+def test_transaction_commits_once(tnfs, monkeypatch):
+    commits = count_commits(tnfs, monkeypatch)
+    with tnfs.transaction():
+        tnfs.create_directory("/tmp/tx")
+        for i in range(3):
+            tnfs.create_file(f"/tmp/tx/{i}.txt", "data", owner="root", perms=0o644)
+        tnfs.flush()
+        assert commits == []
+    assert len(commits) == 1
+    assert len(journal_operations(tnfs, "/tmp/tx")) == 4
+    assert tnfs.list_directory("/tmp/tx") == ["0.txt", "1.txt", "2.txt"]
+
+def test_transaction_rollback_restores_db_and_cache(tnfs):
+    tnfs.create_file("/tmp/keep.txt", "old", owner="root", perms=0o644)
+    assert tnfs.read_file("/tmp/keep.txt") == "old"
+    with pytest.raises(RuntimeError):
+        with tnfs.transaction():
+            tnfs.write_file("/tmp/keep.txt", "new")
+            tnfs.create_file("/tmp/gone.txt", "x", owner="root", perms=0o644)
+            assert tnfs.read_file("/tmp/keep.txt") == "new"
+            raise RuntimeError("abort")
+    assert not tnfs.transaction_active
+    assert tnfs.cache.get("/tmp/keep.txt").content == "old"
+    assert tnfs.read_file("/tmp/keep.txt") == "old"
+    assert tnfs.stat("/tmp/gone.txt") is None
+    assert journal_operations(tnfs, "/tmp/gone.txt") == []
+
+@sqlite_only("counts SQLite lookup statements")
+def test_stat_lookup_once_per_operation(tnfs):
+    tnfs.create_file("/tmp/s.txt", "stat", owner="root", perms=0o644)
+    tnfs.create_file("/tmp/t.txt", "stat", owner="root", perms=0o644)
+    lookups = []
+    with tnfs.transaction():
+        tnfs.db.set_trace_callback(lambda sql: lookups.append(sql) if "FROM dentries" in sql or "FROM inodes" in sql else None)
+        tnfs.dentries.clear()
+        tnfs.cache.clear()
+        assert tnfs.read_file("/tmp/s.txt") == "stat"
+        assert len(lookups) == 3  # "/", "tmp", "s.txt"
+        del lookups[:]
+        assert tnfs.read_file("/tmp/t.txt") == "stat"
+        assert len(lookups) == 1
+        del lookups[:]
+        tnfs.write_file("/tmp/s.txt", "changed")
+        tnfs.chmod("/tmp/s.txt", 0o600)
+        assert tnfs.read_file("/tmp/s.txt") == "changed"
+        assert lookups == []
+        tnfs.db.set_trace_callback(None)
+    st = tnfs.stat("/tmp/s.txt")
+    assert (st.type, st.perms, st.size) == ("file", 0o600, 7)
+    assert tnfs.dentries.stats()["stat_hits"] >= 1
+
+@sqlite_only("readers of the in-memory tables see uncommitted writes, see docs/TNFS.markdown")
+def test_readers_see_committed_snapshot_during_write(tnfs):
+    tnfs.create_file("/tmp/shared.txt", "v1", owner="root", perms=0o644)
+    with tnfs.transaction():
+        tnfs.write_file("/tmp/shared.txt", "v2")
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            seen = list(pool.map(lambda _: tnfs.read_file("/tmp/shared.txt"), range(8)))
+        assert tnfs.read_file("/tmp/shared.txt") == "v2"
+    assert seen == ["v1"] * 8
+    assert tnfs.readers.stats()["opened"] <= 4
+    assert tnfs.db.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert list(pool.map(lambda _: tnfs.read_file("/tmp/shared.txt"), range(4))) == ["v2"] * 4
+
+def test_bulk_copy_directory_progress_and_cancel(tnfs, monkeypatch):
+    monkeypatch.setattr("src.TNFS.TNFS.COPY_BATCH_SIZE", 4)
+    tnfs.create_directory("/home/src", owner="root", perms=0o755)
+    tnfs.create_directory("/home/src/sub", owner="root", perms=0o750)
+    for i in range(6):
+        tnfs.create_file(f"/home/src/sub/{i}.txt", f"data{i % 2}", owner="root", perms=0o644)
+    calls = []
+    assert tnfs.copy_directory("/home/src", "/tmp/dst", progress=lambda done, total: calls.append((done, total)))
+    assert calls == [(4, 7), (7, 7)]
+    assert tnfs.list_directory("/tmp/dst/sub") == [f"{i}.txt" for i in range(6)]
+    assert tnfs.read_file("/tmp/dst/sub/5.txt") == "data1"
+    assert tnfs.stat("/tmp/dst/sub").perms == 0o750
+    assert tnfs.storage_stats()["blobs"] == 2 and tnfs.fsck("/") == []
+    cancel = threading.Event()
+    def stop(done, total):
+        cancel.set()
+    assert tnfs.copy_directory("/home/src", "/tmp/again", progress=stop, cancel=cancel) == False
+    assert tnfs.path_type("/tmp/again") is None
+    assert tnfs.storage_stats()["blobs"] == 2 and tnfs.fsck("/") == []
+
+def test_import_export_tree_round_trip(tnfs, tmp_path, monkeypatch):
+    import tarfile
+    import src.TNFS.TNFS as tnfs_module
+    monkeypatch.setattr(tnfs_module, "IMPORT_BATCH_SIZE", 2)
+    monkeypatch.setattr(tnfs_module, "IMPORT_BUFFER_BYTES", 100 * 1024)
+    host = tmp_path / "host"
+    (host / "sub" / "deep").mkdir(parents=True)
+    (host / "a.txt").write_text("alpha")
+    (host / "empty.txt").write_text("")
+    (host / "sub" / "big.bin").write_bytes(bytes(range(256)) * 1024)
+    (host / "sub" / "deep" / "c.txt").write_text("deep")
+    os.chmod(host / "a.txt", 0o600)
+    os.utime(host / "a.txt", (1000000000, 1000000000))
+    done = []
+    assert tnfs.import_tree(str(host), "/tmp/imported", progress=lambda n, total: done.append(n)) == 6
+    assert done[-1] == 6 and len(done) > 2
+    assert tnfs.read_file("/tmp/imported/a.txt") == "alpha"
+    assert tnfs.read_file("/tmp/imported/sub/deep/c.txt") == "deep"
+    assert tnfs.grep("alpha", "/tmp/imported") == [("/tmp/imported/a.txt", 1, "alpha")]
+    st = tnfs.stat("/tmp/imported/a.txt")
+    assert (st.perms, st.mtime) == (0o600, 1000000000)
+    with tnfs.open("/tmp/imported/sub/big.bin", "rb") as f:
+        assert f.read() == bytes(range(256)) * 1024
+    assert tnfs.fsck("/") == []
+    with pytest.raises(TunderCrash, match="already exists"):
+        tnfs.import_tree(str(host), "/tmp/imported")
+
+    assert tnfs.export_tree("/tmp/imported", str(tmp_path / "out")) == 6
+    assert (tmp_path / "out" / "sub" / "big.bin").read_bytes() == bytes(range(256)) * 1024
+    assert (tmp_path / "out" / "empty.txt").read_bytes() == b""
+    exported = os.stat(tmp_path / "out" / "a.txt")
+    assert (exported.st_mode & 0o777, exported.st_mtime) == (0o600, 1000000000)
+    assert tnfs.export_tree("/tmp/imported", str(tmp_path / "out.tar")) == 6
+    with tarfile.open(tmp_path / "out.tar") as tar:
+        member = tar.getmember("a.txt")
+        assert (member.mode, member.mtime, member.uname) == (0o600, 1000000000, st.owner)
+        assert "ctime" in member.pax_headers
+        assert tar.extractfile("sub/deep/c.txt").read() == b"deep"
+
+def test_export_tree_skips_entries_without_read_permission(tnfs, tmp_path):
+    tnfs.create_directory("/home/root", owner="root", perms=0o755)
+    tnfs.create_file("/home/root/secret.txt", "secret", owner="root", perms=0o600)
+    tnfs.create_file("/home/root/public.txt", "public", owner="root", perms=0o644)
+    tnfs.create_directory("/home/root/private", owner="root", perms=0o700)
+    tnfs.create_file("/home/root/private/inner.txt", "inner", owner="root", perms=0o644)
+    tnfs.current_user = "user"
+    tnfs.current_role = "user"
+    with pytest.raises(TunderCrash, match="No read permission"):
+        tnfs.read_file("/home/root/secret.txt")
+    assert tnfs.export_tree("/home/root", str(tmp_path / "out")) == 1
+    assert sorted(os.listdir(tmp_path / "out")) == ["public.txt"]
+    assert tnfs.export_tree("/home/root", str(tmp_path / "out.tar")) == 1
+    with tarfile.open(tmp_path / "out.tar") as tar:
+        assert tar.getnames() == ["public.txt"]
+
+def test_grep_and_find_use_content_index(tnfs):
+    tnfs.create_directory("/home/docs", owner="root", perms=0o755)
+    tnfs.create_file("/home/docs/a.txt", "first line\nneedle here\n", owner="root", perms=0o644)
+    tnfs.create_file("/home/docs/secret.txt", "needle", owner="root", perms=0o600)
+    tnfs.create_file("/tmp/other.txt", "needle too", owner="root", perms=0o644)
+    tnfs.copy_directory("/home/docs", "/home/copy")
+    with tnfs.open("/tmp/other.txt", "a") as f:
+        f.write("\nappended needle")
+    assert tnfs.grep("needle", "/tmp") == [("/tmp/other.txt", 1, "needle too"), ("/tmp/other.txt", 2, "appended needle")]
+    assert [m[0] for m in tnfs.grep("needle", "/home")] == ["/home/copy/a.txt", "/home/copy/secret.txt", "/home/docs/a.txt", "/home/docs/secret.txt"]
+    tnfs.current_user = "user"
+    assert [m[0] for m in tnfs.grep("needle", "/home")] == ["/home/copy/a.txt", "/home/docs/a.txt"]
+    assert tnfs.find("/home", "*.txt") == ["/home/copy/a.txt", "/home/docs/a.txt"]
+    tnfs.current_user = "root"
+    tnfs.write_file("/home/docs/a.txt", "gone")
+    tnfs.remove("/home/copy/a.txt")
+    assert [m[0] for m in tnfs.grep("needle", "/home")] == ["/home/copy/secret.txt", "/home/docs/secret.txt"]
+    assert tnfs.grep("dl") == tnfs.grep("needle")
+    assert tnfs.find("/home", "sec*") == ["/home/copy/secret.txt", "/home/docs/secret.txt"]
+
+@sqlite_only("inspects the SQLite FTS5 tables")
+def test_content_index_shares_entries_and_reads_text_from_blobs(tnfs):
+    tnfs.create_directory("/home/src", owner="root", perms=0o755)
+    for i in range(3):
+        tnfs.create_file(f"/home/src/{i}.txt", f"needle {i}\n" * 100, owner="root", perms=0o644)
+    tnfs.create_file("/home/src/same.txt", "needle 0\n" * 100, owner="root", perms=0o644)
+    tnfs.copy_directory("/home/src", "/home/dst")
+    # индекс не хранит текст: копии и файлы с одинаковым содержимым ссылаются на одну запись
+    assert tnfs.db.execute("SELECT name FROM sqlite_master WHERE name = 'content_index_content'").fetchone() is None
+    assert tnfs.db.execute("SELECT COUNT(*), SUM(ref_count) FROM content_docs").fetchone() == (3, 8)
+    assert [m[0] for m in tnfs.grep("needle 0", "/home") if m[1] == 1] == ["/home/dst/0.txt", "/home/dst/same.txt", "/home/src/0.txt", "/home/src/same.txt"]
+    tnfs.write_file("/home/src/1.txt", "other")
+    tnfs.remove("/home/dst/1.txt")
+    assert tnfs.grep("needle 1") == []
+    assert tnfs.store.prune_index() == 1
+    assert tnfs.db.execute("SELECT COUNT(*) FROM content_docs WHERE ref_count <= 0").fetchone() == (0,)
+    assert tnfs.grep("other") == [("/home/src/1.txt", 1, "other")]
+    assert len(tnfs.grep("needle 2")) == 200
+    plan = " ".join(row[3] for row in tnfs.db.execute("EXPLAIN QUERY PLAN SELECT rowid FROM content_index WHERE content_index MATCH ?", ('"nee"',)))
+    assert "VIRTUAL TABLE INDEX" in plan
+    # v6: индекс с копией текста каждого файла пересоздается, файлы индексируются при первом поиске
+    tnfs.db.execute("DROP TABLE content_index")
+    tnfs.db.execute("CREATE VIRTUAL TABLE content_index USING fts5(content, tokenize = 'trigram', detail = 'none')")
+    tnfs.db.execute("PRAGMA user_version = 6")
+    tnfs.db.commit()
+    tnfs._init_schema()
+    assert tnfs.db.execute("SELECT name FROM sqlite_master WHERE name = 'content_index_content'").fetchone() is None
+    assert len(tnfs.grep("needle 2")) == 200
+
+def test_walk_pages_subtree_in_order(tnfs):
+    tnfs.create_directory("/home/w", owner="root", perms=0o755)
+    tnfs.create_directory("/home/w/sub", owner="root", perms=0o755)
+    for name in ("c.txt", "a.txt", "b.txt"):
+        tnfs.create_file(f"/home/w/{name}", name, owner="root", perms=0o644)
+    tnfs.create_file("/home/w/sub/x.txt", "x", owner="root", perms=0o644)
+    pre = [p for p, _ in tnfs.walk("/home/w", batch_size=2)]
+    assert pre == ["/home/w/a.txt", "/home/w/b.txt", "/home/w/c.txt", "/home/w/sub", "/home/w/sub/x.txt"]
+    post = [p for p, _ in tnfs.walk("/home/w", order="post", batch_size=1)]
+    assert post == ["/home/w/a.txt", "/home/w/b.txt", "/home/w/c.txt", "/home/w/sub/x.txt", "/home/w/sub"]
+    assert tnfs.du("/home/w", stored=True) == {"entries": 5, "files": 4, "directories": 1, "bytes": 16, "stored": 16}
+    assert tnfs.fsck("/") == []
+    with pytest.raises(TunderCrash, match="into itself"):
+        tnfs.copy_directory("/home/w", "/home/w/sub/again")
+    with pytest.raises(TunderCrash, match="Directory not empty"):
+        tnfs.remove("/home/w")
+    tnfs.copy_file("/home/w/a.txt", "/tmp/a.txt")
+    assert tnfs.remove("/home/w", recursive=True) == True
+    assert tnfs.path_type("/home/w") is None
+    assert tnfs.read_file("/tmp/a.txt") == "a.txt"
+    assert tnfs.fsck("/") == []
+    tnfs.store.begin()
+    tnfs.store.set_stat(tnfs.stat("/tmp/a.txt").inode, size=99)
+    tnfs.store.commit()
+    tnfs.dentries.clear()
+    assert tnfs.fsck("/tmp") == ["/tmp/a.txt: size 99 does not match stored content (5 bytes)"]
+
+@sqlite_only("snapshots copy the SQLite image")
+def test_snapshot_create_restore_delete(tnfs, tmp_path):
+    tnfs.create_directory("/home/work", owner="root", perms=0o755)
+    tnfs.create_file("/home/work/a.txt", "before", owner="root", perms=0o644)
+    job = tnfs.snapshot_create("base", wait=True)
+    assert job.error is None and (tmp_path / "snapshots" / "base.db").exists()
+    with pytest.raises(TunderCrash):
+        tnfs.snapshot_create("base")
+    with pytest.raises(TunderCrash):
+        tnfs.snapshot_create("../escape")
+    assert [(s["name"], s["state"]) for s in tnfs.snapshot_list()] == [("base", "ready")]
+    tnfs.write_file("/home/work/a.txt", "after")
+    tnfs.create_file("/home/work/b.txt", "new", owner="root", perms=0o644)
+    assert tnfs.read_file("/home/work/a.txt") == "after"  # запись в кэше содержимого
+    calls = []
+    assert tnfs.snapshot_restore("base", progress=lambda done, total: calls.append((done, total)))
+    assert calls and calls[-1][0] == calls[-1][1]
+    assert tnfs.read_file("/home/work/a.txt") == "before"
+    assert tnfs.list_directory("/home/work") == ["a.txt"]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        assert list(pool.map(lambda _: tnfs.read_file("/home/work/a.txt"), range(2))) == ["before"] * 2
+    assert tnfs.fsck("/") == []
+    assert tnfs.db.execute("SELECT operation FROM journal ORDER BY id DESC LIMIT 1").fetchone() == ("snapshot_restore",)
+    tnfs.current_user = "user"
+    with pytest.raises(TunderCrash):
+        tnfs.snapshot_restore("base")
+    tnfs.current_user = "root"
+    assert tnfs.snapshot_delete("base")
+    assert tnfs.snapshot_list() == []
+    with pytest.raises(TunderCrash):
+        tnfs.snapshot_restore("base")
+
+@sqlite_only("recovery checkpoints copy the SQLite image")
+def test_recovery_verifies_and_rebuilds_from_checkpoint(tnfs):
+    recovery = TunRecovery(tnfs.logger, tnfs.crash_handler, tnfs.db_path)
+    recovery.attach(tnfs)
+    recovery.checkpoint(tnfs, wait=True)
+    tnfs.create_directory("/home/work", owner="root", perms=0o755)
+    tnfs.create_file("/home/work/a.txt", "first" * 20000, owner="root", perms=0o644)
+    tnfs.write_file("/home/work/a.txt", "second")
+    with tnfs.open("/home/work/a.txt", "a") as handle:
+        handle.write(" tail")
+    tnfs.copy_directory("/home/work", "/home/copy")
+    tnfs.rename_file("/home/copy/a.txt", "/home/copy/b.txt")
+    tnfs.chmod("/home/copy/b.txt", 0o600)
+    tnfs.create_file("/home/work/gone.txt", "x", owner="root", perms=0o644)
+    tnfs.remove("/home/work/gone.txt")
+    # blob первой версии a.txt больше не нужен, но хранится до контрольной точки: без него хвост не повторить
+    assert tnfs.db.execute("SELECT COUNT(*) FROM blobs WHERE ref_count <= 0").fetchone()[0] > 0
+    expected = [(path, entry.type, entry.perms, entry.size) for path, entry in tnfs.walk("/")]
+    tnfs.flush()
+    tnfs.readers.close()
+    tnfs.db.close()  # остановка без detach: отметка открытого образа остается
+
+    report = TunRecovery(tnfs.logger, tnfs.crash_handler, tnfs.db_path).recover()
+    assert report["status"] == "verified" and report["tail"] > 0 and report["problems"] == []
+    assert TunRecovery(tnfs.logger, tnfs.crash_handler, tnfs.db_path).recover()["status"] == "clean"
+    recovery.marker.touch()
+    damaged = sqlite3.connect(tnfs.db_path)
+    damaged.execute("UPDATE inodes SET size = 1 WHERE inode = (SELECT inode FROM files WHERE path = '/home/copy/b.txt')")
+    damaged.commit()
+    damaged.close()
+    before = tnfs.db_path.read_bytes()
+    report = TunRecovery(tnfs.logger, tnfs.crash_handler, tnfs.db_path).recover()
+    assert report["status"] == "rebuilt" and report["replayed"] == report["tail"] and report["problems"]
+    # проверка только читает образ: отложенный в сторону образ совпадает с тем, что был до recover
+    aside = [path for path in tnfs.db_path.parent.glob("image.db.damaged-*") if not path.name.endswith(("-wal", "-shm"))]
+    assert len(aside) == 1 and aside[0].read_bytes() == before
+
+    restored = TNFS(tnfs.logger, tnfs.crash_handler, tnfs.user_manager, tnfs.selinux, db_path=tnfs.db_path)
+    restored.current_user = restored.current_role = "root"
+    assert [(path, entry.type, entry.perms, entry.size) for path, entry in restored.walk("/")] == expected
+    assert restored.read_file("/home/copy/b.txt") == "second tail"
+    assert restored.fsck("/") == []
+    recovery.attach(restored)
+    recovery.checkpoint(restored, wait=True)
+    recovery.checkpoint(restored, wait=True)  # вторая точка удаляет blobs, свободные уже в первой
+    assert restored.db.execute("SELECT COUNT(*) FROM blobs WHERE ref_count <= 0").fetchone()[0] == 0
+    recovery.detach(restored)
+    assert not recovery.marker.exists()
+    restored.readers.close()
+    restored.db.close()
+
+def test_read_journal_policies(tnfs):
+    tnfs.create_file("/tmp/hot.txt", "hot", owner="root", perms=0o644)
+    tnfs.create_file("/tmp/cold.txt", "cold", owner="root", perms=0o644)
+    reads = lambda: sum(record[1] == "read" for record in tnfs.store.journal())
+    assert tnfs.read_journal == "aggregated"
+    for _ in range(50):
+        tnfs.read_file("/tmp/hot.txt")  # из кэша содержимого тоже учитывается
+    tnfs.read_file("/tmp/cold.txt")
+    tnfs.list_directory("/tmp")
+    tnfs.flush()
+    assert reads() == 0 and tnfs.store.access("read") == [] and tnfs.store.access("list") == []
+    assert [(path, count) for path, count, _ in tnfs.hot_files(2)] == [("/tmp/hot.txt", 50), ("/tmp/cold.txt", 1)]
+    assert [(path, count) for path, count, _ in tnfs.hot_files(operation="list")] == [("/tmp", 1)]
+    tnfs.read_file("/tmp/hot.txt")
+    assert tnfs.hot_files(1)[0][1] == 51  # счетчик в базе дополняется, а не заменяется
+    tnfs.remove("/tmp/hot.txt")
+    assert [path for path, _, _ in tnfs.hot_files()] == ["/tmp/cold.txt"]
+
+    tnfs.set_read_journal("sampled")
+    tnfs.read_sample_every = 10
+    for _ in range(30):
+        tnfs.read_file("/tmp/cold.txt")
+    tnfs.flush()
+    assert reads() == 3
+    tnfs.set_read_journal("off")
+    tnfs.read_file("/tmp/cold.txt")
+    tnfs.set_read_journal("full")
+    tnfs.read_file("/tmp/cold.txt")
+    tnfs.flush()
+    assert reads() == 4
+    with pytest.raises(TunderCrash):
+        tnfs.set_read_journal("verbose")
+    tnfs.current_user = "user"
+    with pytest.raises(TunderCrash):
+        tnfs.set_read_journal("off")
+
+@sqlite_only("compression is stored in SQLite blobs")
+def test_compressed_blobs_read_transparently(tnfs):
+    log = "".join(f"2025-06-27 23:19:{i % 60:02d} INFO kernel: request {i} served\n" for i in range(4000))
+    tnfs.create_file("/var/app.log", log, owner="root", perms=0o644)
+    tnfs.create_file("/tmp/small.txt", "tiny", owner="root", perms=0o644)
+    assert tnfs.stat("/var/app.log").size == len(log)
+    codecs = {codec for (codec,) in tnfs.db.execute("SELECT codec FROM blobs WHERE size >= 4096")}
+    assert codecs and None not in codecs
+    usage = tnfs.du("/var", stored=True)
+    assert usage["bytes"] == len(log) and usage["stored"] < len(log) // 4
+    tnfs.cache.clear()
+    assert tnfs.read_file("/var/app.log") == log
+    with tnfs.open("/var/app.log", "r+") as handle:
+        handle.seek(70000)
+        handle.write("PATCHED")
+        handle.seek(69998)
+        assert handle.read(11) == log[69998:70000] + "PATCHED" + log[70007:70009]
+    assert tnfs.fsck("/") == []
+
+    tnfs.compression = "off"
+    tnfs.create_file("/var/raw.log", log.upper(), owner="root", perms=0o644)
+    before = tnfs.storage_stats()
+    assert before["codecs"]["raw"] >= 2
+    tnfs.compression = "zlib"
+    calls = []
+    report = tnfs.compress(progress=lambda done, total: calls.append((done, total)))
+    assert report["compressed"] == report["blobs"] >= 2 and report["after"] < report["before"]
+    assert calls[-1][0] == calls[-1][1]
+    after = tnfs.storage_stats()
+    assert after["bytes"] == before["bytes"] and after["stored"] < before["stored"]
+    assert tnfs.compress()["blobs"] == 0
+    tnfs.cache.clear()
+    assert tnfs.read_file("/var/raw.log") == log.upper()
+    tnfs.current_user = "user"
+    with pytest.raises(TunderCrash):
+        tnfs.compress()
+
+def test_usage_counters_and_quotas(tnfs, tmp_path):
+    def recount(path):
+        usage = {"entries": 0, "files": 0, "directories": 0, "bytes": 0}
+        for _, entry in tnfs.walk(path):
+            usage["entries"] += 1
+            usage["files" if entry.type == "file" else "directories"] += 1
+            usage["bytes"] += entry.size or 0
+        return usage
+
+    tnfs.create_directory("/home/q", owner="user", perms=0o755)
+    tnfs.create_directory("/home/q/sub", owner="user", perms=0o755)
+    tnfs.create_file("/home/q/a.txt", "a" * 100, owner="user", perms=0o644)
+    tnfs.create_file("/home/q/sub/b.txt", "b" * 50, owner="user", perms=0o644)
+    tnfs.write_file("/home/q/a.txt", "a" * 10)
+    with tnfs.open("/home/q/sub/b.txt", "a") as handle:
+        handle.write("c" * 20)
+    tnfs.copy_directory("/home/q", "/tmp/q")
+    tnfs.rename_directory("/tmp/q/sub", "/home/q/moved")
+    tnfs.remove("/tmp/q", recursive=True)
+    (tmp_path / "host" / "d").mkdir(parents=True)
+    (tmp_path / "host" / "d" / "h.txt").write_text("h" * 30)
+    tnfs.import_tree(str(tmp_path / "host"), "/home/q/imported")
+    for path in ("/", "/home", "/home/q", "/tmp"):
+        assert tnfs.du(path) == recount(path)
+    assert tnfs.du("/home/q") == {"entries": 8, "files": 4, "directories": 4, "bytes": 180}
+    total = tnfs.df()
+    assert total["bytes"] == tnfs.du("/")["bytes"] and total["owners"]["user"]["bytes"] == 150
+
+    tnfs.set_quota("/home/q", max_bytes=215)
+    tnfs.create_file("/home/q/c.txt", "c" * 30, owner="user", perms=0o644)
+    with pytest.raises(TunderCrash, match="Quota exceeded for /home/q"):
+        tnfs.write_file("/home/q/c.txt", "c" * 36)
+    with pytest.raises(TunderCrash, match="Quota exceeded"):
+        tnfs.copy_file("/home/q/a.txt", "/home/q/moved/a.txt")
+    assert tnfs.read_file("/home/q/c.txt") == "c" * 30 and tnfs.stat("/home/q/moved/a.txt") is None
+    tnfs.set_quota("user", max_entries=total["owners"]["user"]["files"] + total["owners"]["user"]["directories"] + 1)
+    with pytest.raises(TunderCrash, match="Quota exceeded for user user"):
+        tnfs.create_directory("/tmp/other", owner="user")
+    tnfs.remove("/home/q/c.txt")
+    assert [quota["target"] for quota in tnfs.quotas()] == ["user", "/home/q"]
+    assert tnfs.du("/home/q") == recount("/home/q")
+    tnfs.current_user = "user"
+    with pytest.raises(TunderCrash):
+        tnfs.set_quota("user")
+
+def test_storage_backends_behave_alike(tnfs, tmp_path):
+    from src.TNFS.TNFS import CHUNK_SIZE
+    tnfs.create_directory("/home/b", owner="root", perms=0o755)
+    tnfs.create_file("/home/b/big.txt", "x" * CHUNK_SIZE + "tail", owner="root", perms=0o644)
+    tnfs.create_file("/home/b/note.txt", "first line\nneedle here\n", owner="root", perms=0o644)
+    with tnfs.open("/home/b/big.txt", "r+") as handle:
+        handle.seek(CHUNK_SIZE - 1)
+        handle.write("YZ")
+    assert tnfs.read_file("/home/b/big.txt") == "x" * (CHUNK_SIZE - 1) + "YZail"
+    tnfs.copy_directory("/home/b", "/tmp/c")
+    tnfs.rename_file("/tmp/c/note.txt", "/tmp/c/renamed.txt")
+    tnfs.write_file("/tmp/c/renamed.txt", "changed needle")
+    assert tnfs.read_file("/home/b/note.txt") == "first line\nneedle here\n"
+    assert tnfs.grep("needle") == [("/home/b/note.txt", 2, "needle here"), ("/tmp/c/renamed.txt", 1, "changed needle")]
+    assert tnfs.find("/", "*.txt") == ["/home/b/big.txt", "/home/b/note.txt", "/tmp/c/big.txt", "/tmp/c/renamed.txt"]
+    with pytest.raises(RuntimeError):
+        with tnfs.transaction():
+            tnfs.remove("/tmp/c", recursive=True)
+            tnfs.create_file("/tmp/gone.txt", "x", owner="root", perms=0o644)
+            raise RuntimeError("abort")
+    assert tnfs.list_directory("/tmp/c") == ["big.txt", "renamed.txt"] and tnfs.stat("/tmp/gone.txt") is None
+    with pytest.raises(TunderCrash, match="Path already exists"):
+        tnfs.create_file("/home/b/note.txt", "again", owner="root", perms=0o644)
+    assert tnfs.du("/tmp/c") == {"entries": 2, "files": 2, "directories": 0, "bytes": CHUNK_SIZE + 4 + 14}
+    assert tnfs.fsck("/") == []
+    tnfs.remove("/tmp/c", recursive=True)
+    tnfs.remove("/home/b", recursive=True)
+    assert tnfs.list_directory("/home") == [] and tnfs.storage_stats()["blobs"] == 0
+    assert tnfs.fsck("/") == []
+    # счетчики обращений удаленных путей остаются в хранилище, но hot_files их пропускает
+    assert tnfs.hot_files() == []
+
+def test_memory_backend_rejects_file_only_features(tmp_path):
+    logger = Logger("test")
+    crash_handler = CrashHandler(logger)
+    with pytest.raises(TunderCrash, match="Invalid storage backend"):
+        TNFS(logger, crash_handler, None, None, db_path=tmp_path / "image.db", backend="tape")
+    tnfs = TNFS(logger, crash_handler, None, None, db_path=tmp_path / "image.db", backend="memory")
+    tnfs.current_user = "root"
+    assert not (tmp_path / "image.db").exists()
+    with pytest.raises(TunderCrash, match="does not support snapshots"):
+        tnfs.snapshot_create("s1")
+    with pytest.raises(TunderCrash, match="does not support compression"):
+        tnfs.compress()
+
+def test_log_backend_replays_segments_and_compacts(tmp_path):
+    import struct
+    from src.TNFS.logstore import LogBackend
+    logger = Logger("test")
+    crash_handler = CrashHandler(logger)
+    segments = tmp_path / "image.segments"
+
+    def reopen():
+        user_manager = UserManager(logger, crash_handler)
+        tnfs = TNFS(logger, crash_handler, user_manager, None, db_path=tmp_path / "image.db",
+                    backend=LogBackend(segments, segment_size=64 * 1024, compact_interval=None))
+        tnfs.current_user = "root"
+        tnfs.current_role = "root"
+        tnfs.selinux = SELinux(logger, crash_handler, tnfs, tmp_path / "selinux.db")
+        tnfs.selinux.set_mode("permissive")
+        user_manager.tnfs = tnfs
+        return tnfs
+
+    tnfs = reopen()
+    tnfs.create_directory("/home/log", owner="root", perms=0o755)
+    tnfs.create_file("/home/log/hot.txt", "", owner="root", perms=0o644)
+    tnfs.create_file("/home/log/gone.txt", "bye" * 2000, owner="root", perms=0o644)
+    for version in range(200):
+        tnfs.write_file("/home/log/hot.txt", f"version {version} " * 200)
+    tnfs.remove("/home/log/gone.txt")
+    assert not (tmp_path / "image.db").exists() and len(list(segments.glob("*.seg"))) > 4
+    # текст индекса не попадает в записи META: фиксация записи пишет только измененные ключи, а не содержимое файла
+    meta = [length for segment in tnfs.store.segments.values() for kind, _, length in segment.records() if kind == 2]
+    assert max(meta) < len("version 199 " * 200)
+    journal = tnfs.store.journal()
+    tnfs.selinux.close()
+    tnfs.close()
+
+    tnfs = reopen()
+    assert tnfs.list_directory("/home/log") == ["hot.txt"]
+    assert tnfs.read_file("/home/log/hot.txt") == "version 199 " * 200
+    assert [path for path, _, _ in tnfs.grep("version 199", "/home/log")] == ["/home/log/hot.txt"]
+    before = len(list(segments.glob("*.seg")))
+    assert tnfs.store.compact() > 0
+    assert len(list(segments.glob("*.seg"))) < before and tnfs.fsck("/") == []
+    tnfs.write_file("/home/log/hot.txt", "after compaction")
+    assert tnfs.store.journal()[:len(journal)] == journal
+    tnfs.selinux.close()
+    tnfs.close()
+    # недописанная запись после сбоя отбрасывается при открытии
+    with open(max(segments.glob("*.seg")), "ab") as segment:
+        segment.write(struct.pack("<BII", 2, 100, 0) + b'[["inode"')
+    tnfs = reopen()
+    assert tnfs.read_file("/home/log/hot.txt") == "after compaction"
+    assert tnfs.storage_stats()["blobs"] == 1 and tnfs.fsck("/") == []
+    assert tnfs.store.journal()[:len(journal)] == journal
+    tnfs.selinux.close()
+    tnfs.close()